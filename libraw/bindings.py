@@ -29,22 +29,29 @@ class LibRaw(CDLL):
     A :class:`ctypes.CDLL` that links against `libraw.so` (or the equivalent on
     your platform).
 
+    Args:
+        reentrant (bool): Link against the thread safe build of LibRaw
+                          (`libraw_r.so`) instead, which is needed to use
+                          LibRaw from several threads at once.
+
     Raises:
         ImportError: If LibRaw cannot be found on your system, or linking
                      fails.
     """
 
-    def __init__(self):  # pragma: no cover
-        libraw = util.find_library('raw')
+    def __init__(self, reentrant=False):  # pragma: no cover
+        name = 'raw_r' if reentrant else 'raw'
+        libraw = util.find_library(name)
         if libraw is None:
             # Windows (apparently; see #142)
-            libraw = util.find_library('libraw')
+            libraw = util.find_library('lib' + name)
         if libraw is None:
             # Attempt to guess manually (See #116)
             shared_lib_ext = {'Linux': '.so',
                               'Darwin': '.dylib', 'Windows': '.dll'}
             libraw = os.path.join(
-                sys.prefix, 'lib', 'libraw' + shared_lib_ext[platform.system()])
+                sys.prefix, 'lib',
+                'lib' + name + shared_lib_ext[platform.system()])
 
         try:
             if libraw is not None:
@@ -178,6 +185,28 @@ class LibRaw(CDLL):
         self.libraw_get_decoder_info.restype = c_error
         self.libraw_COLOR.restype = c_int
 
+        # Copying developed images into our own buffers (not available in
+        # older versions of LibRaw):
+
+        try:
+            self.libraw_get_mem_image_format.argtypes = [
+                POINTER(libraw_data_t),
+                POINTER(c_int),
+                POINTER(c_int),
+                POINTER(c_int),
+                POINTER(c_int),
+            ]
+            self.libraw_copy_mem_image.argtypes = [
+                POINTER(libraw_data_t),
+                c_void_p,
+                c_int,
+                c_int,
+            ]
+            self.libraw_get_mem_image_format.restype = None
+            self.libraw_copy_mem_image.restype = c_error
+        except AttributeError:
+            pass
+
         # Some special Windows-only garbage:
 
         try:
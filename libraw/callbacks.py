@@ -66,14 +66,16 @@ Returns:
     _ctypes.PyCFuncPtrType: A C callback.
 """
 
-progress_callback = CFUNCTYPE(c_void_p, c_int, c_int, c_int)
+progress_callback = CFUNCTYPE(c_int, c_void_p, c_int, c_int, c_int)
 """
 A callback that will be called to alert you to the stages of image processing.
+Returning a non-zero value cancels processing (the LibRaw call then fails with
+:class:`libraw.errors.CanceledByCallback`).
 
 .. sourcecode:: python
 
     def progress_cb(data, stage, iteration, expected):
-        pass
+        return 0
 
     cb = progress_callback(progress_cb)
 
@@ -83,7 +85,7 @@ Your callback function should map to the LibRaw C callback definition below:
 
 .. sourcecode:: c
 
-    typedef void (*progress_callback) (
+    typedef int (*progress_callback) (
         void *data, enum LibRaw_progress stage, int iterationa, int expected
     );
 
@@ -95,7 +97,7 @@ Returns:
 """
 
 exif_parser_callback = CFUNCTYPE(
-    c_void_p, c_int, c_int, c_int, c_uint, c_void_p)
+    None, c_void_p, c_int, c_int, c_int, c_uint, c_void_p)
 """
 A callback that will be called to alert you when EXIF data is parsed.
 
@@ -0,0 +1,357 @@
+""":mod:`rawkit.aio` --- asyncio support
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Opening, developing and extracting thumbnails from raw files takes anything
+from milliseconds to seconds of blocking work in LibRaw. The coroutines in
+this module run that work on a :class:`LibRawExecutor`'s threads instead of
+blocking the event loop:
+
+.. sourcecode:: python
+
+    from rawkit import aio
+
+    async def preview(path):
+        async with await aio.open(path) as raw:
+            return await raw.thumbnail()
+
+The executor bounds how many LibRaw calls run at once; callers beyond that
+wait their turn in the event loop. Cancelling a coroutine which is waiting for
+its turn simply removes it from the queue, and cancelling one which is running
+asks LibRaw to abort (through its progress callback) at the next processing
+stage, so a cancelled request doesn't keep a thread busy for seconds.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from libraw.callbacks import progress_callback
+
+from rawkit.raw import Raw
+
+AioStats = namedtuple('AioStats', [
+    'submitted',
+    'completed',
+    'failed',
+    'cancelled',
+    'waiting',
+    'running',
+    'queue_wait',
+    'max_queue_wait',
+    'service_time',
+    'max_service_time',
+])
+"""
+Counters for a :class:`LibRawExecutor`.
+
+`waiting` calls are queued for a slot and `running` calls hold one.
+`queue_wait` and `service_time` are the average number of seconds calls spent
+waiting for a slot and running on a thread (`max_queue_wait` and
+`max_service_time` are the largest).
+"""
+
+
+class LibRawExecutor(object):
+
+    """
+    Runs blocking LibRaw calls on a dedicated pool of threads, admitting at
+    most `max_concurrency` at a time.
+
+    An executor should only be used from one event loop.
+
+    Args:
+        workers (int): The number of threads. By default, one per CPU.
+        max_concurrency (int): The number of calls which may run at once. By
+                               default, the number of threads.
+
+    Returns:
+        LibRawExecutor: An executor.
+    """
+
+    def __init__(self, workers=None, max_concurrency=None):
+        """Start the thread pool."""
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrency = max_concurrency or self.workers
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._semaphore = None
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._waiting = 0
+        self._running = 0
+        self._admitted = 0
+        self._serviced = 0
+        self._queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._service_time = 0.0
+        self._max_service_time = 0.0
+
+    @property
+    def stats(self):
+        """
+        The executor's counters.
+
+        Returns:
+            rawkit.aio.AioStats: Counts, queue depth and timings.
+        """
+        return AioStats(
+            submitted=self._submitted,
+            completed=self._completed,
+            failed=self._failed,
+            cancelled=self._cancelled,
+            waiting=self._waiting,
+            running=self._running,
+            queue_wait=self._queue_wait / (self._admitted or 1),
+            max_queue_wait=self._max_queue_wait,
+            service_time=self._service_time / (self._serviced or 1),
+            max_service_time=self._max_service_time,
+        )
+
+    async def run(self, func, *args, cancel=None, discard=None, **kwargs):
+        """
+        Call a blocking function on one of the executor's threads, once a slot
+        is free.
+
+        Args:
+            func (callable): The function to call.
+            args: Its positional arguments.
+            cancel (callable): Called (in the event loop) if the call is
+                               cancelled while it is running, to ask the
+                               function to stop early.
+            discard (callable): Called with the result of a call which
+                                finished after being cancelled (eg. to close
+                                something it opened).
+            kwargs: Its keyword arguments.
+
+        Returns:
+            object: The function's result.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_event_loop()
+        self._submitted += 1
+        queued = time.monotonic()
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        except asyncio.CancelledError:
+            self._cancelled += 1
+            raise
+        finally:
+            self._waiting -= 1
+
+        started = time.monotonic()
+        self._admitted += 1
+        self._queue_wait += started - queued
+        self._max_queue_wait = max(self._max_queue_wait, started - queued)
+        self._running += 1
+        future = loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self._cancelled += 1
+            if cancel is not None:
+                cancel()
+            # The thread can't be interrupted, so hold on to the slot until
+            # it has actually stopped.
+            try:
+                result = await future
+            except Exception:
+                pass
+            else:
+                if discard is not None:
+                    discard(result)
+            raise
+        except Exception:
+            self._failed += 1
+            raise
+        else:
+            self._completed += 1
+        finally:
+            elapsed = time.monotonic() - started
+            self._serviced += 1
+            self._service_time += elapsed
+            self._max_service_time = max(self._max_service_time, elapsed)
+            self._running -= 1
+            self._semaphore.release()
+        return result
+
+    def shutdown(self, wait=True):
+        """
+        Shut down the thread pool.
+
+        Args:
+            wait (bool): Wait for running calls to finish.
+        """
+        self._executor.shutdown(wait=wait)
+
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def default_executor():
+    """
+    The executor used when none is given, created on first use.
+
+    Returns:
+        rawkit.aio.LibRawExecutor: The default executor.
+    """
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = LibRawExecutor()
+        return _default_executor
+
+
+class AsyncRaw(object):
+
+    """
+    A :class:`rawkit.raw.Raw` whose blocking methods are coroutines which run
+    on a :class:`LibRawExecutor`. Create one with :func:`open`.
+
+    Calls on the same raw are run one at a time, in the order they were made.
+    The underlying :class:`rawkit.raw.Raw` is available as :attr:`raw` (eg.
+    to set its options or read its metadata, which don't block).
+
+    Args:
+        raw (rawkit.raw.Raw): An open raw file.
+        executor (rawkit.aio.LibRawExecutor): The executor to run calls on.
+
+    Returns:
+        AsyncRaw: An asynchronous raw object.
+    """
+
+    def __init__(self, raw, executor=None):
+        """Register the progress callback used to cancel processing."""
+        self.raw = raw
+        self.executor = executor or default_executor()
+        self._lock = None
+        self._abort = threading.Event()
+        # LibRaw holds on to the callback, so we must too.
+        self._progress = progress_callback(self._check_abort)
+        raw.libraw.libraw_set_progress_handler(
+            raw.data, self._progress, None)
+
+    async def __aenter__(self):
+        """Return the raw for use in ``async with``."""
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Close the raw when leaving ``async with``."""
+        await self.close()
+
+    @property
+    def metadata(self):
+        """
+        Common metadata for the photo (see :attr:`rawkit.raw.Raw.metadata`).
+
+        Returns:
+            rawkit.metadata.Metadata: A metadata object.
+        """
+        return self.raw.metadata
+
+    def _check_abort(self, data, stage, iteration, expected):
+        return 1 if self._abort.is_set() else 0
+
+    async def _call(self, func, *args, **kwargs):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._abort.clear()
+            return await self.executor.run(
+                func, *args, cancel=self._abort.set, **kwargs)
+
+    async def to_buffer(self):
+        """
+        Develop the image into an RGB buffer (see
+        :func:`rawkit.raw.Raw.to_buffer`).
+
+        Returns:
+            bytearray: RGB data of the image.
+
+        Raises:
+            asyncio.CancelledError: If the call was cancelled.
+        """
+        return await self._call(self.raw.to_buffer)
+
+    async def to_array(self, dtype='float32', linear=True):
+        """
+        Develop the image into a floating point NumPy array (see
+        :func:`rawkit.raw.Raw.to_array`).
+
+        Args:
+            dtype (str): A NumPy floating point dtype.
+            linear (bool): Develop scene-linear data.
+
+        Returns:
+            numpy.ndarray: The developed image.
+        """
+        return await self._call(self.raw.to_array, dtype, linear)
+
+    async def thumbnail(self):
+        """
+        Extract the embedded thumbnail. Unlike
+        :func:`rawkit.raw.Raw.thumbnail`, the data is copied, so it stays
+        valid after the raw is closed.
+
+        Returns:
+            rawkit.thumbnail.Thumbnail: The thumbnail, with :class:`bytes`
+                                        data.
+
+        Raises:
+            libraw.errors.NoThumbnail: If the raw file does not contain a
+            thumbnail.
+        """
+        def thumbnail():
+            thumb = self.raw.thumbnail()
+            return thumb._replace(data=bytes(thumb.data))
+        return await self._call(thumbnail)
+
+    async def save(self, filename, filetype=None):
+        """
+        Develop and save the image (see :func:`rawkit.raw.Raw.save`).
+
+        Args:
+            filename (str): The name of an image file to save.
+            filetype (output_file_types): The type of file to output.
+        """
+        return await self._call(self.raw.save, filename, filetype)
+
+    async def close(self):
+        """Close the raw once any running call has finished."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self.raw.close()
+
+
+async def open(filename=None, executor=None, **kwargs):
+    """
+    Open a raw file without blocking the event loop.
+
+    Args:
+        filename (str): The name of a raw file to load.
+        executor (rawkit.aio.LibRawExecutor): The executor to run calls on. By
+                                              default, a shared executor with
+                                              one thread per CPU.
+        kwargs: Any other arguments to :class:`rawkit.raw.Raw`.
+
+    Returns:
+        AsyncRaw: The open raw file.
+    """
+    executor = executor or default_executor()
+    raw = await executor.run(
+        Raw, filename=filename, discard=lambda raw: raw.close(), **kwargs)
+    try:
+        return AsyncRaw(raw, executor)
+    except BaseException:
+        raw.close()
+        raise
@@ -0,0 +1,523 @@
+""":mod:`rawkit.batch` --- Develop many raw files in parallel
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:func:`develop` develops raw files on a pool of worker processes and writes
+each of them to a file named after it:
+
+.. sourcecode:: python
+
+    from rawkit.batch import develop
+    from rawkit.options import Options
+
+    options = Options({'half_size': True})
+    for result in develop(paths, options, '/out/{stem}.tiff', workers=8):
+        if result.error is not None:
+            print(result.path, result.error)
+
+A :class:`rawkit.raw.Raw` can't be sent to another process (it holds the
+loaded library and pointers into LibRaw's memory), so only plain values cross
+process boundaries: the options are sent in their frozen form (see
+:func:`rawkit.options.Options.freeze`), and each worker loads LibRaw once and
+develops every file it is given with it.
+
+:func:`develop_threaded` does the same on a pool of threads. ctypes releases
+the GIL while LibRaw is working (unpacking, demosaicing, writing), so threads
+can keep every core busy without the memory and start up cost of extra
+processes. This needs the thread safe build of LibRaw (``libraw_r``, see
+:class:`libraw.bindings.LibRaw`): the regular build keeps state in globals, so
+without it files are developed on a single thread. With it, different
+:class:`rawkit.raw.Raw` objects can be used from different threads at the
+same time (but one can't be shared between threads), and each thread builds
+its own options, so nothing mutable is shared. Warnings (eg. from
+:func:`rawkit.raw.Raw.data_pointer`) are emitted with :func:`warnings.warn`,
+which may be called from any thread, but :class:`warnings.catch_warnings` is
+not thread safe, so filter warnings once before starting rather than in the
+threads.
+
+Either of them can develop into shared memory instead of writing files (see
+:mod:`rawkit.shm`), so that large images aren't pickled through a pipe:
+
+.. sourcecode:: python
+
+    with SegmentPool() as segments:
+        for result in develop(paths, options, None, segments=segments):
+            pixels = segments.array(result.output)
+            ...
+            segments.release(result.output)
+"""
+
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import warnings
+
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from libraw.bindings import LibRaw
+from libraw.errors import InsufficientMemory
+
+from rawkit.options import Options
+from rawkit.raw import Raw
+from rawkit.shm import SharedImage
+from rawkit.shm import _Segments
+from rawkit.util import atomic_output
+
+BatchResult = namedtuple('BatchResult', [
+    'index', 'path', 'output', 'error', 'seconds', 'memory', 'retried'
+])
+"""
+The outcome of developing one file with :func:`develop`: its position in the
+input, its path, the file that was written (or the
+:class:`rawkit.shm.SharedImage` it was developed into), the exception raised
+while developing it (or ``None``), how long it took in seconds, its estimated
+peak memory use in bytes (see :func:`estimate_memory`, or ``None`` if it
+couldn't be opened) and whether it was retried alone after running out of
+memory.
+"""
+
+# Memory used by LibRaw and rawkit regardless of the image size.
+_BASE_MEMORY = 32 * 1024 ** 2
+
+# Budget usage which keeps everything else out while a job runs alone.
+_EXCLUSIVE = 1 << 62
+
+# The library, options, memory budget and shared memory segments used by
+# every file in a develop worker process.
+_worker_libraw = None
+_worker_options = None
+_worker_budget = None
+_worker_segments = None
+
+# The same, for each develop_threaded worker thread.
+_local = threading.local()
+
+
+def _init_develop_worker(frozen, budget, segments=None):
+    global _worker_libraw, _worker_options, _worker_budget, _worker_segments
+    _worker_libraw = LibRaw()
+    _worker_options = Options(dict(frozen))
+    _worker_budget = budget
+    _worker_segments = segments
+
+
+def estimate_memory(raw, options=None):
+    """
+    Estimate the peak memory needed to develop a raw file, from the sizes
+    LibRaw reads when the file is opened.
+
+    This counts the unpacked raw data (one 16-bit sample per photosite for
+    sensors with a color filter array, four otherwise), LibRaw's working image
+    (four 16-bit channels per output pixel) and about as much again for
+    interpolation, and the developed image at the output bit depth.
+
+    Args:
+        raw (rawkit.raw.Raw): An open raw file.
+        options (rawkit.options.Options): The options it will be developed
+                                          with. Defaults to ``raw.options``.
+
+    Returns:
+        int: The estimated peak memory, in bytes.
+    """
+    if options is None:
+        options = raw.options
+    contents = raw.data.contents
+    sizes = contents.sizes
+    samples = 1 if contents.idata.filters else 4
+    raw_bytes = sizes.raw_width * sizes.raw_height * 2 * samples
+
+    shrink = 2 if options.half_size else 1
+    pixels = (sizes.width // shrink) * (sizes.height // shrink)
+    image_bytes = pixels * 4 * 2 * 2
+    output_bytes = pixels * 3 * options.bps // 8
+    return raw_bytes + image_bytes + output_bytes + _BASE_MEMORY
+
+
+class _Budget(object):
+
+    """
+    Admits jobs while their estimated memory fits within a limit. Shared
+    budgets work across processes (they must be passed to the workers when
+    the pool is created).
+
+    A job is always admitted when nothing else is running, so jobs larger
+    than the whole budget still run (alone). Exclusive jobs wait until
+    nothing else is running, and keep new jobs out until they are done.
+    """
+
+    def __init__(self, limit, shared=False):
+        self.limit = limit
+        if shared:
+            self._condition = multiprocessing.Condition()
+            # Bytes in use, and the number of exclusive jobs waiting.
+            self._state = multiprocessing.RawArray('q', 2)
+        else:
+            self._condition = threading.Condition()
+            self._state = [0, 0]
+
+    def _fits(self, size):
+        used, exclusive = self._state
+        if exclusive:
+            return False
+        if used == 0:
+            return True
+        return used < _EXCLUSIVE and (
+            self.limit is None or used + size <= self.limit)
+
+    def acquire(self, size, exclusive=False):
+        with self._condition:
+            if exclusive:
+                self._state[1] += 1
+                try:
+                    self._condition.wait_for(lambda: self._state[0] == 0)
+                finally:
+                    self._state[1] -= 1
+                size = _EXCLUSIVE
+            else:
+                self._condition.wait_for(lambda: self._fits(size))
+            self._state[0] += size
+        return size
+
+    def release(self, size):
+        with self._condition:
+            self._state[0] -= size
+            self._condition.notify_all()
+
+
+def _portable(error):
+    """Make sure an exception can be sent back to the parent process."""
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RuntimeError('{}: {}'.format(type(error).__name__, error))
+    return error
+
+
+def _develop_one(task):
+    return _develop(task, _worker_libraw, _worker_options, _worker_budget,
+                    _worker_segments)
+
+
+def _reentrant():
+    """Whether the thread safe build of LibRaw can be loaded."""
+    try:
+        LibRaw(reentrant=True)
+    except ImportError:
+        return False
+    return True
+
+
+def _thread_state(frozen, reentrant=True):
+    """Get this thread's library, and the options for `frozen`."""
+    if getattr(_local, 'reentrant', None) != reentrant:
+        _local.libraw = LibRaw(reentrant=reentrant)
+        _local.reentrant = reentrant
+    if getattr(_local, 'frozen', None) != frozen:
+        _local.options = Options(dict(frozen))
+        _local.frozen = frozen
+    return _local.libraw, _local.options
+
+
+def _develop_in_thread(task, frozen, budget, segments, reentrant):
+    libraw, options = _thread_state(frozen, reentrant)
+    return _develop(task, libraw, options, budget, segments)
+
+
+def _make_parent(output):
+    """Create the directory an output will be written to."""
+    directory = output and os.path.dirname(output)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def _develop_file(path, write, libraw, options, budget, exclusive, estimate):
+    with Raw(filename=path, libraw=libraw) as raw:
+        raw.options = options
+        estimate[0] = estimate_memory(raw, options)
+        admitted = budget.acquire(estimate[0], exclusive)
+        try:
+            return write(raw)
+        finally:
+            budget.release(admitted)
+
+
+def _develop(task, libraw, options, budget, segments=None):
+    index, path, output, filetype = task
+    started = time.time()
+    estimate = [None]
+    retried = False
+
+    if segments is not None:
+        def write(raw):
+            return segments.develop(raw, options)
+    else:
+        def write(raw):
+            # Nothing is left behind if developing fails half way through.
+            with atomic_output(output) as tmp:
+                raw.save(filename=tmp, filetype=filetype)
+            return output
+
+    try:
+        _make_parent(output)
+        try:
+            output = _develop_file(path, write, libraw, options, budget,
+                                   False, estimate)
+        except InsufficientMemory:
+            # Try again once nothing else is running.
+            retried = True
+            output = _develop_file(path, write, libraw, options, budget,
+                                   True, estimate)
+        error = None
+    except Exception as e:
+        error = _portable(e)
+    return BatchResult(index, path, output, error, time.time() - started,
+                       estimate[0], retried)
+
+
+def output_name(template, path, index=0):
+    """
+    Build an output file name from a template.
+
+    The template is formatted with ``dir`` (the directory the raw file is in),
+    ``name`` (its file name), ``stem`` (its file name without the extension),
+    ``ext`` (its extension, without the dot) and ``index`` (its position in
+    the input), eg. ``'{dir}/developed/{stem}.tiff'``.
+
+    Args:
+        template (str): A :func:`str.format` template.
+        path (str): The raw file.
+        index (int): The position of the file in the input.
+
+    Returns:
+        str: The output file name.
+    """
+    path = os.fsdecode(path)
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    return template.format(
+        dir=directory or '.', name=name, stem=stem, ext=ext[1:], index=index)
+
+
+def _tasks(paths, output_template, filetype):
+    return [
+        (i, path,
+         output_name(output_template, path, i) if output_template else None,
+         filetype)
+        for i, path in enumerate(paths)
+    ]
+
+
+def _adopt(segments, result):
+    """Make sure the parent knows about a segment created by a worker."""
+    if segments is not None and isinstance(result.output, SharedImage):
+        segments._adopt(result.output)
+
+
+def develop(paths, options, output_template, workers=None, filetype=None,
+            ordered=True, chunksize=None, max_tasks_per_worker=100,
+            progress=None, memory_budget=None, segments=None):
+    """
+    Develop raw files on a pool of processes, yielding a
+    :class:`BatchResult` as each one is finished.
+
+    A file which fails to develop doesn't stop the batch: its result holds the
+    exception. Outputs are written atomically, and their directories are
+    created as needed.
+
+    Each file's peak memory use is estimated as soon as it has been opened
+    (see :func:`estimate_memory`), and it is only developed once it fits in
+    `memory_budget` alongside the files already being developed (a file which
+    doesn't fit on its own waits until nothing else is running). A file which
+    still runs out of memory (:class:`libraw.errors.InsufficientMemory`) is
+    retried once, on its own.
+
+    With `segments`, each file is developed straight into a shared memory
+    segment instead of being written to a file, and its result's `output` is
+    the :class:`rawkit.shm.SharedImage` describing it. Only that handle is sent
+    back from the workers; the image belongs to the caller until it is
+    released.
+
+    Args:
+        paths (iterable): The raw files to develop.
+        options (rawkit.options.Options): The options to develop every file
+                                          with (or ``None`` for the
+                                          defaults).
+        output_template (str): The output file name for each file (see
+                               :func:`output_name`). Ignored (and may be
+                               ``None``) with `segments`.
+        workers (int): The number of processes to use. By default, one per
+                       CPU. With a single worker the files are developed in
+                       this process.
+        filetype (output_file_types): The type of file to write. By default,
+                                      it is guessed from each output's file
+                                      name.
+        ordered (bool): Yield results in the order of `paths`. Otherwise they
+                        are yielded as soon as they are ready.
+        chunksize (int): The number of files handed to a worker at a time. By
+                         default, small chunks are used so the work stays
+                         balanced.
+        max_tasks_per_worker (int): Replace each worker process after it has
+                                    handled this many chunks, which returns
+                                    the memory LibRaw's heap has accumulated
+                                    to the system. ``None`` keeps workers for
+                                    the whole batch.
+        progress (callable): Called with the number of files done and the
+                             total after each file.
+        memory_budget (int): The number of bytes the files being developed
+                             at once may use. By default, only the number of
+                             workers limits how many files are developed at
+                             once.
+        segments (rawkit.shm.SegmentPool): Develop into shared memory
+                                           segments from this pool.
+
+    Yields:
+        BatchResult: The outcome of each file.
+    """
+    global _worker_libraw, _worker_options, _worker_budget, _worker_segments
+
+    frozen = (options or Options()).freeze()
+    tasks = _tasks(paths, output_template, filetype)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, min(8, len(tasks) // (workers * 4)))
+
+    done = 0
+    if workers == 1:
+        saved = (_worker_libraw, _worker_options, _worker_budget,
+                 _worker_segments)
+        _init_develop_worker(frozen, _Budget(memory_budget), segments)
+        try:
+            for task in tasks:
+                result = _develop_one(task)
+                done += 1
+                if progress is not None:
+                    progress(done, len(tasks))
+                yield result
+        finally:
+            (_worker_libraw, _worker_options, _worker_budget,
+             _worker_segments) = saved
+        return
+
+    pool = multiprocessing.Pool(
+        workers,
+        initializer=_init_develop_worker,
+        initargs=(
+            frozen,
+            _Budget(memory_budget, shared=True),
+            # Workers share the list of free segments, but not the pool.
+            segments and _Segments(segments._free, segments._lock),
+        ),
+        maxtasksperchild=max_tasks_per_worker,
+    )
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(_develop_one, tasks, chunksize):
+            _adopt(segments, result)
+            done += 1
+            if progress is not None:
+                progress(done, len(tasks))
+            yield result
+    except BaseException:
+        # Stopping early (or failing) kills whatever is still running.
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def develop_threaded(paths, options, output_template, workers=None,
+                     filetype=None, ordered=True, progress=None,
+                     memory_budget=None, segments=None):
+    """
+    Develop raw files on a pool of threads, yielding a :class:`BatchResult`
+    as each one is finished. This takes the same arguments (and behaves the
+    same way) as :func:`develop`, but uses much less memory than a pool of
+    processes.
+
+    Each thread builds the options once, and reuses them for every file it
+    develops. Only a few files per thread are submitted ahead of the results
+    which have been consumed, and stopping early cancels the rest.
+
+    Threads need the thread safe build of LibRaw (``libraw_r``). If it isn't
+    available, a warning is emitted and files are developed on one thread.
+
+    Args:
+        paths (iterable): The raw files to develop.
+        options (rawkit.options.Options): The options to develop every file
+                                          with (or ``None`` for the
+                                          defaults).
+        output_template (str): The output file name for each file (see
+                               :func:`output_name`).
+        workers (int): The number of threads to use. By default, one per CPU.
+        filetype (output_file_types): The type of file to write.
+        ordered (bool): Yield results in the order of `paths`.
+        progress (callable): Called with the number of files done and the
+                             total after each file.
+        memory_budget (int): The number of bytes the files being developed
+                             at once may use.
+        segments (rawkit.shm.SegmentPool): Develop into shared memory
+                                           segments from this pool.
+
+    Yields:
+        BatchResult: The outcome of each file.
+    """
+    frozen = (options or Options()).freeze()
+    budget = _Budget(memory_budget)
+    tasks = _tasks(paths, output_template, filetype)
+    total = len(tasks)
+    workers = workers or os.cpu_count() or 1
+    reentrant = _reentrant()
+    if not reentrant:
+        warnings.warn(
+            'The thread safe build of LibRaw (libraw_r) is not available; '
+            'developing on one thread.')
+        workers = 1
+    pending = deque()
+    done = 0
+
+    tasks = iter(tasks)
+    executor = ThreadPoolExecutor(workers)
+    try:
+        while True:
+            for task in tasks:
+                pending.append(
+                    executor.submit(
+                        _develop_in_thread, task, frozen, budget, segments,
+                        reentrant))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            for result in _collect(pending, ordered):
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+                yield result
+    finally:
+        # Only files which have already started are finished if we stop
+        # early.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _collect(pending, ordered):
+    """Take the next finished result(s) from a deque of futures."""
+    if ordered:
+        return [pending.popleft().result()]
+    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in finished:
+        pending.remove(future)
+    return [future.result() for future in finished]
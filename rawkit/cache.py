@@ -0,0 +1,323 @@
+""":mod:`rawkit.cache` --- On-disk thumbnail cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Extracting an embedded preview means opening the whole raw file with LibRaw.
+:class:`ThumbnailCache` keeps the resulting JPEGs on disk, keyed by the
+identity of the raw file (its path, size, modification time and inode) and the
+requested size, so repeated requests never touch LibRaw:
+
+.. sourcecode:: python
+
+    from rawkit.cache import ThumbnailCache
+
+    cache = ThumbnailCache('/var/cache/thumbs', max_bytes=10 * 1024 ** 3)
+    jpeg = cache.get('some/raw/image.CR2', size=320)
+
+The cache may be shared by several processes. Entries are written to a
+temporary file and atomically renamed into place, and changes to the cache's
+size (which is kept in a small file beside the entries, so it never has to be
+measured by walking the whole tree) and eviction (least recently used first)
+are serialized with a lock file.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from collections import namedtuple
+
+from rawkit.raw import Raw
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+CacheStats = namedtuple(
+    'CacheStats', ['hits', 'misses', 'evictions', 'bytes']
+)
+"""
+Counters for a :class:`ThumbnailCache`. Counts are for this process only; the
+size in bytes is an estimate for the whole cache.
+"""
+
+# After evicting, the cache is trimmed to this fraction of its budget, so that
+# eviction doesn't run again on the very next insert.
+_LOW_WATER = 0.9
+
+_LOCK_NAME = '.lock'
+_SIZE_NAME = '.size'
+
+
+class _Lock(object):
+
+    """An exclusive, inter-process lock on a file (a no-op without fcntl)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._f = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        self._f.close()
+
+
+class ThumbnailCache(object):
+
+    """
+    A content addressed cache of thumbnail JPEGs with a size budget.
+
+    Entries are stored in a sharded directory tree (eg.
+    ``ab/cd/abcdef....jpg``) so no single directory grows too large. Every hit
+    refreshes the entry's modification time, which is used to evict the least
+    recently used entries once the cache grows past `max_bytes`.
+
+    Args:
+        directory (str): The cache directory. It is created if it does not
+                         exist.
+        max_bytes (int): The size budget for the cache.
+        quality (int): JPEG quality used for thumbnails which are scaled.
+
+    Returns:
+        ThumbnailCache: A cache.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, quality=85):
+        """Create the cache directory and read its current size."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Guards the counters, as the cache may be shared between threads.
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        self._bytes = self._read_size()
+        if self._bytes is None:
+            # A new cache (or one written by an older version): measure it.
+            with _Lock(os.path.join(self.directory, _LOCK_NAME)):
+                self._update_size(0)
+
+    @property
+    def stats(self):
+        """
+        The cache's counters.
+
+        Returns:
+            rawkit.cache.CacheStats: Hits, misses, evictions and size.
+        """
+        with self._lock:
+            return CacheStats(
+                self.hits, self.misses, self.evictions, self._bytes)
+
+    def key(self, filename, size=None):
+        """
+        Compute the cache key for a raw file and requested size.
+
+        Args:
+            filename (str): The raw file.
+            size (int): The requested size (longest edge), or None for the
+                        thumbnail as embedded.
+
+        Returns:
+            str: A hexadecimal key.
+
+        Raises:
+            OSError: If the raw file cannot be found.
+        """
+        st = os.stat(filename)
+        identity = '\0'.join(str(part) for part in (
+            os.path.realpath(filename),
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ino,
+            size,
+        ))
+        digest = hashlib.sha1(identity.encode('utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        """
+        The path at which the entry for `key` is stored.
+
+        Args:
+            key (str): A cache key.
+
+        Returns:
+            str: A file path.
+        """
+        return os.path.join(
+            self.directory, key[:2], key[2:4], key + '.jpg')
+
+    def get(self, filename, size=None):
+        """
+        Get a thumbnail JPEG for a raw file, extracting (and caching) it if
+        it is not already cached.
+
+        Args:
+            filename (str): The raw file.
+            size (int): Scale the thumbnail so that its longest edge is at
+                        most this many pixels.
+
+        Returns:
+            bytes: A JPEG file.
+
+        Raises:
+            libraw.errors.NoThumbnail: If the raw file does not contain a
+            thumbnail.
+        """
+        key = self.key(filename, size)
+        data = self.lookup(key)
+        if data is not None:
+            return data
+
+        with self._lock:
+            self.misses += 1
+        with Raw(filename=filename) as raw:
+            data = raw.thumbnail().to_jpeg(size, quality=self.quality)
+        self.put(key, data)
+        return data
+
+    def lookup(self, key):
+        """
+        Get a cached entry without extracting it on a miss. Hits refresh the
+        entry's position in the LRU order.
+
+        Args:
+            key (str): A cache key.
+
+        Returns:
+            bytes: The cached JPEG, or None.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Missing, or evicted by another process since we opened it.
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Atomically store an entry, evicting old entries if the cache is over
+        budget.
+
+        Args:
+            key (str): A cache key.
+            data (bytes): The JPEG to store.
+        """
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with _Lock(os.path.join(self.directory, _LOCK_NAME)):
+                try:
+                    replaced = os.stat(path).st_size
+                except OSError:
+                    replaced = 0
+                os.replace(tmp, path)
+                total = self._update_size(len(data) - replaced)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+        if total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is comfortably
+        within its budget. Other processes are locked out while the cache is
+        walked for candidates and trimmed, and the recorded size is corrected
+        from the walk.
+        """
+        with _Lock(os.path.join(self.directory, _LOCK_NAME)):
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * _LOW_WATER
+            evicted = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+            self._write_size(total)
+            with self._lock:
+                self.evictions += evicted
+                self._bytes = total
+
+    def _read_size(self):
+        """The recorded size of the cache, or None if it is unknown."""
+        try:
+            with open(os.path.join(self.directory, _SIZE_NAME)) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_size(self, total):
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp',
+                                   dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(total))
+        os.replace(tmp, os.path.join(self.directory, _SIZE_NAME))
+
+    def _update_size(self, delta):
+        """
+        Add `delta` to the recorded size of the cache (measuring it if it is
+        unknown), and return the new size. Must be called with the lock file
+        held.
+        """
+        total = self._read_size()
+        if total is None:
+            total = sum(size for _, size, _ in self._entries())
+        else:
+            total = max(0, total + delta)
+        self._write_size(total)
+        with self._lock:
+            self._bytes = total
+        return total
+
+    def _entries(self):
+        """Yield ``(path, size, mtime)`` for every entry in the cache."""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.jpg') or name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
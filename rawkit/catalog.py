@@ -0,0 +1,308 @@
+""":mod:`rawkit.catalog` --- A persistent index of raw files
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A :class:`Catalog` records every file found under a tree, and the metadata of
+its raw files, in an SQLite database. Refreshing the catalogue only opens
+files which are new or whose size, modification time or inode have changed,
+so re-scanning a large archive is mostly a matter of walking the directory
+tree:
+
+.. sourcecode:: python
+
+    from rawkit.catalog import Catalog
+
+    with Catalog('photos.db') as catalog:
+        catalog.refresh('/archive/photos')
+        for entry in catalog.query(make='Canon', min_iso=3200):
+            print(entry.path)
+
+Paths are stored and returned as :class:`bytes`, like those returned by
+:func:`rawkit.util.discover`.
+"""
+
+import errno
+import os
+import sqlite3
+
+from collections import namedtuple
+
+from libraw.bindings import LibRaw
+from libraw.errors import FileUnsupported
+from libraw.errors import LibRawError
+
+from rawkit.metadata import snapshot
+
+
+RefreshStats = namedtuple(
+    'RefreshStats', ['added', 'updated', 'removed', 'unchanged']
+)
+"""
+What a call to :func:`Catalog.refresh` did. Files which are not raw files
+are counted too (they are recorded so they don't have to be reopened).
+"""
+
+CatalogEntry = namedtuple('CatalogEntry', [
+    'path',
+    'make',
+    'model',
+    'lens',
+    'timestamp',
+    'iso',
+    'aperture',
+    'shutter',
+    'focal_length',
+    'width',
+    'height',
+    'orientation',
+])
+"""
+A raw file in a :class:`Catalog`. `make`, `model` and `lens` are decoded to
+:class:`str`.
+"""
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    is_raw INTEGER NOT NULL,
+    error TEXT,
+    make TEXT,
+    model TEXT,
+    lens TEXT,
+    timestamp INTEGER,
+    iso REAL,
+    aperture REAL,
+    shutter REAL,
+    focal_length REAL,
+    width INTEGER,
+    height INTEGER,
+    orientation INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_camera ON files (make, model);
+CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp);
+CREATE INDEX IF NOT EXISTS files_iso ON files (iso);
+CREATE INDEX IF NOT EXISTS files_lens ON files (lens);
+'''
+
+_COLUMNS = (
+    'path', 'size', 'mtime', 'inode', 'is_raw', 'error', 'make', 'model',
+    'lens', 'timestamp', 'iso', 'aperture', 'shutter', 'focal_length',
+    'width', 'height', 'orientation',
+)
+
+_INSERT = 'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if value else None
+
+
+def _missing(path):
+    """Whether a file certainly no longer exists."""
+    try:
+        os.stat(path)
+    except OSError as e:
+        return e.errno in (errno.ENOENT, errno.ENOTDIR)
+    return False
+
+
+class Catalog(object):
+
+    """
+    An SQLite backed index of the files under one or more directory trees.
+
+    Args:
+        database (str): The database file. It is created if it does not
+                        exist.
+        batch_size (int): The number of files written per transaction while
+                          refreshing.
+
+    Returns:
+        Catalog: A catalogue.
+    """
+
+    def __init__(self, database, batch_size=1000):
+        """Open (and if necessary create) the database."""
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(database)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+        self._libraw = None
+        self._data = None
+
+    def __enter__(self):
+        """Return the catalogue for use in context managers."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the catalogue when leaving the context manager."""
+        self.close()
+
+    def close(self):
+        """Close the database and free the LibRaw handle."""
+        if self._data is not None:
+            self._libraw.libraw_close(self._data)
+            self._data = None
+        self.connection.close()
+
+    def _read(self, path):
+        """Read a file's metadata, returning ``(is_raw, error, metadata)``."""
+        if self._data is None:
+            # One handle is reused for every file.
+            self._libraw = LibRaw()
+            self._data = self._libraw.libraw_init(0)
+        try:
+            self._libraw.libraw_open_file(self._data, path)
+            return True, None, snapshot(self._data)
+        except FileUnsupported:
+            return False, None, None
+        except (LibRawError, IOError, OSError, KeyError) as e:
+            # LibRaw reports truncated files as IOError, and unknown error
+            # codes surface as KeyError; neither should stop a refresh.
+            return False, '{}: {}'.format(type(e).__name__, e), None
+        finally:
+            self._libraw.libraw_recycle(self._data)
+
+    def _row(self, path, st):
+        is_raw, error, metadata = self._read(path)
+        row = [path, st.st_size, st.st_mtime_ns, st.st_ino, is_raw, error]
+        if metadata is None:
+            return row + [None] * (len(_COLUMNS) - len(row))
+        return row + [
+            _text(metadata.make),
+            _text(metadata.model),
+            _text(metadata.lens.model) if metadata.lens else None,
+            metadata.timestamp,
+            metadata.iso,
+            metadata.aperture,
+            metadata.shutter,
+            metadata.focal_length,
+            metadata.width,
+            metadata.height,
+            metadata.orientation,
+        ]
+
+    def _known(self, root):
+        """
+        Get the recorded ``[size, mtime, inode, error]`` of files under
+        `root`.
+        """
+        prefix = root.rstrip(b'/') + b'/'
+        # Every path under prefix sorts between it and the same prefix with
+        # its trailing '/' replaced by the next byte, '0'.
+        cursor = self.connection.execute(
+            'SELECT path, size, mtime, inode, error FROM files '
+            'WHERE path >= ? AND path < ?',
+            (prefix, prefix[:-1] + b'0'),
+        )
+        return {bytes(row[0]): list(row[1:]) for row in cursor}
+
+    def _write(self, rows):
+        with self.connection:
+            self.connection.executemany(_INSERT, rows)
+        del rows[:]
+
+    def refresh(self, root):
+        """
+        Bring the catalogue up to date with a directory tree. New and changed
+        files are read with LibRaw, unchanged files (same size, modification
+        time and inode) are skipped unless reading them failed last time, and
+        files which have disappeared are removed.
+
+        Args:
+            root (str): The directory tree to scan.
+
+        Returns:
+            RefreshStats: Counts of what changed.
+        """
+        root = os.path.abspath(os.fsencode(root))
+        known = self._known(root)
+        added = updated = unchanged = 0
+        rows = []
+
+        # Directories which couldn't be listed (but still exist).
+        unlisted = []
+
+        def walk_error(error):
+            if error.errno != errno.ENOENT:
+                unlisted.append(error.filename.rstrip(b'/') + b'/')
+
+        for directory, _, files in os.walk(root, onerror=walk_error):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state = known.pop(path, None)
+                # Files which couldn't be read are retried, in case the
+                # error was transient.
+                if state == [st.st_size, st.st_mtime_ns, st.st_ino, None]:
+                    unchanged += 1
+                    continue
+                if state is None:
+                    added += 1
+                else:
+                    updated += 1
+                rows.append(self._row(path, st))
+                if len(rows) >= self.batch_size:
+                    self._write(rows)
+
+        self._write(rows)
+        # Files which weren't seen are only removed once it's certain that
+        # they no longer exist, rather than because their directory couldn't
+        # be listed or they couldn't be stat'ed.
+        removed = [
+            path for path in known
+            if not path.startswith(tuple(unlisted)) and _missing(path)
+        ]
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM files WHERE path = ?',
+                ((path,) for path in removed))
+        return RefreshStats(
+            added, updated, len(removed),
+            unchanged + len(known) - len(removed))
+
+    def query(self, make=None, model=None, lens=None, since=None, until=None,
+              min_iso=None, max_iso=None):
+        """
+        Find raw files by their metadata. Every criterion is optional, and
+        all of those given must match.
+
+        Args:
+            make (str): The camera make.
+            model (str): The camera model.
+            lens (str): The lens model.
+            since (int): The earliest timestamp (seconds since the epoch).
+            until (int): The latest timestamp (seconds since the epoch).
+            min_iso (float): The lowest ISO speed.
+            max_iso (float): The highest ISO speed.
+
+        Returns:
+            list: :class:`CatalogEntry` objects, ordered by timestamp.
+        """
+        criteria = [('is_raw = ?', 1)]
+        for clause, value in (('make = ?', make),
+                              ('model = ?', model),
+                              ('lens = ?', lens),
+                              ('timestamp >= ?', since),
+                              ('timestamp <= ?', until),
+                              ('iso >= ?', min_iso),
+                              ('iso <= ?', max_iso)):
+            if value is not None:
+                criteria.append((clause, value))
+
+        cursor = self.connection.execute(
+            'SELECT {} FROM files WHERE {} ORDER BY timestamp, path'.format(
+                ', '.join(CatalogEntry._fields),
+                ' AND '.join(clause for clause, _ in criteria)),
+            [value for _, value in criteria],
+        )
+        return [
+            CatalogEntry(bytes(row[0]), *row[1:]) for row in cursor
+        ]
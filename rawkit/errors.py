@@ -21,3 +21,11 @@ class NoFileSpecified(ValueError):
     Raised when the method or function excpects a `filename` argument, but no
     file name (or a value of `None`) was specified.
     """
+
+
+class MetadataOnly(RuntimeError):
+
+    """
+    Raised when pixel data (the raw image or its thumbnail) is requested from
+    a :class:`rawkit.raw.Raw` which was opened for metadata only.
+    """
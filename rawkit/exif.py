@@ -0,0 +1,221 @@
+""":mod:`rawkit.exif` --- EXIF tags collected while parsing
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+LibRaw walks every TIFF/EXIF directory in a raw file while opening it, but only
+keeps the handful of tags it needs. Opening a :class:`rawkit.raw.Raw` with
+``collect_exif`` records every tag LibRaw sees as it goes, so the full EXIF is
+available without parsing the file a second time:
+
+.. sourcecode:: python
+
+    from rawkit.raw import Raw
+
+    with Raw(filename='some/raw/image.NEF', collect_exif=[0x9003]) as raw:
+        for entry in raw.exif:
+            print(hex(entry.tag), entry.value)
+
+LibRaw doesn't pass the values to its callback, only the stream it is reading
+the file through, so values are read by calling the stream's C++ ``read()``
+method. That depends on the layout of the stream class and on the C++ ABI, so
+it is only done with versions of LibRaw whose layout is known, built with the
+Itanium C++ ABI (GCC or Clang, on anything but Windows; see
+:func:`can_read_values`). Otherwise every entry is still recorded, but without
+its value.
+"""
+
+import ctypes
+import struct
+import sys
+
+from collections import namedtuple
+
+from libraw.callbacks import exif_parser_callback
+
+
+exif_types = namedtuple(
+    'ExifType',
+    ['byte', 'ascii', 'short', 'long', 'rational', 'sbyte', 'undefined',
+     'sshort', 'slong', 'srational', 'float', 'double', 'ifd']
+)(1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
+"""
+Constants for the TIFF field types of EXIF entries.
+"""
+
+ExifEntry = namedtuple(
+    'ExifEntry', ['tag', 'type', 'length', 'byte_order', 'value']
+)
+"""
+A single EXIF entry, as reported by LibRaw.
+
+The low 16 bits of `tag` are the TIFF tag number; LibRaw uses the higher bits
+to say which directory the entry came from. `type` is one of
+:data:`exif_types`, `length` is the number of values and `byte_order` is
+``'little'`` or ``'big'``.
+
+`value` is ``None`` if the tag was not requested. Otherwise ASCII and
+undefined values are :class:`bytes` (with ASCII's trailing NULs removed),
+rationals are a tuple of ``(numerator, denominator)`` pairs, and every other
+type is a tuple of numbers.
+"""
+
+# struct format characters for each type (rationals are pairs).
+_FORMATS = {
+    exif_types.byte: 'B',
+    exif_types.short: 'H',
+    exif_types.long: 'I',
+    exif_types.rational: 'II',
+    exif_types.sbyte: 'b',
+    exif_types.sshort: 'h',
+    exif_types.slong: 'i',
+    exif_types.srational: 'ii',
+    exif_types.float: 'f',
+    exif_types.double: 'd',
+    exif_types.ifd: 'I',
+}
+
+_BYTE_ORDERS = {0x4949: 'little', 0x4d4d: 'big'}
+
+# Values larger than this are assumed to come from a corrupt directory and
+# are not read.
+_MAX_VALUE_SIZE = 16 * 1024 * 1024
+
+# LibRaw passes its LibRaw_abstract_datastream (a C++ object) to the callback,
+# positioned at the entry's value. Its read() method is found through the
+# object's vtable: after the virtual destructor (two vtable slots with the
+# Itanium ABI used by GCC and Clang) and valid().
+_READ_SLOT = 3
+
+# LibRaw versions whose datastream class is laid out as above.
+_STREAM_VERSIONS = frozenset([(0, 16), (0, 17), (0, 18), (0, 19)])
+_read_method = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+    ctypes.c_size_t)
+
+
+def can_read_values(version, platform=None):
+    """
+    Check if EXIF values can safely be read while LibRaw parses a file.
+
+    Windows is excluded because LibRaw may be built there with either MSVC or
+    MinGW, whose vtable layouts differ.
+
+    Args:
+        version (3 tuple): The LibRaw version (see
+                           :attr:`libraw.bindings.LibRaw.version_number`).
+        platform (str): The platform, as in :data:`sys.platform`. Defaults to
+                        the current platform.
+
+    Returns:
+        boolean: ``True`` if values can be read.
+    """
+    if platform is None:
+        platform = sys.platform
+    try:
+        known = tuple(version[:2]) in _STREAM_VERSIONS
+    except TypeError:
+        return False
+    return known and platform != 'win32'
+
+
+def _value_size(type, length):
+    if type in (exif_types.ascii, exif_types.undefined):
+        return length
+    if type not in _FORMATS:
+        return None
+    return struct.calcsize('=' + _FORMATS[type]) * length
+
+
+def _read_stream(ifp, size):
+    """Read `size` bytes from a LibRaw datastream."""
+    vtable = ctypes.cast(
+        ifp, ctypes.POINTER(ctypes.POINTER(ctypes.c_void_p))).contents
+    read = _read_method(vtable[_READ_SLOT])
+    buf = ctypes.create_string_buffer(size)
+    count = read(ifp, buf, 1, size)
+    return buf.raw[:max(count, 0)]
+
+
+def decode(type, length, byte_order, data):
+    """
+    Decode the raw bytes of an EXIF value.
+
+    Args:
+        type (int): One of :data:`exif_types`.
+        length (int): The number of values.
+        byte_order (str): ``'little'`` or ``'big'``.
+        data (bytes): The value's bytes.
+
+    Returns:
+        object: The value (see :class:`ExifEntry`), or ``None`` if the type is
+                unknown or `data` is too short.
+    """
+    if type == exif_types.ascii:
+        return data[:length].rstrip(b'\x00')
+    if type == exif_types.undefined:
+        return data[:length]
+    if type not in _FORMATS:
+        return None
+
+    fmt = ('<' if byte_order == 'little' else '>') + _FORMATS[type] * length
+    if len(data) < struct.calcsize(fmt):
+        return None
+    values = struct.unpack_from(fmt, data)
+    if type in (exif_types.rational, exif_types.srational):
+        return tuple(zip(values[::2], values[1::2]))
+    return values
+
+
+class ExifCollector(object):
+
+    """
+    Records the EXIF entries LibRaw reports while parsing a file.
+
+    The C callback is kept on the collector, which must stay alive for as long
+    as LibRaw may call it (:class:`rawkit.raw.Raw` keeps it for its whole
+    lifetime).
+
+    Args:
+        tags (iterable): TIFF tag numbers whose values should be read. Other
+                         entries are recorded without their values. By
+                         default every value is read.
+        read_values (bool): Whether values can be read at all (see
+                            :func:`can_read_values`). If not, every entry is
+                            recorded without its value.
+
+    Returns:
+        ExifCollector: A collector.
+    """
+
+    def __init__(self, tags=None, read_values=True):
+        """Create the C callback."""
+        self.tags = None if tags is None else frozenset(tags)
+        self.read_values = read_values
+        self.entries = []
+        self.callback = exif_parser_callback(self._collect)
+
+    def wants(self, tag):
+        """
+        Check if the value of a tag should be read.
+
+        Args:
+            tag (int): A tag as reported by LibRaw.
+
+        Returns:
+            boolean: ``True`` if the value should be read.
+        """
+        return (self.tags is None or tag in self.tags or
+                tag & 0xffff in self.tags)
+
+    def _collect(self, context, tag, type, length, order, ifp):
+        byte_order = _BYTE_ORDERS.get(order, sys.byteorder)
+        value = None
+        if self.read_values and self.wants(tag):
+            size = _value_size(type, length)
+            if size is not None and 0 <= size <= _MAX_VALUE_SIZE:
+                try:
+                    value = decode(type, length, byte_order,
+                                   _read_stream(ifp, size))
+                except Exception:  # pragma: no cover
+                    # Never let an exception unwind into LibRaw.
+                    value = None
+        self.entries.append(ExifEntry(tag, type, length, byte_order, value))
@@ -0,0 +1,228 @@
+""":mod:`rawkit.export` --- Incremental exports
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+When an archive is re-exported, most outputs are usually already up to date.
+:class:`IncrementalExporter` keeps a manifest which records, for every output,
+what it was developed from: the identity of the source file, the (frozen)
+development options and the LibRaw version. Outputs whose record still matches
+are skipped without opening the raw file at all.
+
+New outputs are written to a temporary file and atomically renamed into place,
+so an interrupted run never leaves a truncated image behind.
+
+.. sourcecode:: python
+
+    from rawkit.export import IncrementalExporter
+    from rawkit.options import Options
+
+    options = Options({'bps': 16})
+
+    with IncrementalExporter('exports/manifest.json') as exporter:
+        for src in sources:
+            exporter.export(src, 'exports/' + name(src) + '.tiff', options)
+"""
+
+import hashlib
+import json
+import os
+
+from libraw.bindings import LibRaw
+
+from rawkit.options import Options
+from rawkit.raw import Raw
+from rawkit.util import atomic_output
+
+
+identities = ('mtime', 'hash')
+"""
+Ways of identifying a source file.
+
+  - ``mtime`` --- The file's size and modification time (fast).
+  - ``hash`` --- The file's size and a SHA-256 hash of its contents (reads the
+    whole file, but survives copies and ``touch``).
+"""
+
+# Read size used when hashing source files.
+_HASH_BLOCK = 1024 * 1024
+
+
+def source_identity(filename, identity='mtime'):
+    """
+    Identify the current contents of a source file without opening it with
+    LibRaw.
+
+    Args:
+        filename (str): The source file.
+        identity (str): One of :data:`identities`.
+
+    Returns:
+        dict: A JSON serializable description of the file.
+
+    Raises:
+        ValueError: If `identity` is not one of :data:`identities`.
+        OSError: If the file cannot be read.
+    """
+    if identity not in identities:
+        raise ValueError('identity must be one of {}'.format(identities))
+
+    st = os.stat(filename)
+    record = {
+        'path': os.path.abspath(filename),
+        'size': st.st_size,
+    }
+    if identity == 'mtime':
+        record['mtime'] = st.st_mtime_ns
+    else:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+                digest.update(block)
+        record['sha256'] = digest.hexdigest()
+    return record
+
+
+class IncrementalExporter(object):
+
+    """
+    Develops raw files into outputs, skipping outputs which are already up to
+    date according to a JSON manifest.
+
+    The manifest is written atomically every `flush_every` exports and when
+    the exporter is closed.
+
+    Args:
+        manifest (str): Path of the manifest file. It is created if it does
+                        not exist.
+        identity (str): How to identify source files; one of
+                        :data:`identities`.
+        flush_every (int): Number of exports between manifest writes.
+
+    Returns:
+        IncrementalExporter: An exporter.
+    """
+
+    def __init__(self, manifest, identity='mtime', flush_every=100):
+        """Load the manifest, if it exists."""
+        if identity not in identities:
+            raise ValueError('identity must be one of {}'.format(identities))
+        self.manifest = manifest
+        self.identity = identity
+        self.flush_every = flush_every
+        self._dirty = 0
+        self._libraw_version = None
+        try:
+            with open(manifest) as f:
+                self.records = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.records = {}
+
+    def __enter__(self):
+        """Return the exporter for use in context managers."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Write the manifest when leaving the context manager."""
+        self.close()
+
+    @property
+    def libraw_version(self):
+        """
+        The version of LibRaw that outputs are developed with.
+
+        Returns:
+            str: The version.
+        """
+        if self._libraw_version is None:
+            self._libraw_version = LibRaw().version
+        return self._libraw_version
+
+    def record(self, source, options=None, filetype=None):
+        """
+        Build the manifest record describing an output developed from
+        `source` with `options`.
+
+        Args:
+            source (str): The raw file.
+            options (rawkit.options.Options): The development options.
+            filetype (output_file_types): The output filetype, if not guessed
+                                          from the output's name.
+
+        Returns:
+            dict: The record.
+        """
+        record = {
+            'source': source_identity(source, self.identity),
+            'options': (options or Options()).freeze(),
+            'filetype': filetype,
+            'libraw': self.libraw_version,
+        }
+        # Normalize tuples and the like to what they will be read back as.
+        return json.loads(json.dumps(record))
+
+    def is_current(self, source, output, options=None, filetype=None):
+        """
+        Check if `output` exists and was developed from the current contents
+        of `source` with the same options and LibRaw version.
+
+        Args:
+            source (str): The raw file.
+            output (str): The output file.
+            options (rawkit.options.Options): The development options.
+            filetype (output_file_types): The output filetype.
+
+        Returns:
+            boolean: ``True`` if the output can be skipped.
+        """
+        key = os.path.abspath(output)
+        if key not in self.records or not os.path.exists(output):
+            return False
+        try:
+            record = self.record(source, options, filetype)
+        except OSError:
+            return False
+        return self.records[key] == record
+
+    def export(self, source, output, options=None, filetype=None):
+        """
+        Develop `source` into `output` unless the output is already current.
+
+        Args:
+            source (str): The raw file.
+            output (str): The output file.
+            options (rawkit.options.Options): The development options.
+            filetype (output_file_types): The type of file to output. By
+                                          default, guess based on the output
+                                          name.
+
+        Returns:
+            boolean: ``True`` if the output was written, ``False`` if it was
+                     skipped.
+        """
+        record = self.record(source, options, filetype)
+        key = os.path.abspath(output)
+        if self.records.get(key) == record and os.path.exists(output):
+            return False
+
+        with Raw(filename=source) as raw:
+            if options is not None:
+                raw.options = options
+            with atomic_output(output) as tmp:
+                raw.save(filename=tmp, filetype=filetype)
+
+        self.records[key] = record
+        self._dirty += 1
+        if self._dirty >= self.flush_every:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Atomically write the manifest to disk."""
+        with atomic_output(self.manifest) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.records, f, sort_keys=True)
+        self._dirty = 0
+
+    def close(self):
+        """Write the manifest if anything has changed."""
+        if self._dirty:
+            self.flush()
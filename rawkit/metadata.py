@@ -4,8 +4,14 @@
 
 from collections import namedtuple
 
+from rawkit.orientation import get_orientation
 
-Metadata = namedtuple('Metadata', [
+
+# LibRaw's value for temperatures which were not recorded.
+_NO_TEMPERATURE = -1000.0
+
+
+class Metadata(namedtuple('Metadata', [
     'aperture',
     'timestamp',
     'shutter',
@@ -17,26 +23,170 @@ Metadata = namedtuple('Metadata', [
     'model',
     'orientation',
     'width',
+    'gps',
+    'lens',
+    'description',
+    'artist',
+    'shot_order',
+    'temperatures',
+])):
+
+    """
+    Common metadata for a photo.
+
+    Orientation matches the values from the EXIF 2.3 specification:
+
+    1 - The 0th row is at the visual top of the image, and the 0th
+        column is the visual left-hand side.
+    2 - The 0th row is at the visual top of the image, and the 0th
+        column is the visual right-hand side.
+    3 - The 0th row is at the visual bottom of the image, and the
+        0th column is the visual right-hand side.
+    4 - The 0th row is at the visual bottom of the image, and the
+        0th column is the visual left-hand side.
+    5 - The 0th row is the visual left-hand side of the image, and
+        the 0th column is the visual top.
+    6 - The 0th row is the visual right-hand side of the image,
+        and the 0th column is the visual top.
+    7 - The 0th row is the visual right-hand side of the image,
+        and the 0th column is the visual bottom.
+    8 - The 0th row is the visual left-hand side of the image, and
+        the 0th column is the visual bottom.
+
+    The `gps` (:class:`GPS`), `lens` (:class:`Lens`) and `temperatures`
+    (:class:`Temperatures`) fields are ``None`` when the file doesn't record
+    them or the linked version of LibRaw doesn't parse them. `description`
+    and `artist` are the raw EXIF bytes, and `shot_order` is the camera's
+    frame counter.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, aperture, timestamp, shutter, flash, focal_length,
+                height, iso, make, model, orientation, width, gps=None,
+                lens=None, description=None, artist=None, shot_order=None,
+                temperatures=None):
+        return super(Metadata, cls).__new__(
+            cls, aperture, timestamp, shutter, flash, focal_length, height,
+            iso, make, model, orientation, width, gps, lens, description,
+            artist, shot_order, temperatures)
+
+
+GPS = namedtuple('GPS', ['latitude', 'longitude', 'altitude', 'time'])
+"""
+Where a photo was taken. Latitude and longitude are in decimal degrees
+(negative south of the equator and west of Greenwich), altitude is in meters
+(negative below sea level) and time is the UTC ``(hour, minute, second)``
+recorded by the GPS.
+"""
+
+Lens = namedtuple('Lens', [
+    'make',
+    'model',
+    'serial',
+    'min_focal',
+    'max_focal',
+    'max_aperture_min_focal',
+    'max_aperture_max_focal',
+    'focal_length_35mm',
 ])
 """
-Common metadata for a photo.
-
-Orientation matches the values from the EXIF 2.3 specification:
-
-1 - The 0th row is at the visual top of the image, and the 0th
-    column is the visual left-hand side.
-2 - The 0th row is at the visual top of the image, and the 0th
-    column is the visual right-hand side.
-3 - The 0th row is at the visual bottom of the image, and the
-    0th column is the visual right-hand side.
-4 - The 0th row is at the visual bottom of the image, and the
-    0th column is the visual left-hand side.
-5 - The 0th row is the visual left-hand side of the image, and
-    the 0th column is the visual top.
-6 - The 0th row is the visual right-hand side of the image,
-    and the 0th column is the visual top.
-7 - The 0th row is the visual right-hand side of the image,
-    and the 0th column is the visual bottom.
-8 - The 0th row is the visual left-hand side of the image, and
-    the 0th column is the visual bottom.
+The lens a photo was taken with. Focal lengths are in millimeters and
+apertures are f-numbers; unknown values are 0.
 """
+
+Temperatures = namedtuple('Temperatures', [
+    'camera',
+    'sensor',
+    'lens',
+    'ambient',
+    'battery',
+])
+"""
+Temperatures recorded by the camera, in degrees Celsius, or ``None`` if they
+were not recorded.
+"""
+
+
+def _degrees(dms, ref, negative):
+    degrees = dms[0] + dms[1] / 60.0 + dms[2] / 3600.0
+    return -degrees if ref == negative else degrees
+
+
+def _gps(other):
+    gps = getattr(other, 'parsed_gps', None)
+    if gps is None or gps.gpsparsed == b'\x00':
+        return None
+    return GPS(
+        latitude=_degrees(gps.latitude, gps.latref, b'S'),
+        longitude=_degrees(gps.longitude, gps.longref, b'W'),
+        altitude=-gps.altitude if gps.altref == b'\x01' else gps.altitude,
+        time=tuple(gps.gpstimestamp),
+    )
+
+
+def _lens(contents):
+    lens = getattr(contents, 'lens', None)
+    if lens is None:
+        return None
+    return Lens(
+        make=lens.LensMake,
+        model=lens.Lens,
+        serial=getattr(lens, 'LensSerial', b''),
+        min_focal=lens.MinFocal,
+        max_focal=lens.MaxFocal,
+        max_aperture_min_focal=lens.MaxAp4MinFocal,
+        max_aperture_max_focal=lens.MaxAp4MaxFocal,
+        focal_length_35mm=lens.FocalLengthIn35mmFormat,
+    )
+
+
+def _temperatures(other):
+    if not hasattr(other, 'CameraTemperature'):
+        return None
+    values = [
+        None if value <= _NO_TEMPERATURE else value
+        for value in (other.CameraTemperature, other.SensorTemperature,
+                      other.LensTemperature, other.AmbientTemperature,
+                      other.BatteryTemperature)
+    ]
+    if all(value is None for value in values):
+        return None
+    return Temperatures(*values)
+
+
+def snapshot(data):
+    """
+    Read the metadata that LibRaw parsed when a file was opened. Each
+    structure is only dereferenced once, since every ctypes attribute access
+    creates a new wrapper object.
+
+    Args:
+        data (POINTER(libraw_data_t)): A LibRaw handle with a file open.
+
+    Returns:
+        rawkit.metadata.Metadata: A metadata object.
+    """
+    contents = data.contents
+    other = contents.other
+    sizes = contents.sizes
+    idata = contents.idata
+    return Metadata(
+        aperture=other.aperture,
+        timestamp=other.timestamp,
+        shutter=other.shutter,
+        flash=bool(contents.color.flash_used),
+        focal_length=other.focal_len,
+        height=sizes.height,
+        iso=other.iso_speed,
+        make=idata.make,
+        model=idata.model,
+        orientation=get_orientation(data),
+        width=sizes.width,
+        gps=_gps(other),
+        lens=_lens(contents),
+        description=other.desc,
+        artist=other.artist,
+        shot_order=other.shot_order,
+        temperatures=_temperatures(other),
+    )
@@ -194,6 +194,25 @@ class WhiteBalance(namedtuple('WhiteBalance',
             cls, auto, camera, greybox, rgbg)
 
 
+def _frozen(value):
+    """Replace lists in an option value with tuples, so it can be hashed."""
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return type(value)(*(_frozen(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    return value
+
+
+# LibRaw keeps its params between developments, and options are only written
+# when they're set, so these (which default to None) are put back to LibRaw's
+# own defaults when unset, in case another development set them (eg. with
+# rawkit.raw.Raw.linear_options).
+_LIBRAW_DEFAULTS = {
+    'brightness': 1.0,
+    'gamma': (0.45, 4.5),
+}
+
+
 class Options(object):
 
     """
@@ -290,6 +309,28 @@ class Options(object):
         """
         return getattr(self, k)
 
+    def freeze(self):
+        """
+        A canonical, immutable snapshot of the options which have been set.
+        Dark frames are represented by their file name (which, for a
+        :class:`rawkit.raw.DarkFrame`, is derived from the file it was opened
+        from), so the snapshot only contains plain values and can be hashed,
+        compared, pickled or serialized (sequences, such as gamma curves,
+        become tuples). An equivalent options object can be recreated with ::
+
+            Options(dict(frozen))
+
+        Returns:
+            tuple: Sorted ``(key, value)`` pairs.
+        """
+        frozen = []
+        for key in sorted(self.keys()):
+            value = self[key]
+            if key == 'dark_frame':
+                value = getattr(value, 'name', value)
+            frozen.append((key, _frozen(value)))
+        return tuple(frozen)
+
     @option(param='output_color', ctype=ctypes.c_int)
     def colorspace(self):
         """
@@ -789,6 +830,12 @@ class Options(object):
             opt = getattr(Options, prop)
             if type(opt) is option and getattr(self, prop) is not None:
                 opt.write_param(self, params)
+            elif prop in _LIBRAW_DEFAULTS:
+                default = _LIBRAW_DEFAULTS[prop]
+                try:
+                    setattr(params, opt.param, opt.ctype(*default))
+                except TypeError:
+                    setattr(params, opt.param, opt.ctype(default))
 
         # This generally isn't needed, except for testing.
         return params
@@ -0,0 +1,448 @@
+""":mod:`rawkit.pipeline` --- Develop raw files in pipelined stages
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Developing a raw file uses very different resources along the way: reading it
+is I/O, unpacking it is mostly single threaded decoding, processing it (eg.
+demosaicing) is CPU bound, and encoding and writing the result is a mix. A
+flat pool of workers which each do everything (like
+:func:`rawkit.batch.develop_threaded`) tends to have all of them reading at
+once and then all of them processing at once.
+
+A :class:`Pipeline` splits the work into stages instead, each with its own
+threads:
+
+``read``
+    Read the raw file into memory.
+``open``
+    Open it with LibRaw and unpack the raw data.
+``process``
+    Process the raw data (see :func:`rawkit.raw.Raw.process`).
+``encode``
+    Copy the developed image out of LibRaw, free LibRaw's memory, and encode
+    the image in the output format.
+``write``
+    Write the encoded file (atomically).
+
+Each stage takes files from a bounded queue, so a stage which can't keep up
+makes the stages before it wait instead of piling up files in memory, and
+:attr:`Pipeline.stats` shows how busy each stage is and how full its queue is
+while it runs:
+
+.. sourcecode:: python
+
+    from rawkit.pipeline import Pipeline
+
+    pipeline = Pipeline(options, '/out/{stem}.tiff',
+                        workers={'read': 4, 'process': 48})
+    for result in pipeline.run(paths):
+        ...
+    for stage in pipeline.stats:
+        print(stage.name, stage.utilisation, stage.max_queued)
+
+A stage whose utilisation is close to 1 is the bottleneck, and should be
+given more workers (or the others fewer).
+"""
+
+import os
+import queue
+import threading
+import time
+
+from collections import namedtuple
+
+from rawkit.batch import BatchResult
+from rawkit.batch import _make_parent
+from rawkit.batch import _reentrant
+from rawkit.batch import _thread_state
+from rawkit.batch import estimate_memory
+from rawkit.batch import output_name
+from rawkit.options import Options
+from rawkit.raw import Raw
+from rawkit.util import atomic_output
+from rawkit.writers import encode_image
+from rawkit.writers import image_filetype
+
+STAGES = ('read', 'open', 'process', 'encode', 'write')
+"""The names of the stages of a :class:`Pipeline`, in order."""
+
+StageStats = namedtuple('StageStats', [
+    'name',
+    'workers',
+    'processed',
+    'failed',
+    'busy',
+    'blocked',
+    'utilisation',
+    'queued',
+    'max_queued',
+    'capacity',
+])
+"""
+Counters for one stage of a :class:`Pipeline`.
+
+`processed` files went through the stage and `failed` of them raised an
+error in it. `busy` is the number of seconds its workers spent working, and
+`blocked` the number of seconds they spent waiting for room in the next
+stage's queue. `utilisation` is the fraction of its workers' time spent
+working since the pipeline started. `queued` files are waiting in its queue
+(which holds at most `capacity`), and `max_queued` is the most there have
+been.
+"""
+
+# Marks the end of the files in a queue.
+_DONE = object()
+
+# How often blocked workers check whether the pipeline has been stopped.
+_POLL = 0.1
+
+
+def default_workers():
+    """
+    The number of workers each stage gets unless told otherwise: every CPU
+    for ``process``, a quarter of them for ``open``, and a few for the I/O
+    bound stages.
+
+    Returns:
+        dict: The number of workers for each stage.
+    """
+    cpus = os.cpu_count() or 1
+    return {
+        'read': 2,
+        'open': max(1, cpus // 4),
+        'process': cpus,
+        'encode': max(1, cpus // 8),
+        'write': max(2, cpus // 8),
+    }
+
+
+class _Job(object):
+
+    """A file on its way through the pipeline."""
+
+    __slots__ = ('index', 'path', 'output', 'started', 'data', 'raw',
+                 'encoded', 'memory', 'error')
+
+    def __init__(self, index, path, output):
+        self.index = index
+        self.path = path
+        self.output = output
+        self.started = None
+        self.data = self.raw = self.encoded = self.memory = self.error = None
+
+    def discard(self):
+        """Free whatever the job is holding."""
+        if self.raw is not None:
+            self.raw.close()
+        self.data = self.raw = self.encoded = None
+
+    def result(self):
+        return BatchResult(self.index, self.path, self.output, self.error,
+                           time.time() - self.started, self.memory, False)
+
+
+class _Stage(object):
+
+    """The threads, input queue and counters of one stage."""
+
+    def __init__(self, name, func, workers, capacity, output):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.input = queue.Queue(capacity)
+        self.capacity = capacity
+        # The next stage's queue, or the results.
+        self.output = output
+        self.lock = threading.Lock()
+        self.live = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.max_queued = 0
+
+
+class Pipeline(object):
+
+    """
+    Develops raw files in stages, each with its own threads and a bounded
+    queue of files waiting for it (see :mod:`rawkit.pipeline`).
+
+    The stages use LibRaw from several threads at once, so they need its
+    thread safe build (``libraw_r``, see :class:`libraw.bindings.LibRaw`). A
+    raw is only used by one thread at a time, as it is handed from stage to
+    stage.
+
+    Args:
+        options (rawkit.options.Options): The options to develop every file
+                                          with (or ``None`` for the
+                                          defaults).
+        output_template (str): The output file name for each file (see
+                               :func:`rawkit.batch.output_name`).
+        workers (dict): The number of workers for some or all of the
+                        :data:`STAGES` (see :func:`default_workers`).
+        queue_sizes (dict): The number of files which may wait for some or
+                            all of the stages. By default, twice the stage's
+                            number of workers.
+        filetype (output_file_types): The type of file to write. By default,
+                                      it is guessed from each output's file
+                                      name.
+
+    Returns:
+        Pipeline: A pipeline.
+
+    Raises:
+        ValueError: If a stage is unknown or has no workers.
+        ImportError: If the thread safe build of LibRaw is not available.
+    """
+
+    def __init__(self, options, output_template, workers=None,
+                 queue_sizes=None, filetype=None):
+        """Work out the size of each stage."""
+        self.frozen = (options or Options()).freeze()
+        self.output_template = output_template
+        self.filetype = filetype
+        self.workers = default_workers()
+        self.workers.update(workers or {})
+        self.queue_sizes = {name: 2 * count
+                            for name, count in self.workers.items()}
+        self.queue_sizes.update(queue_sizes or {})
+        for name in set(self.workers) | set(self.queue_sizes):
+            if name not in STAGES:
+                raise ValueError('Unknown stage: {}'.format(name))
+            if self.workers[name] < 1 or self.queue_sizes[name] < 1:
+                raise ValueError(
+                    'Stage {} needs at least one worker and queue slot'.format(
+                        name))
+        if not _reentrant():
+            raise ImportError(
+                'A pipeline needs the thread safe build of LibRaw (libraw_r)')
+        self._stages = []
+        self._started = self._finished = None
+
+    @property
+    def stats(self):
+        """
+        The counters for each stage of the current (or last) run, in order.
+
+        Returns:
+            list: A :class:`StageStats` for each stage.
+        """
+        elapsed = 0
+        if self._started is not None:
+            elapsed = (self._finished or time.monotonic()) - self._started
+        stats = []
+        for stage in self._stages:
+            with stage.lock:
+                stats.append(StageStats(
+                    name=stage.name,
+                    workers=stage.workers,
+                    processed=stage.processed,
+                    failed=stage.failed,
+                    busy=stage.busy,
+                    blocked=stage.blocked,
+                    utilisation=min(
+                        1.0, stage.busy / (stage.workers * elapsed)
+                    ) if elapsed else 0.0,
+                    queued=stage.input.qsize(),
+                    max_queued=stage.max_queued,
+                    capacity=stage.capacity,
+                ))
+        return stats
+
+    # The stages.
+
+    def _read(self, job):
+        # Jobs are all built up front, so time each from when it's read.
+        job.started = time.time()
+        with open(job.path, 'rb') as f:
+            job.data = f.read()
+
+    def _open(self, job):
+        libraw, options = _thread_state(self.frozen)
+        data, job.data = job.data, None
+        job.raw = Raw(buffer=data, libraw=libraw)
+        job.raw.options = options
+        job.memory = estimate_memory(job.raw, options)
+        job.raw.unpack()
+
+    def _process(self, job):
+        job.raw.process()
+
+    def _encode(self, job):
+        filetype = image_filetype(job.output, self.filetype)
+        image = job.raw._mem_image()
+        job.raw.close()
+        job.raw = None
+        job.encoded = encode_image(image, filetype)
+
+    def _write(self, job):
+        encoded, job.encoded = job.encoded, None
+        _make_parent(job.output)
+        with atomic_output(job.output) as tmp:
+            with open(tmp, 'wb') as f:
+                f.write(encoded)
+
+    # Moving files between stages.
+
+    def _put(self, stage, target, item):
+        """
+        Put an item in a queue, waiting for room unless the pipeline is
+        stopped. Returns whether it was put.
+        """
+        started = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                try:
+                    target.put(item, timeout=_POLL)
+                except queue.Full:
+                    continue
+                return True
+            return False
+        finally:
+            if stage is not None:
+                with stage.lock:
+                    stage.blocked += time.monotonic() - started
+
+    def _get(self, source):
+        """Take an item from a queue, or None if the pipeline is stopped."""
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=_POLL)
+            except queue.Empty:
+                continue
+        return None
+
+    def _queued(self, stage):
+        """Record how full a stage's queue is."""
+        if stage is not None:
+            queued = stage.input.qsize()
+            with stage.lock:
+                stage.max_queued = max(stage.max_queued, queued)
+
+    def _work(self, stage, following):
+        while True:
+            job = self._get(stage.input)
+            if job is None:
+                return
+            if job is _DONE:
+                with stage.lock:
+                    stage.live -= 1
+                    last = stage.live == 0
+                # Let the other workers see the end too, and tell the next
+                # stage once they've all finished.
+                self._put(None, stage.output if last else stage.input, _DONE)
+                return
+
+            started = time.monotonic()
+            try:
+                stage.func(job)
+            except Exception as e:
+                job.error = e
+            elapsed = time.monotonic() - started
+            with stage.lock:
+                stage.processed += 1
+                stage.busy += elapsed
+                if job.error is not None:
+                    stage.failed += 1
+
+            target = stage.output
+            if job.error is not None:
+                # Failed files skip the rest of the pipeline.
+                job.discard()
+                target = self._results
+            if not self._put(stage, target, job):
+                job.discard()
+                return
+            self._queued(following)
+
+    def _feed(self, jobs):
+        first = self._stages[0]
+        for job in jobs:
+            if not self._put(None, first.input, job):
+                return
+            self._queued(first)
+        self._put(None, first.input, _DONE)
+
+    def run(self, paths, ordered=True, progress=None):
+        """
+        Develop raw files, yielding a :class:`rawkit.batch.BatchResult` as
+        each one is finished.
+
+        A file which fails to develop doesn't stop the others: its result
+        holds the exception. Stopping early (eg. closing the generator) stops
+        every stage and frees the files which were on their way through.
+
+        Args:
+            paths (iterable): The raw files to develop.
+            ordered (bool): Yield results in the order of `paths`. Otherwise
+                            they are yielded as soon as they are ready.
+            progress (callable): Called with the number of files done and
+                                 the total after each file.
+
+        Yields:
+            rawkit.batch.BatchResult: The outcome of each file.
+        """
+        jobs = [
+            _Job(i, path, output_name(self.output_template, path, i))
+            for i, path in enumerate(paths)
+        ]
+        funcs = {
+            'read': self._read,
+            'open': self._open,
+            'process': self._process,
+            'encode': self._encode,
+            'write': self._write,
+        }
+        self._results = queue.Queue(self.queue_sizes['write'])
+        self._stages = []
+        output = self._results
+        for name in reversed(STAGES):
+            stage = _Stage(name, funcs[name], self.workers[name],
+                           self.queue_sizes[name], output)
+            self._stages.insert(0, stage)
+            output = stage.input
+        self._stop = threading.Event()
+        self._started = time.monotonic()
+        self._finished = None
+
+        threads = [threading.Thread(target=self._feed, args=(jobs,))]
+        for i, stage in enumerate(self._stages):
+            following = self._stages[i + 1] if i + 1 < len(STAGES) else None
+            threads.extend(
+                threading.Thread(target=self._work, args=(stage, following))
+                for _ in range(stage.workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        done = 0
+        waiting = {}
+        try:
+            while done < len(jobs):
+                job = self._results.get()
+                waiting[job.index] = job
+                while waiting:
+                    if ordered:
+                        job = waiting.pop(done, None)
+                        if job is None:
+                            break
+                    else:
+                        job = waiting.popitem()[1]
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(jobs))
+                    yield job.result()
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self._finished = time.monotonic()
+            # Free whatever was still on its way through.
+            for target in [s.input for s in self._stages] + [self._results]:
+                while True:
+                    try:
+                        job = target.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(job, _Job):
+                        job.discard()
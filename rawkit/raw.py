@@ -3,34 +3,131 @@
 """
 
 import ctypes
+import gc
+import hashlib
+import mmap
 import os
-import random
-import string
+import secrets
+import stat
 import tempfile
 import warnings
+import weakref
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from libraw.bindings import LibRaw
 from libraw.errors import raise_if_error
 
 from rawkit.errors import InvalidFileType
+from rawkit.errors import MetadataOnly
 from rawkit.errors import NoFileSpecified
-from rawkit.metadata import Metadata
+from rawkit.exif import ExifCollector
+from rawkit.exif import can_read_values
+from rawkit.metadata import snapshot
+from rawkit.options import gamma_curves
+from rawkit.options import highlight_modes
 from rawkit.options import Options
-from rawkit.orientation import get_orientation
+from rawkit.thumbnail import Thumbnail
+from rawkit.tiff import write_tiff
+from rawkit.util import atomic_output
+from rawkit.writers import float_chunks
+from rawkit.writers import image_filetype
+from rawkit.writers import pillow_file_types
+from rawkit.writers import resize
+from rawkit.writers import to_8_bit
+from rawkit.writers import write_image
+from rawkit.writers import write_npy
+from rawkit.writers import write_pfm
 
 
 output_file_types = namedtuple(
-    'OutputFileType', ['ppm', 'tiff']
-)('ppm', 'tiff')
+    'OutputFileType', ['ppm', 'tiff', 'npy', 'pfm']
+)('ppm', 'tiff', 'npy', 'pfm')
 
 """
 Constants for setting the output filetype.
 
   - ``ppm`` --- PGM data file.
   - ``tiff`` --- TIFF file.
+  - ``npy`` --- Scene-linear 32-bit floating point NumPy array.
+  - ``pfm`` --- Scene-linear 32-bit floating point Portable Float Map.
 """
 
+ProcessedImage = namedtuple(
+    'ProcessedImage', ['width', 'height', 'colors', 'bits', 'data']
+)
+"""
+A developed image and the dimensions needed to interpret it.
+
+The `data` field is a :class:`bytearray` of interleaved samples (eg. RGBRGB...)
+with `bits` bits per sample, in native byte order.
+"""
+
+
+class ExportTarget(namedtuple('ExportTarget',
+                              ['filename', 'filetype', 'size', 'bps',
+                               'kwargs'])):
+
+    """
+    Describes one output of :func:`Raw.export`.
+
+    Args:
+        filename (str): The file to write.
+        filetype (str): Any of the :class:`output_file_types` or
+                        :data:`rawkit.writers.pillow_file_types`, or
+                        ``'thumbnail'`` to save the embedded thumbnail as is.
+                        By default, guess based on the filename.
+        size (int): Scale the image down so its longest edge is at most this
+                    many pixels (requires Pillow). By default the image is
+                    written at full size.
+        bps (int): Bits per sample (8 or 16). Ignored for floating point and
+                   Pillow file types.
+        kwargs (dict): Extra arguments for the writer, eg. ``{'quality': 90}``
+                       for JPEGs or ``{'compression': ...}`` for TIFFs.
+
+    Returns:
+        ExportTarget: An export target.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, filename, filetype=None, size=None, bps=8, kwargs=None):
+        return super(ExportTarget, cls).__new__(
+            cls, filename, filetype, size, bps, kwargs or {})
+
+
+def _buffer_pointer(buffer):
+    """
+    Get a ctypes object pointing at the contents of a bytes-like object, its
+    address and its size, copying the contents only if they can't be pointed
+    at directly.
+    """
+    if not isinstance(buffer, bytes):
+        view = memoryview(buffer)
+        if not view.readonly and view.contiguous:
+            pointer = (ctypes.c_char * view.nbytes).from_buffer(view)
+            return pointer, ctypes.addressof(pointer), view.nbytes
+        if (isinstance(view.obj, bytes) and view.contiguous and
+                view.nbytes == len(view.obj)):
+            buffer = view.obj
+        else:
+            buffer = view.tobytes()
+        view.release()
+
+    # ctypes points straight at the contents of a bytes object.
+    pointer = ctypes.c_char_p(buffer)
+    return pointer, ctypes.cast(pointer, ctypes.c_void_p).value, len(buffer)
+
+
+def _write_target(image, target, filetype):
+    """Scale, convert and write a developed image for an export target."""
+    image = resize(image, target.size)
+    if target.bps == 8 and filetype not in (output_file_types.npy,
+                                            output_file_types.pfm):
+        image = to_8_bit(image)
+    write_image(target.filename, image, filetype, **target.kwargs)
+    return target.filename
+
 
 class Raw(object):
 
@@ -50,12 +147,31 @@ class Raw(object):
 
     Args:
         filename (str): The name of a raw file to load.
+        metadata_only (bool): Only parse the file's metadata, and close the
+                              file as soon as it has been parsed (see
+                              :func:`open_metadata`).
+        collect_exif (bool): Record every EXIF entry LibRaw parses while
+                             opening the file (see :attr:`exif`). Pass an
+                             iterable of tag numbers instead of ``True`` to
+                             only read the values of those tags. Values can
+                             only be read with some builds of LibRaw (see
+                             :func:`rawkit.exif.can_read_values`); a warning
+                             is emitted if they can't be.
+        buffer (bytes): A bytes-like object containing a raw file, to load
+                        instead of `filename`. It is referenced, not copied,
+                        until the Raw is closed (see :func:`from_bytes`).
+        libraw (libraw.bindings.LibRaw): Loaded LibRaw bindings to use.
+                                         Loading the library is relatively
+                                         expensive, so code which opens many
+                                         files can load it once and share
+                                         it.
 
     Returns:
         Raw: A raw object.
 
     Raises:
-        rawkit.errors.NoFileSpecified: If `filename` is ``None``.
+        rawkit.errors.NoFileSpecified: If neither `filename` nor `buffer` is
+                                       given.
         libraw.errors.FileUnsupported: If the specified file is not a supported
                                        raw type.
         libraw.errors.InsufficientMemory: If we run out of memory while loading
@@ -64,22 +180,188 @@ class Raw(object):
                  permissions).
     """
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, metadata_only=False,
+                 collect_exif=False, buffer=None, libraw=None):
         """Initializes a new Raw object."""
-        if filename is None:
+        if filename is None and buffer is None:
             raise NoFileSpecified()
-        self.libraw = LibRaw()
+        self.libraw = libraw if libraw is not None else LibRaw()
         self.data = self.libraw.libraw_init(0)
-        try:  # pragma: no cover
-            _fname = os.fsencode(filename)
-        except Exception:  # pragma: no cover
-            _fname = filename
-        self.libraw.libraw_open_file(self.data, _fname)
+
+        try:
+            # The collector owns the C callback, so it must live as long as
+            # we do.
+            self._exif = None
+            if collect_exif:
+                read_values = can_read_values(self.libraw.version_number)
+                if not read_values:
+                    warnings.warn(
+                        'EXIF values cannot be read with this build of '
+                        'LibRaw; entries will be collected without their '
+                        'values.')
+                self._exif = ExifCollector(
+                    None if collect_exif is True else collect_exif,
+                    read_values)
+                self.libraw.libraw_set_exifparser_handler(
+                    self.data, self._exif.callback, None)
+
+            self._buffer = None
+            self._mmap = None
+            if buffer is not None:
+                self._open_buffer(buffer)
+            else:
+                try:  # pragma: no cover
+                    _fname = os.fsencode(filename)
+                except Exception:  # pragma: no cover
+                    _fname = filename
+                self.libraw.libraw_open_file(self.data, _fname)
+        except BaseException:
+            # Nothing else will free the handle if we don't return.
+            self.libraw.libraw_close(self.data)
+            raise
+
+        self.metadata_only = metadata_only
+        if metadata_only:
+            # Everything we need has been parsed; close the file now rather
+            # than holding its descriptor until the Raw is closed.
+            self.libraw.libraw_recycle_datastream(self.data)
+            self._release_buffer()
 
         self.options = Options()
 
         self.image_unpacked = False
         self.thumb_unpacked = False
+        self._thumbnail_views = []
+        self._metadata = None
+
+    @classmethod
+    def open_metadata(cls, filename):
+        """
+        Open a raw file for its metadata only. The file is parsed and closed
+        immediately, and the pixel data is never read, which makes this much
+        cheaper than a regular :class:`Raw` when building catalogues.
+
+        Methods that need the raw image or the thumbnail raise
+        :class:`rawkit.errors.MetadataOnly`.
+
+        Args:
+            filename (str): The name of a raw file to load.
+
+        Returns:
+            Raw: A metadata only raw object.
+        """
+        return cls(filename=filename, metadata_only=True)
+
+    @classmethod
+    def from_mmap(cls, filename, **kwargs):
+        """
+        Open a raw file by memory mapping it, instead of having LibRaw read
+        it through its own buffered stream. Processes working on the same
+        files share the operating system's page cache, and only the pages
+        LibRaw actually reads are loaded (so metadata only opens of large
+        files are cheap).
+
+        The mapping is closed when the Raw is closed.
+
+        Args:
+            filename (str): The name of a raw file to load.
+            kwargs: Any other arguments to :class:`Raw`.
+
+        Returns:
+            Raw: A raw object.
+        """
+        with open(filename, 'rb') as f:
+            return cls._from_fd(f.fileno(), 0, kwargs)
+
+    @classmethod
+    def _from_fd(cls, fd, offset, kwargs):
+        if os.fstat(fd).st_size <= offset:
+            # Empty files can't be mapped; let LibRaw reject them.
+            return cls(buffer=b'', **kwargs)
+        # A private (copy on write) mapping is writable, so ctypes can point
+        # at it, but LibRaw only reads it, so its pages are never copied. The
+        # mapping stays valid after the file is closed.
+        mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+        buffer = memoryview(mapping)[offset:]
+        try:
+            raw = cls(buffer=buffer, **kwargs)
+        except Exception:
+            buffer.release()
+            mapping.close()
+            raise
+        buffer.release()
+        if raw._buffer is None:
+            # Already released by a metadata only open.
+            mapping.close()
+        else:
+            raw._mmap = mapping
+        return raw
+
+    @classmethod
+    def from_bytes(cls, data, **kwargs):
+        """
+        Open a raw file which is already in memory, eg. the body of an HTTP
+        upload, without writing it to a temporary file.
+
+        :class:`bytes`, :class:`bytearray`, and writable or whole-object
+        :class:`memoryview` objects are used in place, without being copied;
+        read-only views of part of an object are copied. The buffer is
+        referenced until the Raw is closed, and must not be modified until
+        then.
+
+        Args:
+            data (bytes): A bytes-like object containing a raw file.
+            kwargs: Any other arguments to :class:`Raw`.
+
+        Returns:
+            Raw: A raw object.
+
+        Raises:
+            rawkit.errors.NoFileSpecified: If `data` is ``None``.
+            libraw.errors.FileUnsupported: If the data is not a supported raw
+                                           type.
+        """
+        return cls(buffer=data, **kwargs)
+
+    @classmethod
+    def from_fileobj(cls, fileobj, **kwargs):
+        """
+        Open a raw file from a file-like object, starting at its current
+        position.
+
+        Regular files are memory mapped (see :func:`from_mmap`), and the
+        contents of :class:`io.BytesIO` objects are used in place (they can't
+        be resized until the Raw is closed). Anything else is read into
+        memory.
+
+        Args:
+            fileobj (file): A readable file-like object.
+            kwargs: Any other arguments to :class:`Raw`.
+
+        Returns:
+            Raw: A raw object.
+
+        Raises:
+            rawkit.errors.NoFileSpecified: If `fileobj` is ``None``.
+            libraw.errors.FileUnsupported: If the data is not a supported raw
+                                           type.
+        """
+        if fileobj is None:
+            raise NoFileSpecified()
+
+        getbuffer = getattr(fileobj, 'getbuffer', None)
+        if getbuffer is not None:
+            return cls(buffer=getbuffer()[fileobj.tell():], **kwargs)
+
+        try:
+            fd = fileobj.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return cls._from_fd(fd, fileobj.tell(), kwargs)
+        except (AttributeError, OSError, ValueError):
+            # No usable file descriptor (eg. sockets and pipes can't be
+            # mapped).
+            pass
+        return cls(buffer=fileobj.read(), **kwargs)
 
     def __enter__(self):
         """Return a Raw object for use in context managers."""
@@ -90,11 +372,69 @@ class Raw(object):
         self.close()
 
     def close(self):
-        """Free the underlying raw representation."""
+        """
+        Free the underlying raw representation.
+
+        Raises:
+            BufferError: If something made from a thumbnail's data without
+                         copying it (eg. a slice of it, or
+                         :func:`rawkit.thumbnail.Thumbnail.as_array`) is
+                         still alive. Nothing is freed, so the raw can be
+                         closed again once it is gone.
+        """
+        self._release_thumbnails()
         self.libraw.libraw_close(self.data)
+        self._release_buffer()
+
+    def _open_buffer(self, buffer):
+        # LibRaw reads straight from the buffer for as long as the file is
+        # open, so the ctypes object pointing at it is kept until then (and
+        # isn't held in a local, which would keep it alive in tracebacks).
+        self._buffer, address, size = _buffer_pointer(buffer)
+        try:
+            self.libraw.libraw_open_buffer(self.data, address, size)
+        except Exception:
+            self._buffer = None
+            raise
+
+    def _release_buffer(self):
+        # The ctypes view must go before a mapping can be closed.
+        self._buffer = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _release_thumbnails(self):
+        # Views handed out by thumbnail() point into memory that LibRaw is
+        # about to free; release them so using them raises instead of
+        # reading freed memory.
+        for view, _ in self._thumbnail_views:
+            view.release()
+        # Slices and arrays made from a view survive its release, but they
+        # keep the ctypes array it was made from alive, so LibRaw's memory
+        # mustn't be freed while it is.
+        if any(ref() is not None for _, ref in self._thumbnail_views):
+            gc.collect()
+            if any(ref() is not None for _, ref in self._thumbnail_views):
+                raise BufferError(
+                    'A view of a thumbnail is still in use; delete it (or '
+                    'copy it) before closing the raw')
+        self._thumbnail_views = []
+
+    def _check_pixels(self):
+        if self.metadata_only:
+            raise MetadataOnly(
+                "Pixel data is unavailable for files opened for metadata only")
 
     def unpack(self):
-        """Unpack the raw data."""
+        """
+        Unpack the raw data.
+
+        Raises:
+            rawkit.errors.MetadataOnly: If the file was opened for metadata
+                                        only.
+        """
+        self._check_pixels()
         if not self.image_unpacked:
             self.libraw.libraw_unpack(self.data)
             self.image_unpacked = True
@@ -108,15 +448,22 @@ class Raw(object):
             thumbnail.
             libraw.errors.UnsupportedThumbnail: If the thumbnail format is
             unsupported.
+            rawkit.errors.MetadataOnly: If the file was opened for metadata
+            only.
         """
+        self._check_pixels()
         if not self.thumb_unpacked:
             self.libraw.libraw_unpack_thumb(self.data)
             self.thumb_unpacked = True
 
-    def process(self):
+    def process(self, options=None):
         """
         Process the raw data based on ``self.options``.
 
+        Args:
+            options (rawkit.options.Options): Options to use instead of
+                                              ``self.options``.
+
         Raises:
             libraw.errors.DataError: If invalid or corrupt data is encountered
                                      in the data struct.
@@ -126,13 +473,19 @@ class Raw(object):
                                    sense).
             libraw.errors.InsufficientMemory: If we run out of memory while
                                               processing the raw file.
+            rawkit.errors.MetadataOnly: If the file was opened for metadata
+                                        only.
         """
-        self.options._map_to_libraw_params(self.data.contents.params)
+        self._check_pixels()
+        if options is None:
+            options = self.options
+        options._map_to_libraw_params(self.data.contents.params)
         self.libraw.libraw_dcraw_process(self.data)
 
     def save(self, filename, filetype=None):
         """
-        Save the image data as a new PPM or TIFF image.
+        Save the image data as a new PPM or TIFF image, or as scene-linear
+        floating point NPY or PFM data (see :func:`to_array`).
 
         Args:
             filename (str): The name of an image file to save.
@@ -156,6 +509,14 @@ class Raw(object):
             raise InvalidFileType(
                 "Output filetype must be in raw.output_file_types")
 
+        if filetype in (output_file_types.npy, output_file_types.pfm):
+            image = self.to_image(options=self.linear_options())
+            if filetype == output_file_types.npy:
+                write_npy(filename, image)
+            else:
+                write_pfm(filename, image)
+            return
+
         self.data.contents.params.output_tiff = (
             filetype == output_file_types.tiff
         )
@@ -384,16 +745,23 @@ class Raw(object):
         """
         return self.raw_image(include_margin), self.color_filter_array
 
-    def to_buffer(self):
+    def to_image(self, options=None):
         """
-        Convert the image to an RGB buffer.
+        Develop the image and return its data along with its dimensions.
+
+        Args:
+            options (rawkit.options.Options): Options to develop with instead
+                                              of ``self.options``.
 
         Returns:
-            bytearray: RGB data of the image.
+            rawkit.raw.ProcessedImage: The developed image.
         """
         self.unpack()
-        self.process()
+        self.process(options=options)
+        return self._mem_image()
 
+    def _mem_image(self):
+        """Copy the image which has already been processed out of LibRaw."""
         status = ctypes.c_int(0)
         processed_image = self.libraw.libraw_dcraw_make_mem_image(
             self.data,
@@ -403,14 +771,282 @@ class Raw(object):
             ),
         )
         raise_if_error(status.value)
+        contents = processed_image.contents
         data_pointer = ctypes.cast(
-            processed_image.contents.data,
-            ctypes.POINTER(ctypes.c_byte * processed_image.contents.data_size)
+            contents.data,
+            ctypes.POINTER(ctypes.c_byte * contents.data_size)
+        )
+        image = ProcessedImage(
+            width=contents.width,
+            height=contents.height,
+            colors=contents.colors,
+            bits=contents.bits,
+            data=bytearray(data_pointer.contents),
         )
-        data = bytearray(data_pointer.contents)
         self.libraw.libraw_dcraw_clear_mem(processed_image)
 
-        return data
+        return image
+
+    def develop_into(self, allocate, options=None):
+        """
+        Develop the image straight into a buffer supplied by the caller (eg.
+        a shared memory segment), instead of into a new :class:`bytearray`.
+
+        LibRaw copies the developed image directly into the buffer. With
+        versions of LibRaw which can't do that, the image is developed with
+        :func:`to_image` and then copied.
+
+        Args:
+            allocate (callable): Called with the developed image's ``(width,
+                                 height, colors, bits)``. Must return a
+                                 writable buffer of at least ``width * height
+                                 * colors * bits // 8`` bytes.
+            options (rawkit.options.Options): Options to develop with instead
+                                              of ``self.options``.
+
+        Returns:
+            rawkit.raw.ProcessedImage: The developed image, whose data is the
+                                       buffer returned by `allocate`.
+        """
+        try:
+            copy = self.libraw.libraw_copy_mem_image
+        except AttributeError:
+            image = self.to_image(options=options)
+            buffer = allocate(
+                image.width, image.height, image.colors, image.bits)
+            memoryview(buffer).cast('B')[:len(image.data)] = image.data
+            return image._replace(data=buffer)
+
+        self.unpack()
+        self.process(options=options)
+
+        width, height, colors, bits = (
+            ctypes.pointer(ctypes.c_int(0)) for _ in range(4))
+        self.libraw.libraw_get_mem_image_format(
+            self.data, width, height, colors, bits)
+        width, height, colors, bits = (
+            value.contents.value for value in (width, height, colors, bits))
+
+        buffer = allocate(width, height, colors, bits)
+        stride = width * colors * bits // 8
+        target = (ctypes.c_char * (stride * height)).from_buffer(buffer)
+        try:
+            copy(self.data, ctypes.addressof(target), stride, 0)
+        finally:
+            # The buffer can't be released (eg. a segment closed) while a
+            # ctypes object points into it.
+            del target
+        return ProcessedImage(
+            width=width, height=height, colors=colors, bits=bits, data=buffer)
+
+    def to_buffer(self):
+        """
+        Convert the image to an RGB buffer.
+
+        Returns:
+            bytearray: RGB data of the image.
+        """
+        return self.to_image().data
+
+    def linear_options(self):
+        """
+        A copy of ``self.options`` adjusted to produce scene-linear output:
+        16 bits per sample, a linear gamma curve, no automatic brightening and
+        unclipped highlights.
+
+        Returns:
+            rawkit.options.Options: The linear options.
+        """
+        options = Options(dict(self.options))
+        options.bps = 16
+        options.gamma = gamma_curves.linear
+        options.auto_brightness = False
+        options.brightness = 1.0
+        options.highlight_mode = highlight_modes.ignore
+        return options
+
+    def to_array(self, dtype='float32', linear=True, memmap=None):
+        """
+        Develop the image into a floating point NumPy array of shape
+        ``(height, width, colors)``.
+
+        When `linear` is set, the image is developed with
+        :func:`linear_options`. LibRaw subtracts the black level
+        (``color.black``) and scales the white level (``color.maximum``) to
+        the top of the 16-bit range while developing, so after normalization
+        ``0.0`` is black and ``1.0`` is the sensor's white point, with no gamma
+        curve applied.
+
+        Args:
+            dtype (str): A NumPy floating point dtype.
+            linear (boolean): Develop scene-linear data instead of using
+                              ``self.options`` as is.
+            memmap (str): If set, write the array to this ``.npy`` file and
+                          return a memory mapped array backed by it instead
+                          of allocating the array in memory.
+
+        Returns:
+            array: The developed image.
+        """
+        import numpy
+
+        image = self.to_image(
+            options=self.linear_options() if linear else None)
+        shape = (image.height, image.width, image.colors)
+
+        if memmap is None:
+            array = numpy.empty(shape, dtype=dtype)
+        else:
+            array = numpy.lib.format.open_memmap(
+                memmap, mode='w+', dtype=dtype, shape=shape)
+
+        for start, chunk in float_chunks(image, dtype):
+            array[start:start + len(chunk)] = chunk
+
+        if memmap is not None:
+            array.flush()
+        return array
+
+    def export(self, targets, workers=None):
+        """
+        Write several outputs (different formats, sizes and bit depths) while
+        unpacking and developing the raw as few times as possible.
+
+        Targets are split into at most two developments: one with
+        :func:`linear_options` for floating point outputs, and one with
+        ``self.options`` at the highest bit depth any target needs (8-bit
+        targets are derived from 16-bit data exactly as LibRaw would produce
+        them). If every target in a development is at most half the size of
+        the image and ``half_size`` hasn't been set explicitly, the
+        development is done at half size. Scaling and encoding run in
+        parallel on a thread pool, overlapping with the next development.
+
+        For example::
+
+            raw.export([
+                ExportTarget('master.tiff', bps=16),
+                ExportTarget('full.jpg', kwargs={'quality': 90}),
+                ExportTarget('web.jpg', size=1024),
+                ExportTarget('thumb.jpg', filetype='thumbnail'),
+            ])
+
+        Args:
+            targets (list): :class:`ExportTarget` objects.
+            workers (int): The number of encoding threads.
+
+        Returns:
+            list: The file names that were written, in the order given.
+
+        Raises:
+            rawkit.errors.InvalidFileType: If a target's file type is not
+                                           supported.
+        """
+        thumbnails = []
+        developments = {}
+        for target in targets:
+            if target.filetype == 'thumbnail':
+                thumbnails.append(target)
+                continue
+            filetype = image_filetype(target.filename, target.filetype)
+            linear = filetype in (output_file_types.npy,
+                                  output_file_types.pfm)
+            developments.setdefault(linear, []).append((target, filetype))
+
+        for target in thumbnails:
+            self.save_thumb(filename=target.filename)
+
+        sizes = self.data.contents.sizes
+        longest = max(sizes.width, sizes.height)
+
+        futures = []
+        with ThreadPoolExecutor(workers) as pool:
+            for linear, group in sorted(developments.items()):
+                if linear:
+                    options = self.linear_options()
+                else:
+                    options = Options(dict(self.options))
+                    options.bps = max(
+                        8 if filetype in pillow_file_types else target.bps
+                        for target, filetype in group
+                    )
+                if 'half_size' not in self.options.keys() and all(
+                    target.size and target.size <= longest // 2
+                    for target, _ in group
+                ):
+                    options.half_size = True
+
+                image = self.to_image(options=options)
+                futures += [
+                    pool.submit(_write_target, image, target, filetype)
+                    for target, filetype in group
+                ]
+
+        for future in futures:
+            future.result()
+        return [target.filename for target in targets]
+
+    def save_tiff(self, filename, **kwargs):
+        """
+        Save the image data as a TIFF using rawkit's own TIFF writer, which
+        (unlike :func:`save`) supports compression, predictors, tiles and
+        BigTIFF.
+
+        Args:
+            filename (str): The name of an image file to save.
+            kwargs: Any arguments accepted by :func:`rawkit.tiff.write_tiff`
+                    (eg. `compression`, `predictor` or `workers`).
+
+        Returns:
+            rawkit.tiff.TiffStats: Statistics about the write.
+
+        Raises:
+            rawkit.errors.NoFileSpecified: If `filename` is ``None``.
+        """
+        if filename is None:
+            raise NoFileSpecified()
+
+        image = self.to_image()
+        return write_tiff(
+            filename,
+            image.data,
+            image.width,
+            image.height,
+            colors=image.colors,
+            bits=image.bits,
+            **kwargs
+        )
+
+    def thumbnail(self):
+        """
+        Get the embedded thumbnail without decoding or copying it.
+
+        Returns:
+            rawkit.thumbnail.Thumbnail: The thumbnail. Its data is only valid
+                                        until this raw is closed.
+
+        Raises:
+            libraw.errors.NoThumbnail: If the raw file does not contain a
+            thumbnail.
+            libraw.errors.UnsupportedThumbnail: If the thumbnail format is
+            unsupported.
+        """
+        self.unpack_thumb()
+
+        thumb = self.data.contents.thumbnail
+        buf = ctypes.cast(
+            thumb.thumb,
+            ctypes.POINTER(ctypes.c_char * thumb.tlength)
+        ).contents
+        view = memoryview(buf).cast('B')
+        self._thumbnail_views.append((view, weakref.ref(buf)))
+
+        return Thumbnail(
+            format=thumb.tformat,
+            width=thumb.twidth,
+            height=thumb.theight,
+            colors=thumb.tcolors,
+            data=view,
+        )
 
     def thumbnail_to_buffer(self):
         """
@@ -442,24 +1078,46 @@ class Raw(object):
     @property
     def metadata(self):
         """
-        Common metadata for the photo
+        Common metadata for the photo. It is read from LibRaw once and then
+        cached, since it cannot change after the file has been opened.
 
         Returns:
             rawkit.metadata.Metadata: A metadata object.
         """
-        return Metadata(
-            aperture=self.data.contents.other.aperture,
-            timestamp=self.data.contents.other.timestamp,
-            shutter=self.data.contents.other.shutter,
-            flash=bool(self.data.contents.color.flash_used),
-            focal_length=self.data.contents.other.focal_len,
-            height=self.data.contents.sizes.height,
-            iso=self.data.contents.other.iso_speed,
-            make=self.data.contents.idata.make,
-            model=self.data.contents.idata.model,
-            orientation=get_orientation(self.data),
-            width=self.data.contents.sizes.width,
-        )
+        if self._metadata is None:
+            self._metadata = snapshot(self.data)
+        return self._metadata
+
+    @property
+    def exif(self):
+        """
+        The EXIF entries LibRaw parsed while opening the file, in the order
+        they were parsed. Only available if the file was opened with
+        ``collect_exif``.
+
+        Returns:
+            list: :class:`rawkit.exif.ExifEntry` objects, or ``None``.
+        """
+        if self._exif is None:
+            return None
+        return self._exif.entries
+
+
+def _source_digest(filename, buffer):
+    """Identify the source of a raw file, for naming files derived from it."""
+    digest = hashlib.sha256()
+    if filename is None:
+        digest.update(buffer)
+    else:
+        identity = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            pass
+        else:
+            identity += ':{}:{}'.format(st.st_size, st.st_mtime_ns)
+        digest.update(os.fsencode(identity))
+    return digest.hexdigest()[:16]
 
 
 class DarkFrame(Raw):
@@ -469,12 +1127,19 @@ class DarkFrame(Raw):
     subtracted from another photos raw data.
 
     Creates a temporary file which is not cleaned up until the dark frame is
-    closed.
+    closed. The file is named after the source (its path, size and
+    modification time, or the contents of a buffer), so options which use the
+    dark frame freeze to the same value each time it is opened (see
+    :func:`rawkit.options.Options.freeze`).
+
+    Dark frames opened from the same source (in any process) share the file:
+    it is written atomically, and each dark frame which uses it holds a hard
+    link to it, so it's only removed once the last of them is closed.
     """
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, **kwargs):
         """Initializes a new DarkFrame object."""
-        super(DarkFrame, self).__init__(filename=filename)
+        super(DarkFrame, self).__init__(filename=filename, **kwargs)
         self.options = Options({
             'auto_brightness': False,
             'brightness': 1.0,
@@ -485,13 +1150,12 @@ class DarkFrame(Raw):
         })
         self._tmp = os.path.join(
             tempfile.gettempdir(),
-            '{prefix}{rand}'.format(
+            '{prefix}dark-{digest}'.format(
                 prefix=tempfile.gettempprefix(),
-                rand=''.join(random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits) for _ in range(8)
-                )
+                digest=_source_digest(filename, kwargs.get('buffer')),
             )
         )
+        self._link = None
         self._filetype = None
 
     def save(self, filename=None, filetype=output_file_types.ppm):
@@ -507,16 +1171,39 @@ class DarkFrame(Raw):
                                            :class:`output_file_types`.
         """
 
-        if filename is None:
-            filename = self._tmp
-
-        if not os.path.isfile(filename):
-            super(DarkFrame, self).save(filename=filename, filetype=filetype)
+        if filename is not None:
+            if not os.path.isfile(filename):
+                super(DarkFrame, self).save(
+                    filename=filename, filetype=filetype)
+            return
+
+        if not os.path.isfile(self._tmp):
+            if self._link is not None:
+                # Another dark frame removed it while this one was using it.
+                try:
+                    os.link(self._link, self._tmp)
+                except FileExistsError:
+                    pass
+            else:
+                with atomic_output(self._tmp) as tmp:
+                    super(DarkFrame, self).save(
+                        filename=tmp, filetype=filetype)
+        if self._link is None:
+            link = '{}.{}'.format(self._tmp, secrets.token_hex(8))
+            try:
+                os.link(self._tmp, link)
+            except OSError:
+                # Hard links aren't supported here; the file is only shared
+                # within a dark frame's lifetime.
+                pass
+            else:
+                self._link = link
 
     @property
     def name(self):
         """
-        A tempfile in a unique directory.
+        The temp file the dark frame is saved to, which is shared by dark
+        frames opened from the same source.
 
         Returns:
             str: The name of a temp file.
@@ -525,8 +1212,16 @@ class DarkFrame(Raw):
 
     def cleanup(self):
         """Cleanup temp files."""
+        if self._link is not None:
+            try:
+                os.unlink(self._link)
+            except OSError:
+                pass
+            self._link = None
         try:
-            os.unlink(self._tmp)
+            # Other dark frames from the same source may still be using it.
+            if os.stat(self._tmp).st_nlink == 1:
+                os.unlink(self._tmp)
         except OSError:
             pass
 
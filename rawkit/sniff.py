@@ -0,0 +1,122 @@
+""":mod:`rawkit.sniff` --- Recognize raw files from their first bytes
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Asking LibRaw whether a file is a raw file means opening and parsing it.
+:func:`sniff` looks at the first few hundred bytes of a file instead, and
+recognizes the containers used by raw formats as well as common files which
+are certainly not raw files (JPEGs, XMP sidecars, videos...), so those can be
+skipped without involving LibRaw at all.
+
+Sniffing can't prove that a file is a raw file (a TIFF based format might be a
+plain TIFF, and LibRaw identifies some headerless formats by their size alone),
+so anything which isn't rejected should still be confirmed by LibRaw.
+"""
+
+SNIFF_BYTES = 512
+"""The number of bytes :func:`sniff` needs from the start of a file."""
+
+raw_formats = (
+    'tiff', 'cr2', 'orf', 'rw2', 'raf', 'cr3', 'crw', 'x3f', 'mrw', 'unknown'
+)
+"""
+Format guesses returned by :func:`sniff`.
+
+  - ``tiff`` --- A TIFF based raw (eg. NEF, ARW, DNG, PEF, SRW...).
+  - ``cr2`` --- Canon CR2.
+  - ``orf`` --- Olympus ORF.
+  - ``rw2`` --- Panasonic RW2 and RWL.
+  - ``raf`` --- Fujifilm RAF.
+  - ``cr3`` --- Canon CR3 (ISO base media file format).
+  - ``crw`` --- Canon CRW (CIFF).
+  - ``x3f`` --- Sigma X3F.
+  - ``mrw`` --- Minolta MRW.
+  - ``unknown`` --- Not recognized, but not known not to be a raw file.
+"""
+
+# ISO base media file brands which are raw files.
+_RAW_BRANDS = (b'crx ',)
+
+# Leading bytes of files which are never raw files.
+_NOT_RAW = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG',
+    b'GIF8',
+    b'%PDF',
+    b'PK\x03\x04',  # Zip
+    b'RIFF',  # AVI, WAV, WebP
+    b'\x1a\x45\xdf\xa3',  # Matroska, WebM
+    b'OggS',
+    b'fLaC',
+    b'ID3',  # MP3
+    b'8BPS',  # Photoshop
+    b'\xef\xbb\xbf',  # UTF-8 byte order mark
+)
+
+# Markup (XMP sidecars, XML, HTML), after any leading whitespace.
+_MARKUP = (b'<?xpacket', b'<?xml', b'<x:xmpmeta', b'<!doctype', b'<html')
+
+
+def sniff(header):
+    """
+    Guess whether a file is a raw file from its first bytes.
+
+    Args:
+        header (bytes): The first :data:`SNIFF_BYTES` bytes of a file (or the
+                        whole file, if it is shorter).
+
+    Returns:
+        str: One of :data:`raw_formats`, or ``None`` if the file is not a raw
+             file.
+    """
+    if not header:
+        return None
+
+    if header[:2] in (b'II', b'MM'):
+        magic = header[2:4]
+        if magic in (b'RO', b'OR', b'RS'):
+            return 'orf'
+        if magic == b'U\x00':
+            return 'rw2'
+        if header[6:14] == b'HEAPCCDR':
+            return 'crw'
+        if magic in (b'*\x00', b'\x00*', b'+\x00', b'\x00+'):
+            return 'cr2' if header[8:10] == b'CR' else 'tiff'
+
+    if header.startswith(b'FUJIFILM'):
+        return 'raf'
+    if header.startswith(b'FOVb'):
+        return 'x3f'
+    if header.startswith(b'\x00MRM'):
+        return 'mrw'
+
+    if header[4:8] == b'ftyp':
+        # An ISO base media file: CR3, or a video or HEIF image.
+        return 'cr3' if header[8:12] in _RAW_BRANDS else None
+    if header[4:8] in (b'moov', b'mdat', b'wide', b'free'):
+        return None  # QuickTime
+
+    if header.startswith(_NOT_RAW):
+        return None
+    if header.lstrip()[:10].lower().startswith(_MARKUP):
+        return None
+
+    return 'unknown'
+
+
+def sniff_file(path):
+    """
+    Guess whether a file is a raw file from its first bytes (see
+    :func:`sniff`).
+
+    Args:
+        path (str): The file to check.
+
+    Returns:
+        str: One of :data:`raw_formats`, or ``None`` if the file is not a raw
+             file or can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return sniff(f.read(SNIFF_BYTES))
+    except (IOError, OSError):
+        return None
@@ -0,0 +1,290 @@
+""":mod:`rawkit.thumbnail` --- Embedded thumbnails
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Most raw files embed a preview image, usually a full size (or nearly full
+size) JPEG rendered by the camera. :func:`rawkit.raw.Raw.thumbnail` exposes it
+without decoding or copying it, eg. to stream an embedded JPEG to a client
+byte for byte:
+
+.. sourcecode:: python
+
+    from rawkit.raw import Raw
+    from rawkit.thumbnail import thumbnail_formats
+
+    with Raw(filename='some/raw/image.CR2') as raw:
+        thumb = raw.thumbnail()
+        if thumb.format == thumbnail_formats.jpeg:
+            response.write(thumb.data)
+"""
+
+import io
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+thumbnail_formats = namedtuple(
+    'ThumbnailFormat',
+    ['unknown', 'jpeg', 'bitmap', 'bitmap16', 'layer', 'rollei']
+)(0, 1, 2, 3, 4, 5)
+"""
+Constants for the format of an embedded thumbnail (LibRaw's
+``LibRaw_thumbnail_formats``).
+
+  - ``unknown`` --- The format could not be determined.
+  - ``jpeg`` --- A complete JPEG file.
+  - ``bitmap`` --- Interleaved 8-bit samples.
+  - ``bitmap16`` --- Interleaved 16-bit samples.
+  - ``layer`` --- A Foveon layer (unsupported by LibRaw).
+  - ``rollei`` --- A Rollei thumbnail (unsupported by LibRaw).
+"""
+
+
+def _fit(width, height, size):
+    """The dimensions of a `width` by `height` image scaled to `size`."""
+    scale = float(size) / max(width, height)
+    return (max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))))
+
+
+def _bin(pixels, factor):
+    """Downsample a ``(height, width, colors)`` array by averaging blocks."""
+    height = pixels.shape[0] // factor
+    width = pixels.shape[1] // factor
+    blocks = pixels[:height * factor, :width * factor].reshape(
+        height, factor, width, factor, pixels.shape[2]
+    ).sum(axis=(1, 3), dtype='uint32')
+    area = factor * factor
+    return ((blocks + area // 2) // area).astype(pixels.dtype)
+
+
+class Thumbnail(namedtuple('Thumbnail',
+                           ['format', 'width', 'height', 'colors', 'data'])):
+
+    """
+    An embedded thumbnail.
+
+    The `data` field is a :class:`memoryview` directly over LibRaw's copy of
+    the thumbnail, so no copies are made, but it is only valid until the
+    :class:`rawkit.raw.Raw` it came from is closed (after which it is
+    released, and accessing it raises :class:`ValueError`). Use
+    ``bytes(thumb.data)`` to keep a copy. Slices of it and
+    :func:`as_array` don't copy it either, and the raw can't be closed while
+    they are alive. Everything else (eg. :func:`to_image`) makes a copy.
+
+    Args:
+        format (thumbnail_formats): The format of the thumbnail.
+        width (int): Width in pixels.
+        height (int): Height in pixels.
+        colors (int): Number of color samples per pixel.
+        data (memoryview): The thumbnail's bytes. For JPEGs, this is a
+                           complete JPEG file.
+
+    Returns:
+        Thumbnail: A thumbnail object.
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_jpeg(self):
+        """
+        Whether the thumbnail is a JPEG file.
+
+        Returns:
+            boolean: ``True`` for JPEG thumbnails.
+        """
+        return self.format == thumbnail_formats.jpeg
+
+    @property
+    def is_bitmap(self):
+        """
+        Whether the thumbnail is an uncompressed bitmap.
+
+        Returns:
+            boolean: ``True`` for 8 or 16-bit bitmaps.
+        """
+        return self.format in (thumbnail_formats.bitmap,
+                               thumbnail_formats.bitmap16)
+
+    def as_array(self):
+        """
+        Get a NumPy view of a bitmap thumbnail. Like the thumbnail's data,
+        it isn't a copy, so the raw can't be closed until it is deleted.
+
+        Returns:
+            array: A ``(height, width, colors)`` array.
+
+        Raises:
+            ValueError: If the thumbnail is not a bitmap.
+        """
+        import numpy
+
+        if not self.is_bitmap:
+            raise ValueError("Only bitmap thumbnails can be viewed as arrays")
+
+        dtype = (numpy.uint8 if self.format == thumbnail_formats.bitmap
+                 else numpy.uint16)
+        return numpy.frombuffer(
+            self.data, dtype=dtype,
+            count=self.width * self.height * self.colors,
+        ).reshape(self.height, self.width, self.colors)
+
+    def to_image(self, size=None):
+        """
+        Decode the thumbnail with Pillow, scaled down so that its longest edge
+        is at most `size` pixels. JPEGs are decoded in draft mode, so a
+        reduced size image is decoded directly from the DCT coefficients
+        instead of decoding the whole thumbnail and scaling it afterwards.
+
+        Args:
+            size (int): The maximum length of the longest edge. By default
+                        the thumbnail is returned at full size.
+
+        Returns:
+            PIL.Image.Image: The decoded thumbnail.
+
+        Raises:
+            ValueError: If the thumbnail is neither a JPEG nor a bitmap.
+        """
+        return self._to_image(size)
+
+    def _to_image(self, size, jpeg=None):
+        # `jpeg` is the embedded JPEG, if it has already been opened (which
+        # only reads its header).
+        from PIL import Image
+
+        if self.is_jpeg:
+            image = jpeg if jpeg is not None else Image.open(
+                io.BytesIO(self.data))
+            if size is not None:
+                # Draft mode picks the smallest DCT scale which still covers
+                # the requested box, so ask for a box with the same aspect
+                # ratio as the image rather than a square.
+                image.draft('RGB', _fit(image.width, image.height, size))
+        elif self.is_bitmap:
+            image = _from_array(self._pixels())
+        else:
+            raise ValueError("Unsupported thumbnail format")
+
+        if size is not None:
+            image.thumbnail((size, size), Image.LANCZOS)
+        return image
+
+    def to_jpeg(self, size=None, quality=85):
+        """
+        Get the thumbnail as a JPEG file. Embedded JPEGs which don't need to
+        be scaled are returned as is, without being decoded or re-encoded.
+
+        Args:
+            size (int): The maximum length of the longest edge.
+            quality (int): The JPEG quality used if the thumbnail has to be
+                           encoded.
+
+        Returns:
+            bytes: A JPEG file.
+        """
+        if self.is_jpeg and (size is None or max(self._jpeg_size()) <= size):
+            return bytes(self.data)
+
+        return _encode(self.to_image(size), quality)
+
+    def renditions(self, sizes, quality=85, workers=None):
+        """
+        Get JPEG renditions of the thumbnail at several sizes at once.
+
+        The thumbnail is only decoded once: embedded JPEGs are decoded in
+        draft mode at the smallest DCT scale which covers the largest
+        requested size, and bitmaps are binned with NumPy. Each rendition is
+        then scaled down from the next larger one, and the renditions are
+        encoded in parallel.
+
+        Args:
+            sizes (iterable): The maximum lengths of the longest edges.
+            quality (int): The JPEG quality used for renditions which have to
+                           be encoded.
+            workers (int): The number of threads used for encoding. By
+                           default, one per rendition.
+
+        Returns:
+            dict: A JPEG file (bytes) for each size.
+
+        Raises:
+            ValueError: If the thumbnail is neither a JPEG nor a bitmap.
+        """
+        from PIL import Image
+
+        sizes = sorted(set(sizes), reverse=True)
+
+        if self.is_jpeg:
+            # LibRaw doesn't always know the size of an embedded JPEG, so it
+            # is read from the JPEG's header. Sizes at least as large as the
+            # JPEG are passed through.
+            jpeg = Image.open(io.BytesIO(self.data))
+            longest = max(jpeg.size)
+            scaled = [size for size in sizes if size < longest]
+            image = self._to_image(scaled[0], jpeg) if scaled else None
+        elif self.is_bitmap:
+            longest = max(self.width, self.height)
+            pixels = self._pixels()
+            if sizes and longest // sizes[0] > 1:
+                pixels = _bin(pixels, longest // sizes[0])
+            image = _from_array(pixels)
+        else:
+            raise ValueError("Unsupported thumbnail format")
+
+        # Cascade: each rendition is resampled from the previous (larger)
+        # one, so every resize works on as few pixels as possible.
+        renditions = []
+        for size in sizes:
+            if self.is_jpeg and size >= longest:
+                renditions.append((size, None))
+                continue
+            if max(image.size) > size:
+                image = image.resize(
+                    _fit(image.width, image.height, size), Image.LANCZOS)
+            renditions.append((size, image))
+
+        def encode(rendition):
+            size, image = rendition
+            if image is None:
+                return size, bytes(self.data)
+            return size, _encode(image, quality)
+
+        if not renditions:
+            return {}
+        with ThreadPoolExecutor(workers or len(renditions)) as executor:
+            return dict(executor.map(encode, renditions))
+
+    def _jpeg_size(self):
+        # LibRaw leaves the size of some embedded JPEGs at 0 (or reports the
+        # wrong one), so read it from the JPEG's header.
+        from PIL import Image
+
+        return Image.open(io.BytesIO(self.data)).size
+
+    def _pixels(self):
+        """
+        Get a bitmap thumbnail as 8-bit grayscale or RGB samples, copied so
+        that images made from them don't point into LibRaw's memory.
+        """
+        pixels = self.as_array()
+        if self.format == thumbnail_formats.bitmap16:
+            pixels = pixels >> 8
+        pixels = pixels.astype('uint8')
+        return pixels if self.colors == 1 else pixels[:, :, :3]
+
+
+def _from_array(pixels):
+    """Wrap a ``(height, width, colors)`` array in a Pillow image."""
+    from PIL import Image
+
+    return Image.fromarray(pixels[:, :, 0] if pixels.shape[2] == 1
+                           else pixels)
+
+
+def _encode(image, quality):
+    """Encode a Pillow image as a JPEG file."""
+    out = io.BytesIO()
+    image.convert('RGB').save(out, format='JPEG', quality=quality)
+    return out.getvalue()
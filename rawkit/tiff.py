@@ -0,0 +1,489 @@
+""":mod:`rawkit.tiff` --- Native TIFF writer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+LibRaw's own TIFF writer (used by :func:`rawkit.raw.Raw.save`) always writes
+uncompressed, single strip files. The :func:`write_tiff` function in this
+module works on an already processed RGB buffer instead (eg. the result of
+:func:`rawkit.raw.Raw.to_image`) and supports compression, the horizontal
+differencing predictor, strip or tile layouts and BigTIFF.
+
+For example, saving a compressed 16-bit TIFF might look like this:
+
+.. sourcecode:: python
+
+    from rawkit.raw import Raw
+    from rawkit.tiff import compression_types, predictors
+
+    with Raw(filename='some/raw/image.CR2') as raw:
+        raw.options.bps = 16
+        stats = raw.save_tiff(
+            'some/destination/image.tiff',
+            compression=compression_types.deflate,
+            predictor=predictors.horizontal,
+        )
+        print('{:.1f} MB/s'.format(stats.mb_per_s))
+"""
+
+import os
+import struct
+import sys
+import time
+import zlib
+
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from rawkit.errors import InvalidFileType
+
+
+compression_types = namedtuple(
+    'CompressionType', ['none', 'lzw', 'deflate']
+)(1, 5, 8)
+"""
+Constants for setting the TIFF compression scheme.
+
+  - ``none`` --- No compression.
+  - ``lzw`` --- Lempel-Ziv-Welch compression (slow, pure Python).
+  - ``deflate`` --- Adobe style deflate (zlib) compression.
+"""
+
+predictors = namedtuple(
+    'Predictor', ['none', 'horizontal']
+)(1, 2)
+"""
+Constants for setting the TIFF predictor.
+
+  - ``none`` --- No prediction.
+  - ``horizontal`` --- Horizontal differencing, which usually makes
+    photographic data compress a lot better (requires NumPy).
+"""
+
+BIGTIFF_THRESHOLD = 2 ** 32
+"""
+Files which may grow past this many bytes are written as BigTIFF.
+"""
+
+# TIFF field types
+_SHORT = 3
+_LONG = 4
+_LONG8 = 16
+_ASCII = 2
+
+_TYPE_FORMATS = {
+    _ASCII: 's',
+    _SHORT: 'H',
+    _LONG: 'I',
+    _LONG8: 'Q',
+}
+
+# Tags
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_ROWS_PER_STRIP = 278
+_STRIP_BYTE_COUNTS = 279
+_PLANAR_CONFIG = 284
+_SOFTWARE = 305
+_PREDICTOR = 317
+_TILE_WIDTH = 322
+_TILE_LENGTH = 323
+_TILE_OFFSETS = 324
+_TILE_BYTE_COUNTS = 325
+_EXTRA_SAMPLES = 338
+
+# Target uncompressed size of a single strip when rows_per_strip isn't given.
+_STRIP_SIZE = 256 * 1024
+
+# LZW codes
+_LZW_CLEAR = 256
+_LZW_EOI = 257
+_LZW_FIRST = 258
+_LZW_MAX = 4095
+
+
+class TiffStats(namedtuple('TiffStats',
+                           ['bytes_in', 'bytes_out', 'seconds', 'bigtiff'])):
+
+    """
+    Statistics about a single call to :func:`write_tiff`.
+
+    Args:
+        bytes_in (int): Size of the uncompressed image data.
+        bytes_out (int): Size of the file that was written.
+        seconds (float): Wall clock time spent writing the file.
+        bigtiff (boolean): Whether the file was written as BigTIFF.
+
+    Returns:
+        TiffStats: A stats object.
+    """
+
+    __slots__ = ()
+
+    @property
+    def mb_per_s(self):
+        """
+        Throughput in (uncompressed) megabytes per second.
+
+        Returns:
+            float: The throughput.
+        """
+        if self.seconds <= 0:
+            return float('inf')
+        return self.bytes_in / self.seconds / 1e6
+
+    @property
+    def ratio(self):
+        """
+        The compression ratio achieved.
+
+        Returns:
+            float: Uncompressed size divided by file size.
+        """
+        return self.bytes_in / float(self.bytes_out or 1)
+
+
+@contextmanager
+def _open_output(filename):
+    """
+    Open a file for writing, or use a binary file object (eg. an
+    ``io.BytesIO``) as it is, leaving it open.
+    """
+    if hasattr(filename, 'write'):
+        yield filename
+    else:
+        with open(filename, 'wb') as f:
+            yield f
+
+
+def _lzw_compress(data):
+    """
+    Compress `data` using the TIFF flavour of LZW (MSB-first bit order, with
+    the same "early change" code width handling as libtiff).
+    """
+    out = bytearray()
+    codes = [(_LZW_CLEAR, 9)]
+    nbits = 9
+    maxcode = (1 << nbits) - 1
+    free_ent = _LZW_FIRST
+    table = {}
+
+    data = memoryview(data).cast('B')
+    if len(data):
+        ent = data[0]
+        for c in data[1:]:
+            key = (ent << 8) | c
+            code = table.get(key)
+            if code is not None:
+                ent = code
+                continue
+            codes.append((ent, nbits))
+            ent = c
+            table[key] = free_ent
+            free_ent += 1
+            if free_ent == _LZW_MAX - 1:
+                table.clear()
+                free_ent = _LZW_FIRST
+                codes.append((_LZW_CLEAR, nbits))
+                nbits = 9
+                maxcode = (1 << nbits) - 1
+            elif free_ent > maxcode:
+                nbits += 1
+                maxcode = (1 << nbits) - 1
+
+        codes.append((ent, nbits))
+        free_ent += 1
+        if free_ent == _LZW_MAX - 1:
+            codes.append((_LZW_CLEAR, nbits))
+            nbits = 9
+        elif free_ent > maxcode:
+            nbits += 1
+    codes.append((_LZW_EOI, nbits))
+
+    acc = 0
+    acc_bits = 0
+    for code, width in codes:
+        acc = (acc << width) | code
+        acc_bits += width
+        while acc_bits >= 8:
+            acc_bits -= 8
+            out.append((acc >> acc_bits) & 0xff)
+        acc &= (1 << acc_bits) - 1
+    if acc_bits:
+        out.append((acc << (8 - acc_bits)) & 0xff)
+
+    return bytes(out)
+
+
+def _predict(segment, width, colors, bits):
+    """Apply horizontal differencing to the rows of a segment."""
+    import numpy
+
+    dtype = numpy.uint8 if bits == 8 else numpy.uint16
+    rows = numpy.frombuffer(segment, dtype=dtype).reshape(-1, width, colors)
+    diff = rows.copy()
+    diff[:, 1:] -= rows[:, :-1]
+    return diff.tobytes()
+
+
+def _segments(data, width, height, colors, bits, rows_per_strip, tile_size):
+    """
+    Yield the uncompressed bytes of each strip or tile, in the order they
+    should appear in the file.
+    """
+    view = memoryview(data).cast('B')
+    pixel = colors * bits // 8
+    row = width * pixel
+
+    if tile_size is None:
+        for y in range(0, height, rows_per_strip):
+            yield view[y * row:min(y + rows_per_strip, height) * row]
+        return
+
+    tile_width, tile_length = tile_size
+    tile_row = tile_width * pixel
+    for y in range(0, height, tile_length):
+        for x in range(0, width, tile_width):
+            tile = bytearray(tile_row * tile_length)
+            start = x * pixel
+            end = min(x + tile_width, width) * pixel
+            for ty in range(min(tile_length, height - y)):
+                offset = (y + ty) * row
+                tile[ty * tile_row:ty * tile_row + end - start] = (
+                    view[offset + start:offset + end]
+                )
+            yield tile
+
+
+def _encode(segment, width, colors, bits, compression, predictor, level):
+    if compression == compression_types.none:
+        return bytes(segment)
+    if predictor == predictors.horizontal:
+        segment = _predict(segment, width, colors, bits)
+    if compression == compression_types.deflate:
+        return zlib.compress(segment, level)
+    return _lzw_compress(segment)
+
+
+def _ifd(entries, offset, bigtiff, byteorder):
+    """
+    Build an image file directory which will be written at `offset`.
+
+    Args:
+        entries (list): ``(tag, type, values)`` tuples.
+        offset (int): The file offset the IFD will be written at.
+        bigtiff (boolean): Whether to use the BigTIFF layout.
+        byteorder (str): A :mod:`struct` byte order character.
+
+    Returns:
+        bytes: The encoded IFD, including out-of-line values.
+    """
+    if bigtiff:
+        count_fmt, entry_fmt, inline, offset_fmt = 'Q', 'HHQ', 8, 'Q'
+    else:
+        count_fmt, entry_fmt, inline, offset_fmt = 'H', 'HHI', 4, 'I'
+
+    entry_size = struct.calcsize(byteorder + entry_fmt) + inline
+    header = struct.calcsize(byteorder + count_fmt)
+    extra_offset = offset + header + len(entries) * entry_size + inline
+
+    ifd = bytearray(struct.pack(byteorder + count_fmt, len(entries)))
+    extra = bytearray()
+    for tag, typ, values in sorted(entries, key=lambda e: e[0]):
+        if typ == _ASCII:
+            payload = values + b'\0'
+            count = len(payload)
+        else:
+            count = len(values)
+            payload = struct.pack(
+                byteorder + str(count) + _TYPE_FORMATS[typ], *values
+            )
+        ifd += struct.pack(byteorder + entry_fmt, tag, typ, count)
+        if len(payload) <= inline:
+            ifd += payload.ljust(inline, b'\0')
+        else:
+            ifd += struct.pack(
+                byteorder + offset_fmt, extra_offset + len(extra))
+            extra += payload
+            if len(extra) % 2:
+                extra += b'\0'
+    ifd += struct.pack(byteorder + offset_fmt, 0)
+    return bytes(ifd + extra)
+
+
+def write_tiff(filename, data, width, height, colors=3, bits=8,
+               compression=compression_types.deflate,
+               predictor=predictors.none, rows_per_strip=None, tile_size=None,
+               level=6, workers=None, bigtiff=None):
+    """
+    Write interleaved image data as a TIFF file.
+
+    Deflate compressed strips (or tiles) are compressed in parallel on a
+    thread pool (zlib releases the GIL while compressing) and written out in
+    order as they become available. LZW is pure Python, so it would gain
+    nothing from more threads under the GIL: LZW (and uncompressed) segments
+    are encoded by a single thread, which still overlaps with writing.
+
+    Args:
+        filename (str): The file to write, or a seekable binary file object
+                        positioned at its start.
+        data (bytes-like): Interleaved pixel data in native byte order, eg.
+                           the `data` field of a
+                           :class:`rawkit.raw.ProcessedImage`.
+        width (int): Width of the image in pixels.
+        height (int): Height of the image in pixels.
+        colors (int): Number of samples per pixel.
+        bits (int): Bits per sample (8 or 16).
+        compression (compression_types): The compression scheme to use.
+        predictor (predictors): The predictor to use. Ignored for
+                                uncompressed files.
+        rows_per_strip (int): Rows in each strip. By default strips of
+                              roughly 256KB are used.
+        tile_size (2 int tuple): Write tiles of ``(width, length)`` instead
+                                 of strips. Both must be multiples of 16.
+        level (int): The zlib compression level.
+        workers (int): The number of compression threads to use for deflate.
+                       By default, one per CPU.
+        bigtiff (boolean): Force (or prevent) writing a BigTIFF. By default a
+                           BigTIFF is only written if the file might exceed
+                           :data:`BIGTIFF_THRESHOLD` bytes.
+
+    Returns:
+        TiffStats: Statistics about the write.
+
+    Raises:
+        rawkit.errors.InvalidFileType: If an unsupported compression,
+                                       predictor, bit depth or tile size is
+                                       requested.
+        ValueError: If `data` is not the expected size.
+    """
+    start = time.time()
+
+    if compression not in compression_types:
+        raise InvalidFileType(
+            "Compression must be in rawkit.tiff.compression_types")
+    if predictor not in predictors:
+        raise InvalidFileType("Predictor must be in rawkit.tiff.predictors")
+    if bits not in (8, 16):
+        raise InvalidFileType("Only 8 and 16 bit TIFFs are supported")
+    if tile_size is not None and (tile_size[0] % 16 or tile_size[1] % 16):
+        raise InvalidFileType("Tile dimensions must be multiples of 16")
+
+    bytes_in = width * height * colors * bits // 8
+    if len(memoryview(data).cast('B')) != bytes_in:
+        raise ValueError(
+            "Expected {} bytes of image data".format(bytes_in))
+
+    if rows_per_strip is None:
+        row = width * colors * bits // 8
+        rows_per_strip = max(1, min(height, _STRIP_SIZE // max(row, 1)))
+
+    if bigtiff is None:
+        # LZW can expand incompressible data by up to 50%.
+        worst_case = bytes_in * (3 if compression == compression_types.lzw
+                                 else 2) // 2 + 2 ** 20
+        bigtiff = worst_case >= BIGTIFF_THRESHOLD
+
+    byteorder = '<' if sys.byteorder == 'little' else '>'
+    if bigtiff:
+        header = (b'II' if byteorder == '<' else b'MM') + struct.pack(
+            byteorder + 'HHHQ', 43, 8, 0, 0)
+        offset_type = _LONG8
+    else:
+        header = (b'II' if byteorder == '<' else b'MM') + struct.pack(
+            byteorder + 'HI', 42, 0)
+        offset_type = _LONG
+
+    if compression != compression_types.deflate:
+        workers = 1
+    elif workers is None:
+        workers = os.cpu_count() or 1
+
+    segment_width = width if tile_size is None else tile_size[0]
+    offsets = []
+    counts = []
+
+    with _open_output(filename) as f, ThreadPoolExecutor(workers) as pool:
+        f.write(header)
+        position = len(header)
+
+        # Keep a bounded number of segments in flight so that large images
+        # are never held in memory in compressed and uncompressed form.
+        max_pending = 2 * workers
+        pending = deque()
+        segments = _segments(data, width, height, colors, bits,
+                             rows_per_strip, tile_size)
+        while True:
+            for segment in segments:
+                pending.append(pool.submit(
+                    _encode, segment, segment_width, colors, bits,
+                    compression, predictor, level,
+                ))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            chunk = pending.popleft().result()
+            f.write(chunk)
+            offsets.append(position)
+            counts.append(len(chunk))
+            position += len(chunk)
+
+        if position % 2:
+            f.write(b'\0')
+            position += 1
+
+        photometric = 1 if colors < 3 else 2
+        entries = [
+            (_IMAGE_WIDTH, _LONG, (width,)),
+            (_IMAGE_LENGTH, _LONG, (height,)),
+            (_BITS_PER_SAMPLE, _SHORT, (bits,) * colors),
+            (_COMPRESSION, _SHORT, (compression,)),
+            (_PHOTOMETRIC, _SHORT, (photometric,)),
+            (_SAMPLES_PER_PIXEL, _SHORT, (colors,)),
+            (_PLANAR_CONFIG, _SHORT, (1,)),
+            (_SOFTWARE, _ASCII, b'rawkit'),
+        ]
+        if compression == compression_types.none:
+            predictor = predictors.none
+        if predictor != predictors.none:
+            entries.append((_PREDICTOR, _SHORT, (predictor,)))
+        extra_samples = colors - (1 if colors < 3 else 3)
+        if extra_samples:
+            entries.append((_EXTRA_SAMPLES, _SHORT, (0,) * extra_samples))
+        if tile_size is None:
+            entries += [
+                (_ROWS_PER_STRIP, _LONG, (rows_per_strip,)),
+                (_STRIP_OFFSETS, offset_type, offsets),
+                (_STRIP_BYTE_COUNTS, offset_type, counts),
+            ]
+        else:
+            entries += [
+                (_TILE_WIDTH, _LONG, (tile_size[0],)),
+                (_TILE_LENGTH, _LONG, (tile_size[1],)),
+                (_TILE_OFFSETS, offset_type, offsets),
+                (_TILE_BYTE_COUNTS, offset_type, counts),
+            ]
+
+        if not bigtiff and position >= BIGTIFF_THRESHOLD:  # pragma: no cover
+            raise ValueError(
+                "Image data exceeds 4GB, write it with bigtiff=True")
+
+        f.write(_ifd(entries, position, bigtiff, byteorder))
+        bytes_out = f.tell()
+
+        # Point the header at the IFD we just wrote.
+        f.seek(8 if bigtiff else 4)
+        f.write(struct.pack(byteorder + ('Q' if bigtiff else 'I'), position))
+
+    return TiffStats(
+        bytes_in=bytes_in,
+        bytes_out=bytes_out,
+        seconds=time.time() - start,
+        bigtiff=bigtiff,
+    )
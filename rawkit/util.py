@@ -7,36 +7,594 @@ by LibRaw.
 """
 
 import ctypes
+import fnmatch
+import json
+import multiprocessing
 import os
+import secrets
+import stat
+import threading
+import time
+
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from libraw.bindings import LibRaw
-from libraw.errors import FileUnsupported
+from libraw.errors import LibRawError
+
+from rawkit.metadata import snapshot
+from rawkit.sniff import sniff_file
+
+DiscoveredFile = namedtuple(
+    'DiscoveredFile', ['path', 'size', 'mtime', 'format_guess']
+)
+"""
+A raw file found by :func:`iter_discover`: its path (as :class:`bytes`), size,
+modification time (in nanoseconds since the epoch) and the format guessed from
+its header (one of :data:`rawkit.sniff.raw_formats`).
+"""
+
+ScanDiff = namedtuple('ScanDiff', ['added', 'removed', 'modified'])
+"""
+The raw files (as :class:`bytes` paths) which changed between two runs of
+:func:`rescan`.
+"""
+
+# Version of the state file written by rescan.
+_SCAN_STATE_VERSION = 1
+
+# Directories modified this close to the start of a scan could be modified
+# again without their mtime changing (timestamps are coarse on some file
+# systems), so their mtime isn't trusted by the next scan.
+_RACY_NS = 2 * 10 ** 9
+
+# Columns returned by read_metadata, and their types.
+metadata_columns = (
+    ('aperture', 'float32'),
+    ('shutter', 'float32'),
+    ('iso', 'float32'),
+    ('timestamp', 'int64'),
+    ('focal_length', 'float32'),
+    ('flash', 'bool'),
+    ('width', 'uint16'),
+    ('height', 'uint16'),
+    ('make', 'S64'),
+    ('model', 'S64'),
+    ('orientation', 'uint8'),
+    ('shot_order', 'uint32'),
+)
+
+# The LibRaw handle reused by every read in a read_metadata worker process
+# (reads in the calling process use their own).
+_worker_libraw = None
+_worker_data = None
+
 
+class _Confirmer(object):
 
-def discover(path):
+    """
+    Confirms that files are raw files, first by sniffing them and then with
+    LibRaw. Each thread gets its own LibRaw handle, which is reused for every
+    file it checks.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for libraw, data in self._handles:
+            libraw.libraw_close(data)
+        self._handles = []
+
+    def _handle(self):
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            libraw = LibRaw()
+            handle = self._local.handle = (libraw, libraw.libraw_init(0))
+            with self._lock:
+                self._handles.append(handle)
+        return handle
+
+    def check(self, path):
+        """Return the sniffed format of a raw file, or None."""
+        format_guess = sniff_file(path)
+        if format_guess is None:
+            return None
+        libraw, data = self._handle()
+        try:
+            libraw.libraw_open_file(data, path)
+        except (LibRawError, IOError, OSError, KeyError):
+            # Truncated or unreadable files (and unknown LibRaw errors) are
+            # no more raw files than unsupported ones.
+            return None
+        finally:
+            libraw.libraw_recycle(data)
+        return format_guess
+
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def _scan(root, include, exclude, max_depth, follow_symlinks):
+    """Yield a DirEntry for every file to check under root."""
+    stack = [(root, 0)]
+    seen = set()
+    if follow_symlinks:
+        st = os.stat(root)
+        seen.add((st.st_dev, st.st_ino))
+
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                name = os.fsdecode(entry.name)
+                if exclude and _matches(name, exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        if max_depth is not None and depth >= max_depth:
+                            continue
+                        if follow_symlinks:
+                            # Don't follow links around in circles.
+                            st = entry.stat()
+                            if (st.st_dev, st.st_ino) in seen:
+                                continue
+                            seen.add((st.st_dev, st.st_ino))
+                        subdirs.append(entry.path)
+                    elif (entry.is_file(follow_symlinks=follow_symlinks) and
+                            (not include or _matches(name, include))):
+                        yield entry
+                except OSError:
+                    continue
+        # Visit subdirectories in the order they were listed.
+        stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+
+def iter_discover(path, include=None, exclude=None, max_depth=None,
+                  follow_symlinks=False, records=False, workers=None):
+    """
+    Recursively search for raw files in a given directory, yielding each one
+    as soon as it has been confirmed, so that huge trees can be processed
+    while they are still being scanned. Candidates are checked the same way
+    as by :func:`discover`, and results are yielded in the order in which
+    they were found.
+
+    Args:
+        path (str): A tree to recursively search.
+        include (list): Only consider files whose names match one of these
+                        glob patterns (eg. ``['*.CR2', '*.NEF']``).
+        exclude (list): Skip files and directories whose names match one of
+                        these glob patterns (eg. ``['.*', '@eaDir']``).
+        max_depth (int): How many levels of subdirectories to descend into
+                         (0 only searches `path` itself). By default, there
+                         is no limit.
+        follow_symlinks (bool): Follow symbolic links to files and
+                                directories (links which loop back are only
+                                followed once).
+        records (bool): Yield :class:`DiscoveredFile` records instead of
+                        paths.
+        workers (int): The number of threads used to confirm candidates. By
+                       default, one per CPU.
+
+    Yields:
+        bytes: The path of each raw file (or a :class:`DiscoveredFile`).
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = deque()
+
+    def finish(entry, future):
+        format_guess = future.result()
+        if format_guess is None:
+            return None
+        if not records:
+            return entry.path
+        try:
+            # DirEntry caches this, and on some platforms already has it.
+            st = entry.stat(follow_symlinks=follow_symlinks)
+        except OSError:
+            return None
+        return DiscoveredFile(
+            entry.path, st.st_size, st.st_mtime_ns, format_guess)
+
+    with _Confirmer() as confirmer:
+        with ThreadPoolExecutor(workers) as executor:
+            for entry in _scan(os.fsencode(path), include, exclude,
+                               max_depth, follow_symlinks):
+                pending.append(
+                    (entry, executor.submit(confirmer.check, entry.path)))
+                # Yield whatever is ready, and never have more than a few
+                # candidates per worker in flight.
+                while pending and (len(pending) > workers * 4 or
+                                   pending[0][1].done()):
+                    result = finish(*pending.popleft())
+                    if result is not None:
+                        yield result
+            while pending:
+                result = finish(*pending.popleft())
+                if result is not None:
+                    yield result
+
+
+def discover(path, workers=None):
     """
     Recursively search for raw files in a given directory.
 
+    Files are sniffed first (see :mod:`rawkit.sniff`), so files which are
+    certainly not raw files (JPEGs, sidecars, videos...) are never opened with
+    LibRaw. The remaining candidates are confirmed by LibRaw on a pool of
+    threads.
+
     Args:
         path (str): A tree to recursively search.
+        workers (int): The number of threads to use. By default, one per CPU.
+
+    Returns:
+        list: The paths (as :class:`bytes`) of the raw files, in the order
+              they were found.
     """
-    file_list = []
-    libraw = LibRaw()
-    raw = libraw.libraw_init(0)
+    return list(iter_discover(path, workers=workers))
+
 
-    for root, _, files in os.walk(path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name).encode('ascii')
+def _list_directory(directory, include, exclude, follow_symlinks):
+    """
+    List ``(entry, stat)`` for the subdirectories (whose stat is None) and
+    candidate files in a directory.
+    """
+    listing = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = os.fsdecode(entry.name)
+            if exclude and _matches(name, exclude):
+                continue
             try:
-                libraw.libraw_open_file(raw, file_path)
-            except FileUnsupported:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    listing.append((entry, None))
+                elif (entry.is_file(follow_symlinks=follow_symlinks) and
+                        (not include or _matches(name, include))):
+                    listing.append(
+                        (entry, entry.stat(follow_symlinks=follow_symlinks)))
+            except OSError:
+                continue
+    return listing
+
+
+def _load_scan_state(state_file, options):
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if (state.get('version') != _SCAN_STATE_VERSION or
+            state.get('options') != options):
+        return {}
+    return state['dirs']
+
+
+def rescan(path, state_file, include=None, exclude=None, max_depth=None,
+           follow_symlinks=False, verify=False, workers=None):
+    """
+    Incrementally search for raw files, reporting what changed since the
+    last run.
+
+    The state of each directory (its modification time, subdirectories and
+    raw files) is saved in `state_file`. Directories whose modification time
+    hasn't changed are not listed again and their files are not checked
+    again, so rescanning a mostly unchanged archive only costs one
+    :func:`os.stat` per directory. The first run (or a run with different
+    filters) scans everything and reports every raw file as added.
+
+    Editing a file in place doesn't change the modification time of its
+    directory, so such changes are only noticed with `verify`, which also
+    stats every known raw file in unchanged directories.
+
+    Args:
+        path (str): A tree to recursively search.
+        state_file (str): Where to keep the state between runs. It is written
+                          atomically.
+        include (list): Glob patterns of file names to consider (see
+                        :func:`iter_discover`).
+        exclude (list): Glob patterns of names to skip.
+        max_depth (int): How many levels of subdirectories to descend into.
+        follow_symlinks (bool): Follow symbolic links.
+        verify (bool): Stat known raw files in unchanged directories.
+        workers (int): The number of threads used to confirm candidates.
+
+    Returns:
+        ScanDiff: The raw files which were added, removed and modified.
+    """
+    root = os.path.abspath(os.fsencode(path))
+    options = {
+        'root': os.fsdecode(root),
+        'include': include,
+        'exclude': exclude,
+        'max_depth': max_depth,
+        'follow_symlinks': follow_symlinks,
+    }
+    old_dirs = _load_scan_state(state_file, options)
+    new_dirs = {}
+    racy = int(time.time() * 10 ** 9) - _RACY_NS
+    added, removed, modified = [], [], []
+    # (directory key, DirEntry, stat) of files which need to be checked.
+    candidates = []
+    seen = set()
+
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        key = os.fsdecode(directory)
+        try:
+            st = os.stat(directory)
+        except OSError:
+            continue
+        if follow_symlinks:
+            if (st.st_dev, st.st_ino) in seen:
                 continue
-            finally:
-                libraw.libraw_recycle(raw)
-            file_list.append(file_path)
+            seen.add((st.st_dev, st.st_ino))
+
+        old = old_dirs.get(key)
+        if old is not None and old['mtime'] == st.st_mtime_ns:
+            # Nothing was added, removed or renamed: reuse the old listing.
+            record = new_dirs[key] = old
+            if verify:
+                record = new_dirs[key] = dict(old, raws={})
+                for name, old_raw in old['raws'].items():
+                    path = os.path.join(directory, os.fsencode(name))
+                    try:
+                        file_st = os.stat(path)
+                    except OSError:
+                        continue
+                    raw = [file_st.st_size, file_st.st_mtime_ns, old_raw[2]]
+                    if raw != old_raw:
+                        modified.append(path)
+                    record['raws'][name] = raw
+        else:
+            record = new_dirs[key] = {
+                'mtime': st.st_mtime_ns if st.st_mtime_ns < racy else None,
+                'subdirs': [],
+                'raws': {},
+            }
+            known = old['raws'] if old is not None else {}
+            try:
+                listing = _list_directory(
+                    directory, include, exclude, follow_symlinks)
+            except OSError:
+                # Keep what we knew (rather than report everything under it
+                # as removed), and list it again next time.
+                record = new_dirs[key] = dict(
+                    old or {'subdirs': [], 'raws': {}}, mtime=None)
+                listing = []
+            for entry, file_st in listing:
+                name = os.fsdecode(entry.name)
+                if file_st is None:
+                    record['subdirs'].append(name)
+                    continue
+                old_raw = known.get(name)
+                if old_raw is not None and old_raw[:2] == [
+                        file_st.st_size, file_st.st_mtime_ns]:
+                    record['raws'][name] = old_raw
+                else:
+                    candidates.append((key, entry, file_st))
+
+        if max_depth is None or depth < max_depth:
+            stack.extend(
+                (os.path.join(directory, os.fsencode(name)), depth + 1)
+                for name in reversed(record['subdirs']))
+
+    with _Confirmer() as confirmer:
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+            results = executor.map(
+                confirmer.check, [entry.path for _, entry, _ in candidates])
+            for (key, entry, file_st), format_guess in zip(
+                    candidates, results):
+                if format_guess is None:
+                    continue
+                name = os.fsdecode(entry.name)
+                new_dirs[key]['raws'][name] = [
+                    file_st.st_size, file_st.st_mtime_ns, format_guess]
+                old = old_dirs.get(key)
+                if old is not None and name in old['raws']:
+                    modified.append(entry.path)
+                else:
+                    added.append(entry.path)
+
+    for key, old in old_dirs.items():
+        raws = new_dirs.get(key, {'raws': {}})['raws']
+        removed.extend(
+            os.fsencode(os.path.join(key, name))
+            for name in old['raws'] if name not in raws)
+
+    with atomic_output(state_file) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump({
+                'version': _SCAN_STATE_VERSION,
+                'options': options,
+                'dirs': new_dirs,
+            }, f)
+
+    return ScanDiff(sorted(added), sorted(removed), sorted(modified))
+
+
+@contextmanager
+def atomic_output(filename):
+    """
+    A context manager which yields a temporary file name to write to in place
+    of `filename`. When the block succeeds the temporary file is flushed to
+    disk and atomically renamed over `filename`, so readers (and interrupted
+    runs, or crashes) never see a partially written file; if the block raises,
+    the temporary file is removed.
+
+    The temporary file is created in the same directory and keeps the same
+    extension, so file types can still be guessed from its name. It gets the
+    permissions of the file it replaces, or those of a newly created file if
+    there isn't one. ::
+
+        with atomic_output('out.tiff') as tmp:
+            raw.save(filename=tmp)
+
+    Args:
+        filename (str): The file that will ultimately be written.
+
+    Yields:
+        str: The temporary file name.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    ext = os.path.splitext(name)[1]
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = None
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp = os.path.join(directory, '.{}.{}{}'.format(
+            name, secrets.token_hex(4), ext))
+        try:
+            # Like any new file, this gets 0666 less the process umask.
+            fd = os.open(tmp, flags, 0o666)
+        except FileExistsError:
+            continue
+        break
+    try:
+        try:
+            if mode is not None:
+                if hasattr(os, 'fchmod'):
+                    os.fchmod(fd, mode)
+                else:  # pragma: no cover
+                    os.chmod(tmp, mode)
+        finally:
+            os.close(fd)
+        yield tmp
+        # Flush the data to disk before the rename makes it visible, so a
+        # crash can't leave an empty or truncated file under the final name.
+        _fsync(tmp, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        os.replace(tmp, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # And the rename itself, where directories can be synced (not on
+    # Windows, or some file systems).
+    try:
+        _fsync(directory, os.O_RDONLY)
+    except OSError:
+        pass
+
+
+def _fsync(path, flags):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _init_metadata_worker():
+    global _worker_libraw, _worker_data
+    _worker_libraw = LibRaw()
+    _worker_data = _worker_libraw.libraw_init(0)
+
+
+def _read_one(path):
+    """Read one file's metadata in a worker process."""
+    return _read_with(_worker_libraw, _worker_data, path)
+
+
+def _read_with(libraw, data, path):
+    """Read one file's metadata, returning ``(values, error)``."""
+    try:
+        try:  # pragma: no cover
+            _fname = os.fsencode(path)
+        except Exception:  # pragma: no cover
+            _fname = path
+        libraw.libraw_open_file(data, _fname)
+        metadata = snapshot(data)
+        return tuple(
+            getattr(metadata, name) for name, _ in metadata_columns
+        ), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        libraw.libraw_recycle(data)
+
+
+def read_metadata(paths, workers=None, chunksize=64):
+    """
+    Read the metadata of many raw files across a pool of processes.
+
+    Each worker process opens a single LibRaw handle and reuses it for every
+    file it reads, and only the parsed metadata (never the pixel data) is
+    read. The result is columnar: a :class:`numpy.ndarray` per field, in the
+    same order as `paths`, which is far more compact than one
+    :class:`rawkit.metadata.Metadata` per file.
+
+    Files that cannot be read don't stop the run. Their row is zeroed, and the
+    ``error`` column holds a description of what went wrong (it is ``None``
+    for every file that was read). ::
+
+        table = read_metadata(discover('photos'), workers=8)
+        failed = table['path'][table['error'] != None]
+
+    Args:
+        paths (iterable): The raw files to read.
+        workers (int): The number of processes to use. By default, one per
+                       CPU. With a single worker the files are read in this
+                       process.
+        chunksize (int): The number of files handed to a worker at a time.
+
+    Returns:
+        dict: Arrays keyed by column name: ``path``, ``error`` and each of
+              :data:`metadata_columns`.
+    """
+    import numpy
+
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        libraw = LibRaw()
+        data = libraw.libraw_init(0)
+        try:
+            results = [_read_with(libraw, data, path) for path in paths]
+        finally:
+            libraw.libraw_close(data)
+    else:
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_metadata_worker)
+        try:
+            results = list(pool.imap(_read_one, paths, chunksize))
+        finally:
+            pool.close()
+            pool.join()
 
-    libraw.libraw_close(raw)
-    return file_list
+    table = {
+        name: numpy.zeros(len(paths), dtype)
+        for name, dtype in metadata_columns
+    }
+    table['path'] = numpy.array(paths, dtype=object)
+    table['error'] = numpy.empty(len(paths), dtype=object)
+    for i, (values, error) in enumerate(results):
+        if error is not None:
+            table['error'][i] = error
+            continue
+        for (name, _), value in zip(metadata_columns, values):
+            table[name][i] = value
+    return table
 
 
 def camera_list():
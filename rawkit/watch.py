@@ -0,0 +1,523 @@
+""":mod:`rawkit.watch` --- Develop raw files as they arrive
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A :class:`Watcher` uses Linux's inotify to notice raw files as soon as they
+have been written to a directory (for instance by tethering software or an
+upload server), and hands each of them to a function on a pool of worker
+threads:
+
+.. sourcecode:: python
+
+    from rawkit.raw import Raw
+    from rawkit.watch import Watcher
+
+    def develop(path):
+        with Raw(filename=path) as raw:
+            raw.save(filename=path + b'.tiff', filetype='tiff')
+
+    with Watcher('/srv/ingest', develop, include=['*.CR2', '*.NEF']):
+        signal.pause()
+
+Files are only considered once they have been closed after writing (or moved
+into the watched tree), so partially written files are never opened. Because
+some programs write a file in several passes, a file is only dispatched once
+it has been quiet for a short while, and it is then checked (see
+:mod:`rawkit.sniff`) to make sure that it is a raw file.
+
+If files arrive faster than they can be noticed, the kernel's queue of events
+overflows and some are lost. The watched tree is then rescanned (see
+:func:`rawkit.util.rescan`) in the background, and raw files which were added
+or modified since the last scan, and which weren't seen arriving, are
+dispatched too. If the scan's state is kept in a file, files added or
+modified while nobody was watching are dispatched when watching starts again.
+
+inotify is accessed with :mod:`ctypes`, so no extra dependency is needed, but
+watching is only supported on Linux.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from rawkit.util import _Confirmer
+from rawkit.util import _matches
+from rawkit.util import rescan
+
+
+WatchStats = namedtuple('WatchStats', [
+    'events',
+    'developed',
+    'failed',
+    'skipped',
+    'overflows',
+    'pending',
+    'queued',
+    'max_queued',
+    'queue_wait',
+    'latency',
+    'max_latency',
+])
+"""
+Counters for a :class:`Watcher`.
+
+`events` is the number of completed writes seen, `developed`, `failed` and
+`skipped` (not raw files) count the files handled so far, and `overflows`
+counts the times the kernel's event queue overflowed (and events were lost,
+so the tree was rescanned).
+
+`pending` files are waiting to go quiet, and `queued` files have been
+dispatched but are waiting for a worker (`max_queued` is the deepest the queue
+has been). `queue_wait` is the average number of seconds files spent queued,
+and `latency` and `max_latency` are the average and largest number of seconds
+from a file's last write to its handler returning.
+"""
+
+# From <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# struct inotify_event, which is followed by `len` bytes of NUL padded name.
+_EVENT = struct.Struct('iIII')
+
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _inotify():
+    """Load the inotify functions from the C library."""
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+def _parse_events(buffer):
+    """Yield ``(wd, mask, cookie, name)`` for each event in a buffer."""
+    offset = 0
+    while offset + _EVENT.size <= len(buffer):
+        wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+        offset += _EVENT.size
+        name = buffer[offset:offset + length].rstrip(b'\x00')
+        offset += length
+        yield wd, mask, cookie, name
+
+
+class Watcher(object):
+
+    """
+    Watches a directory tree and runs a function on every raw file written to
+    it.
+
+    The handler is called with the path of each file (as :class:`bytes`) on a
+    pool of worker threads. Exceptions raised by the handler are counted (see
+    :attr:`stats`) and passed to `on_error`, and never stop the watcher.
+
+    Leaving the context manager (or calling :func:`stop`) stops watching,
+    dispatches any files which are still waiting to go quiet and waits for
+    the workers to finish.
+
+    Args:
+        path (str): The directory to watch.
+        handler (callable): Called with the path of each new raw file.
+        recursive (bool): Also watch subdirectories, including ones created
+                          while watching.
+        include (list): Only consider files whose names match one of these
+                        glob patterns.
+        exclude (list): Ignore files and directories whose names match one of
+                        these glob patterns.
+        debounce (float): The number of seconds a file must go without being
+                          written before it is dispatched.
+        workers (int): The number of worker threads. By default, one per CPU.
+        on_error (callable): Called with the path and the exception when the
+                             handler fails.
+        state_file (str): Where to keep the state of the tree between scans
+                          (see :func:`rawkit.util.rescan`). The tree is
+                          scanned when watching starts, and again whenever
+                          events are lost. If the file was left by an earlier
+                          run, raw files which changed since are dispatched.
+                          By default, a temporary file which is removed when
+                          watching stops.
+
+    Returns:
+        Watcher: A watcher.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+
+    def __init__(self, path, handler, recursive=True, include=None,
+                 exclude=None, debounce=0.5, workers=None, on_error=None,
+                 state_file=None):
+        """Set up the watcher (call :func:`start` or :func:`run` to watch)."""
+        self.path = os.path.abspath(os.fsencode(path))
+        self.handler = handler
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.workers = workers or os.cpu_count() or 1
+        self.on_error = on_error
+        self.state_file = state_file
+        self._libc = _inotify()
+        self._fd = None
+        self._wake = None
+        self._thread = None
+        self._stopping = False
+        self._executor = None
+        self._confirmer = None
+        self._state_dir = None
+        # Watch descriptors to directories, and files to their deadlines.
+        self._directories = {}
+        self._due = {}
+        # Files seen arriving since the last scan (and not since removed),
+        # to their mtimes.
+        self._seen = {}
+        # The thread rescanning the tree after events were lost, and whether
+        # more were lost since it started.
+        self._recovering = None
+        self._rescan_again = False
+        self._lock = threading.Lock()
+        self._events = 0
+        self._developed = 0
+        self._failed = 0
+        self._skipped = 0
+        self._overflows = 0
+        self._queued = 0
+        self._max_queued = 0
+        self._started = 0
+        self._queue_wait = 0.0
+        self._finished = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+
+    def __enter__(self):
+        """Start watching in the background."""
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop watching and wait for the workers."""
+        self.stop()
+
+    @property
+    def stats(self):
+        """
+        The watcher's counters.
+
+        Returns:
+            rawkit.watch.WatchStats: Counts, queue depth and latencies.
+        """
+        with self._lock:
+            return WatchStats(
+                events=self._events,
+                developed=self._developed,
+                failed=self._failed,
+                skipped=self._skipped,
+                overflows=self._overflows,
+                pending=len(self._due),
+                queued=self._queued,
+                max_queued=self._max_queued,
+                queue_wait=self._queue_wait / (self._started or 1),
+                latency=self._latency / (self._finished or 1),
+                max_latency=self._max_latency,
+            )
+
+    def start(self):
+        """
+        Start watching on a background thread.
+
+        Returns:
+            Watcher: The watcher.
+
+        Raises:
+            OSError: If the directory can't be watched.
+        """
+        self._open()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def run(self):
+        """
+        Watch in the current thread until :func:`stop` is called (for instance
+        from a signal handler or another thread).
+        """
+        self._open()
+        try:
+            while not self._stopping:
+                timeout = None
+                if self._due:
+                    timeout = max(
+                        min(self._due.values()) - time.monotonic(), 0)
+                readable, _, _ = select.select(
+                    [self._fd, self._wake[0]], [], [], timeout)
+                if self._fd in readable:
+                    self._read()
+                if self._wake[0] in readable:
+                    os.read(self._wake[0], 64)
+                self._dispatch(time.monotonic())
+        finally:
+            self._close()
+
+    def stop(self):
+        """Stop watching, and wait for files already seen to be handled."""
+        self._stopping = True
+        if self._wake is not None:
+            os.write(self._wake[1], b'\x00')
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+            self._thread = None
+
+    def _open(self):
+        if self._fd is not None:
+            return
+        self._stopping = False
+        self._fd = _check(self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC))
+        self._wake = os.pipe()
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._confirmer = _Confirmer()
+        try:
+            self._directories[_check(self._libc.inotify_add_watch(
+                self._fd, self.path, self._mask()))] = self.path
+            self._watch_tree(self.path)
+            # The first scan only records what is already there, but
+            # changes since an earlier run's scan are dispatched.
+            resumed = (self.state_file is not None and
+                       os.path.exists(self.state_file))
+            diff = self._rescan()
+            if resumed:
+                self._schedule_changes(diff, {})
+        except BaseException:
+            self._close()
+            raise
+
+    def _close(self):
+        # Let a rescan which is under way finish, and don't lose files which
+        # were written but hadn't gone quiet yet.
+        recovering = self._recovering
+        if recovering is not None:
+            recovering.join()
+        self._dispatch(float('inf'))
+        self._executor.shutdown(wait=True)
+        self._confirmer.__exit__(None, None, None)
+        os.close(self._fd)
+        for fd in self._wake:
+            os.close(fd)
+        self._fd = self._wake = None
+        self._directories = {}
+        self._seen = {}
+        if self._state_dir is not None:
+            shutil.rmtree(self._state_dir, ignore_errors=True)
+            self._state_dir = None
+
+    def _mask(self):
+        mask = (_IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_DELETE |
+                _IN_ONLYDIR)
+        return mask | _IN_CREATE if self.recursive else mask
+
+    def _watch_tree(self, directory, schedule=False):
+        """Watch a directory (and its subdirectories, if recursive)."""
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            wd = self._libc.inotify_add_watch(self._fd, current, self._mask())
+            if wd < 0:
+                # Probably removed already.
+                continue
+            self._directories[wd] = current
+            if not self.recursive:
+                break
+            # The directory is only listed once it's watched, so anything
+            # created in it is caught by one or the other (or both).
+            try:
+                entries = list(os.scandir(current))
+            except OSError:
+                continue
+            if schedule:
+                # Files may have been written before the watch was added.
+                for entry in entries:
+                    if not entry.is_dir():
+                        self._schedule(entry.path, entry.name)
+            pending.extend(
+                entry.path for entry in entries
+                if entry.is_dir(follow_symlinks=False) and
+                not (self.exclude and
+                     _matches(os.fsdecode(entry.name), self.exclude)))
+
+    def _read(self):
+        try:
+            buffer = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        for wd, mask, _, name in _parse_events(buffer):
+            if mask & _IN_Q_OVERFLOW:
+                with self._lock:
+                    self._overflows += 1
+                self._start_recovery()
+                continue
+            if mask & _IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & (_IN_DELETE | _IN_MOVED_FROM):
+                with self._lock:
+                    self._seen.pop(path, None)
+                continue
+            if mask & _IN_ISDIR:
+                if (self.recursive and
+                        mask & (_IN_CREATE | _IN_MOVED_TO) and
+                        not (self.exclude and
+                             _matches(os.fsdecode(name), self.exclude))):
+                    self._watch_tree(path, schedule=True)
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                self._schedule(path, name)
+
+    def _rescan(self):
+        """Scan the tree for raw files changed since the last scan."""
+        state_file = self.state_file
+        if state_file is None:
+            if self._state_dir is None:
+                self._state_dir = tempfile.mkdtemp()
+            state_file = os.path.join(self._state_dir, 'scan.json')
+        return rescan(
+            self.path, state_file, include=self.include, exclude=self.exclude,
+            max_depth=None if self.recursive else 0, verify=True,
+            workers=self.workers)
+
+    def _start_recovery(self):
+        """
+        Rescan the tree on another thread, so that events keep being read
+        (and don't overflow again) while it runs.
+        """
+        with self._lock:
+            if self._recovering is not None:
+                # The scan under way may already have passed these files.
+                self._rescan_again = True
+                return
+            self._recovering = threading.Thread(target=self._recover)
+            self._recovering.daemon = True
+            self._recovering.start()
+
+    def _recover(self):
+        """Find the files whose events were lost, and schedule them."""
+        try:
+            while True:
+                with self._lock:
+                    self._rescan_again = False
+                    seen, self._seen = self._seen, {}
+                self._schedule_changes(self._rescan(), seen)
+                with self._lock:
+                    if not self._rescan_again or self._stopping:
+                        break
+        finally:
+            with self._lock:
+                self._recovering = None
+            # Have the watching thread dispatch them.
+            os.write(self._wake[1], b'\x00')
+
+    def _schedule_changes(self, diff, seen):
+        """
+        Schedule the files a scan found, unless they were already seen
+        arriving (before or during the scan) and haven't changed since.
+        """
+        for path in diff.added + diff.modified:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            with self._lock:
+                arrived = self._seen.get(path)
+            if mtime not in (seen.get(path), arrived):
+                self._schedule(path, os.path.basename(path))
+
+    def _schedule(self, path, name):
+        name = os.fsdecode(name)
+        if self.exclude and _matches(name, self.exclude):
+            return
+        if self.include and not _matches(name, self.include):
+            return
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime is not None:
+                self._seen[path] = mtime
+            self._events += 1
+            self._due[path] = time.monotonic() + self.debounce
+
+    def _dispatch(self, now):
+        """Hand every file which has gone quiet to the workers."""
+        with self._lock:
+            ready = [path for path, due in self._due.items() if due <= now]
+            for path in ready:
+                written = self._due.pop(path) - self.debounce
+                self._executor.submit(
+                    self._process, path, written, time.monotonic())
+                self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+
+    def _process(self, path, written, dispatched):
+        started = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            self._started += 1
+            self._queue_wait += started - dispatched
+
+        try:
+            if self._confirmer.check(path) is None:
+                with self._lock:
+                    self._skipped += 1
+                return
+            self.handler(path)
+        except Exception as e:
+            with self._lock:
+                self._failed += 1
+            if self.on_error is not None:
+                self.on_error(path, e)
+            return
+
+        latency = time.monotonic() - written
+        with self._lock:
+            self._developed += 1
+            self._finished += 1
+            self._latency += latency
+            self._max_latency = max(self._max_latency, latency)
@@ -0,0 +1,501 @@
+""":mod:`rawkit.writers` --- Image writers
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Writers that work on developed images (see :class:`rawkit.raw.ProcessedImage`)
+rather than on the LibRaw handle.
+
+The floating point writers convert the integer image a few rows at a time and
+stream them to disk, so the full size floating point image (which is two to
+four times the size of the developed image) never has to exist in memory.
+
+:class:`AsyncWriter` runs any of these writers on a background thread pool so
+that encoding and disk I/O overlap with developing the next image:
+
+.. sourcecode:: python
+
+    from rawkit.raw import Raw
+    from rawkit.writers import AsyncWriter
+
+    with AsyncWriter(workers=2) as writer:
+        for src, dest in jobs:
+            with Raw(filename=src) as raw:
+                writer.submit(raw.to_image(), dest)
+"""
+
+import array
+import io
+import os
+import sys
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from rawkit.errors import InvalidFileType
+from rawkit.errors import NoFileSpecified
+from rawkit.tiff import _open_output
+from rawkit.tiff import write_tiff
+
+# Rows converted to floating point per write.
+_CHUNK_ROWS = 256
+
+pillow_file_types = namedtuple(
+    'PillowFileType', ['jpeg', 'png']
+)('jpeg', 'png')
+"""
+Constants for file types that are encoded with Pillow (which must be
+installed to use them). These are always written with 8 bits per sample.
+
+  - ``jpeg`` --- JPEG file.
+  - ``png`` --- PNG file.
+"""
+
+# Extensions which don't match the name of their file type.
+_EXTENSIONS = {
+    'jpg': pillow_file_types.jpeg,
+    'tif': 'tiff',
+}
+
+
+def _image_array(image):
+    """Get a (height, width, colors) NumPy view of a processed image."""
+    import numpy
+
+    dtype = numpy.uint8 if image.bits == 8 else numpy.uint16
+    return numpy.frombuffer(image.data, dtype=dtype).reshape(
+        image.height, image.width, image.colors
+    )
+
+
+def float_chunks(image, dtype='float32', reverse=False):
+    """
+    Convert a processed image to floating point a few rows at a time.
+
+    Samples are normalized so that ``1.0`` is the largest value representable
+    at the image's bit depth.
+
+    Args:
+        image (rawkit.raw.ProcessedImage): The image to convert.
+        dtype (str): A NumPy floating point dtype.
+        reverse (boolean): Yield chunks (and the rows in each chunk) from the
+                           bottom of the image to the top.
+
+    Yields:
+        tuple: ``(first_row, array)`` pairs.
+    """
+    import numpy
+
+    pixels = _image_array(image)
+    scale = numpy.dtype(dtype).type(1.0 / ((1 << image.bits) - 1))
+    starts = range(0, image.height, _CHUNK_ROWS)
+    if reverse:
+        starts = reversed(starts)
+    for start in starts:
+        rows = pixels[start:start + _CHUNK_ROWS]
+        if reverse:
+            rows = rows[::-1]
+        chunk = rows.astype(dtype)
+        chunk *= scale
+        yield start, chunk
+
+
+def write_npy(filename, image, dtype='float32'):
+    """
+    Write a processed image as a floating point NumPy ``.npy`` file of shape
+    ``(height, width, colors)``.
+
+    Args:
+        filename (str): The file to write, or a binary file object.
+        image (rawkit.raw.ProcessedImage): The image to write.
+        dtype (str): A NumPy floating point dtype.
+    """
+    import numpy
+
+    header = {
+        'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)),
+        'fortran_order': False,
+        'shape': (image.height, image.width, image.colors),
+    }
+    with _open_output(filename) as f:
+        numpy.lib.format.write_array_header_1_0(f, header)
+        for _, chunk in float_chunks(image, dtype):
+            f.write(chunk.tobytes())
+
+
+def write_pfm(filename, image):
+    """
+    Write a processed image as a Portable Float Map (little endian, 32-bit
+    floating point).
+
+    Args:
+        filename (str): The file to write, or a binary file object.
+        image (rawkit.raw.ProcessedImage): The image to write. Must have one
+                                           or three colors.
+
+    Raises:
+        ValueError: If the image has an unsupported number of colors.
+    """
+    if image.colors not in (1, 3):
+        raise ValueError("PFM files must have 1 or 3 colors")
+
+    header = '{magic}\n{width} {height}\n-1.0\n'.format(
+        magic='PF' if image.colors == 3 else 'Pf',
+        width=image.width,
+        height=image.height,
+    )
+    with _open_output(filename) as f:
+        f.write(header.encode('ascii'))
+        # PFM scanlines are stored from the bottom of the image to the top.
+        for _, chunk in float_chunks(image, '<f4', reverse=True):
+            f.write(chunk.tobytes())
+
+
+def to_8_bit(image):
+    """
+    Reduce a processed image to 8 bits per sample.
+
+    LibRaw's 8-bit output is its 16-bit output with the low byte dropped, so
+    this gives the same result as developing with ``bps = 8``.
+
+    Args:
+        image (rawkit.raw.ProcessedImage): The image to convert.
+
+    Returns:
+        rawkit.raw.ProcessedImage: An 8-bit image.
+    """
+    if image.bits == 8:
+        return image
+    import numpy
+
+    pixels = _image_array(image) >> 8
+    return image._replace(
+        bits=8, data=bytearray(pixels.astype(numpy.uint8).tobytes()))
+
+
+def resize(image, size):
+    """
+    Scale a processed image down so that its longest edge is at most `size`
+    pixels, preserving the aspect ratio. Requires Pillow.
+
+    Args:
+        image (rawkit.raw.ProcessedImage): The image to scale.
+        size (int): The maximum length of the longest edge.
+
+    Returns:
+        rawkit.raw.ProcessedImage: The scaled image (or `image` itself if it
+                                   is already small enough).
+    """
+    longest = max(image.width, image.height)
+    if size is None or longest <= size:
+        return image
+
+    import numpy
+    from PIL import Image
+
+    width = max(1, int(round(image.width * size / float(longest))))
+    height = max(1, int(round(image.height * size / float(longest))))
+    pixels = _image_array(image)
+
+    if image.bits == 8 and image.colors in (1, 3):
+        source = pixels[:, :, 0] if image.colors == 1 else pixels
+        scaled = numpy.asarray(
+            Image.fromarray(source).resize((width, height), Image.LANCZOS)
+        ).reshape(height, width, image.colors)
+    else:
+        # Pillow has no multi-channel 16-bit mode, so scale each channel as
+        # a floating point image.
+        channels = [
+            numpy.asarray(
+                Image.fromarray(pixels[:, :, c].astype(numpy.float32))
+                .resize((width, height), Image.LANCZOS)
+            )
+            for c in range(image.colors)
+        ]
+        limit = (1 << image.bits) - 1
+        scaled = numpy.clip(numpy.rint(numpy.dstack(channels)), 0, limit)
+        scaled = scaled.astype(pixels.dtype)
+
+    return image._replace(
+        width=width,
+        height=height,
+        data=bytearray(numpy.ascontiguousarray(scaled).tobytes()),
+    )
+
+
+def write_pillow(filename, image, filetype, **kwargs):
+    """
+    Encode a processed image with Pillow. 16-bit images are reduced to 8 bits
+    per sample first.
+
+    Args:
+        filename (str): The file to write, or a binary file object.
+        image (rawkit.raw.ProcessedImage): The image to write. Must have one
+                                           or three colors.
+        filetype (pillow_file_types): The type of file to write.
+        kwargs: Extra arguments for Pillow's ``Image.save`` (eg. `quality`).
+
+    Raises:
+        ValueError: If the image has an unsupported number of colors.
+    """
+    from PIL import Image
+
+    if image.colors not in (1, 3):
+        raise ValueError("Pillow images must have 1 or 3 colors")
+
+    image = to_8_bit(image)
+    Image.frombuffer(
+        'RGB' if image.colors == 3 else 'L',
+        (image.width, image.height),
+        bytes(image.data),
+        'raw',
+    ).save(filename, format=filetype.upper(), **kwargs)
+
+
+def write_ppm(filename, image):
+    """
+    Write a processed image as a binary PPM (or PGM for single color images),
+    matching the output of LibRaw's own writer.
+
+    Args:
+        filename (str): The file to write, or a binary file object.
+        image (rawkit.raw.ProcessedImage): The image to write. Must have one
+                                           or three colors.
+
+    Raises:
+        ValueError: If the image has an unsupported number of colors.
+    """
+    if image.colors not in (1, 3):
+        raise ValueError("PPM files must have 1 or 3 colors")
+
+    header = '{magic}\n{width} {height}\n{maxval}\n'.format(
+        magic='P6' if image.colors == 3 else 'P5',
+        width=image.width,
+        height=image.height,
+        maxval=(1 << image.bits) - 1,
+    )
+    data = image.data
+    if image.bits == 16 and sys.byteorder == 'little':
+        # Netpbm stores 16-bit samples most significant byte first.
+        data = array.array('H', bytes(data))
+        data.byteswap()
+    with _open_output(filename) as f:
+        f.write(header.encode('ascii'))
+        f.write(data)
+
+
+def image_filetype(filename, filetype=None):
+    """
+    Work out which file type :func:`write_image` will write.
+
+    Args:
+        filename (str): The file to write.
+        filetype (str): An explicit file type, or None to guess one from the
+                        file extension (falling back to PPM).
+
+    Returns:
+        str: A member of :class:`rawkit.raw.output_file_types` or
+             :data:`pillow_file_types`.
+
+    Raises:
+        rawkit.errors.InvalidFileType: If the file type is not supported.
+    """
+    from rawkit.raw import output_file_types
+
+    if filetype is None:
+        ext = os.path.splitext(filename)[-1].lower()[1:]
+        filetype = _EXTENSIONS.get(ext, ext) or output_file_types.ppm
+
+    if filetype not in output_file_types + pillow_file_types:
+        raise InvalidFileType(
+            "Output filetype must be in raw.output_file_types or "
+            "writers.pillow_file_types")
+    return filetype
+
+
+def write_image(filename, image, filetype=None, **kwargs):
+    """
+    Write a processed image in any of the
+    :class:`rawkit.raw.output_file_types` or :data:`pillow_file_types`.
+
+    Args:
+        filename (str): The file to write, or a binary file object.
+        image (rawkit.raw.ProcessedImage): The image to write.
+        filetype (output_file_types): The type of file to output. By default,
+                                      guess based on the filename, falling
+                                      back to PPM. Required when writing to
+                                      a file object.
+        kwargs: Extra arguments for :func:`rawkit.tiff.write_tiff` or
+                :func:`write_pillow`.
+
+    Raises:
+        rawkit.errors.NoFileSpecified: If `filename` is ``None``.
+        rawkit.errors.InvalidFileType: If `filetype` is not None or a
+                                       supported file type.
+    """
+    from rawkit.raw import output_file_types
+
+    if filename is None:
+        raise NoFileSpecified()
+
+    filetype = image_filetype(filename, filetype)
+
+    if filetype in pillow_file_types:
+        write_pillow(filename, image, filetype, **kwargs)
+    elif filetype == output_file_types.tiff:
+        write_tiff(
+            filename,
+            image.data,
+            image.width,
+            image.height,
+            colors=image.colors,
+            bits=image.bits,
+            **kwargs
+        )
+    elif filetype == output_file_types.npy:
+        write_npy(filename, image)
+    elif filetype == output_file_types.pfm:
+        write_pfm(filename, image)
+    else:
+        write_ppm(filename, image)
+
+
+def encode_image(image, filetype, **kwargs):
+    """
+    Encode a processed image in memory, as :func:`write_image` would write
+    it.
+
+    Args:
+        image (rawkit.raw.ProcessedImage): The image to encode.
+        filetype (output_file_types): The type of file to encode.
+        kwargs: Extra arguments for :func:`rawkit.tiff.write_tiff` or
+                :func:`write_pillow`.
+
+    Returns:
+        bytes: The encoded file.
+
+    Raises:
+        rawkit.errors.InvalidFileType: If `filetype` is not a supported file
+                                       type.
+    """
+    output = io.BytesIO()
+    write_image(output, image, filetype, **kwargs)
+    return output.getvalue()
+
+
+class AsyncWriter(object):
+
+    """
+    A write-behind queue which encodes and writes developed images on a
+    bounded pool of background threads.
+
+    :func:`submit` blocks once `max_pending` images are queued or being
+    written, which bounds the memory held by developed images that have not
+    been written yet. Leaving the context manager waits for all pending writes
+    to finish.
+
+    Args:
+        workers (int): The number of writer threads.
+        max_pending (int): The maximum number of images that may be queued or
+                           in the process of being written. Defaults to twice
+                           the number of workers.
+
+    Returns:
+        AsyncWriter: A writer.
+    """
+
+    def __init__(self, workers=2, max_pending=None):
+        """Start the writer's thread pool."""
+        self._executor = ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failed = []
+
+    def __enter__(self):
+        """Return the writer for use in context managers."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Wait for pending writes and shut down. If the body of the ``with``
+        statement succeeded but a write failed, the first write error is
+        raised.
+        """
+        self.close()
+        if exc_type is None and self._failed:
+            raise self._failed[0].exception()
+
+    def submit(self, image, filename, filetype=None, **kwargs):
+        """
+        Queue an image to be written, blocking while the queue is full.
+
+        Args:
+            image (rawkit.raw.ProcessedImage): The image to write.
+            filename (str): The file to write.
+            filetype (output_file_types): The type of file to output.
+            kwargs: Extra arguments for :func:`write_image`.
+
+        Returns:
+            concurrent.futures.Future: A future which resolves once the image
+                                       has been written, or holds the error
+                                       raised while writing it.
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                write_image, filename, image, filetype, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _record(self, future):
+        # Called by both the done callback and flush(), whichever sees the
+        # finished future first.
+        with self._lock:
+            self._pending.discard(future)
+            if (not future.cancelled() and future.exception() is not None and
+                    future not in self._failed):
+                self._failed.append(future)
+
+    def _done(self, future):
+        self._record(future)
+        self._slots.release()
+
+    @property
+    def pending(self):
+        """
+        The number of images which are queued or being written.
+
+        Returns:
+            int: The number of pending writes.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Wait until every image submitted so far has been written.
+
+        Returns:
+            list: Futures for the writes which have failed so far.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass
+            # The done callback may not have run yet.
+            self._record(future)
+        with self._lock:
+            return list(self._failed)
+
+    def close(self):
+        """Wait for pending writes and shut down the thread pool."""
+        self.flush()
+        self._executor.shutdown(wait=True)
@@ -22,12 +22,9 @@ setup(
     keywords=['encoding', 'images', 'photography', 'libraw', 'raw', 'photos'],
     classifiers=[
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: Implementation :: PyPy",
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
@@ -36,5 +33,6 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     long_description=readme(),
+    python_requires='>=3.8',
     extras_require={'doc': ['sphinx >= 1.3']},
 )
@@ -0,0 +1,213 @@
+import asyncio
+import threading
+import time
+
+import mock
+import pytest
+
+from rawkit import aio
+from rawkit.thumbnail import Thumbnail
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.yield_fixture
+def executor():
+    executor = aio.LibRawExecutor(workers=2, max_concurrency=1)
+    yield executor
+    executor.shutdown()
+
+
+def test_run(executor):
+    assert run(executor.run(divmod, 7, 2)) == (3, 1)
+    with pytest.raises(ZeroDivisionError):
+        run(executor.run(divmod, 1, 0))
+
+    stats = executor.stats
+    assert stats.submitted == 2
+    assert stats.completed == stats.failed == 1
+    assert stats.waiting == stats.running == stats.cancelled == 0
+    assert stats.service_time <= stats.max_service_time
+
+
+def test_run_bounded(executor):
+    release = threading.Event()
+
+    async def main():
+        first = asyncio.ensure_future(executor.run(release.wait))
+        second = asyncio.ensure_future(executor.run(lambda: 'second'))
+        # Let both calls be queued before timing how long the second waits.
+        await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        # Only one call may run at a time.
+        assert executor.stats.running == 1
+        assert executor.stats.waiting == 1
+        release.set()
+        return await asyncio.gather(first, second)
+
+    assert run(main()) == [True, 'second']
+    assert executor.stats.max_queue_wait >= 0.05
+
+
+def test_run_cancel_waiting(executor):
+    release = threading.Event()
+    called = mock.Mock()
+
+    async def main():
+        first = asyncio.ensure_future(executor.run(release.wait))
+        second = asyncio.ensure_future(executor.run(called))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await second
+
+    run(main())
+    assert not called.called
+    assert executor.stats.cancelled == 1
+
+
+def test_run_cancel_running(executor):
+    stop = threading.Event()
+    discard = mock.Mock()
+
+    def work():
+        stop.wait()
+        return 'result'
+
+    async def main():
+        task = asyncio.ensure_future(
+            executor.run(work, cancel=stop.set, discard=discard))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The slot was held until the thread stopped.
+        assert executor.stats.running == 0
+
+    run(main())
+    discard.assert_called_once_with('result')
+    assert executor.stats.cancelled == 1
+
+
+def test_run_cancel_running_without_callback(executor):
+    async def main():
+        task = asyncio.ensure_future(executor.run(time.sleep, 0.05))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert executor.stats.running == 0
+
+    run(main())
+    assert executor.stats.cancelled == 1
+
+
+def test_default_executor(monkeypatch):
+    monkeypatch.setattr(aio, '_default_executor', None)
+    executor = aio.default_executor()
+    try:
+        assert isinstance(executor, aio.LibRawExecutor)
+        assert aio.default_executor() is executor
+    finally:
+        executor.shutdown()
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        libraw.return_value = libraw
+        yield libraw
+
+
+def test_open(libraw, executor):
+    async def main():
+        async with await aio.open('a.CR2', executor=executor) as raw:
+            assert isinstance(raw, aio.AsyncRaw)
+            with mock.patch.object(raw.raw, 'to_buffer',
+                                   return_value=b'rgb') as to_buffer:
+                assert await raw.to_buffer() == b'rgb'
+            to_buffer.assert_called_once_with()
+            with mock.patch.object(raw.raw, 'to_array',
+                                   return_value='array') as to_array:
+                assert await raw.to_array('float64') == 'array'
+            to_array.assert_called_once_with('float64', True)
+            with mock.patch('rawkit.raw.Raw.metadata', 'metadata'):
+                assert raw.metadata == 'metadata'
+            return raw
+
+    raw = run(main())
+    libraw.libraw_open_file.assert_called_once_with(
+        raw.raw.data, b'a.CR2')
+    libraw.libraw_set_progress_handler.assert_called_once_with(
+        raw.raw.data, raw._progress, None)
+    libraw.libraw_close.assert_called_once_with(raw.raw.data)
+
+
+def test_thumbnail(libraw, executor):
+    thumb = Thumbnail(format=1, width=2, height=1, colors=3,
+                      data=memoryview(b'jpeg'))
+
+    async def main():
+        async with await aio.open('a.CR2', executor=executor) as raw:
+            with mock.patch.object(raw.raw, 'thumbnail', return_value=thumb):
+                return await raw.thumbnail()
+
+    assert run(main()) == thumb._replace(data=b'jpeg')
+
+
+def test_cancel_aborts_libraw(libraw, executor):
+    started = threading.Event()
+
+    async def main():
+        raw = await aio.open('a.CR2', executor=executor)
+
+        def process(*args):
+            # Stand in for LibRaw, which polls the progress callback.
+            started.set()
+            while not raw._check_abort(None, 0, 0, 1):
+                pass
+            raise RuntimeError('canceled by callback')
+
+        with mock.patch.object(raw.raw, 'save', side_effect=process):
+            task = asyncio.ensure_future(raw.save('out.tiff'))
+            await asyncio.get_event_loop().run_in_executor(
+                None, started.wait)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        # The next call isn't aborted.
+        assert raw._check_abort(None, 0, 0, 1) == 1
+        with mock.patch.object(raw.raw, 'to_buffer', return_value=b''):
+            await raw.to_buffer()
+        assert raw._check_abort(None, 0, 0, 1) == 0
+        await raw.close()
+
+    run(main())
+
+
+def test_close_unused(libraw, executor):
+    async def main():
+        raw = await aio.open('a.CR2', executor=executor)
+        await raw.close()
+        return raw
+
+    raw = run(main())
+    libraw.libraw_close.assert_called_once_with(raw.raw.data)
+
+
+def test_open_fails(libraw, executor):
+    libraw.libraw_set_progress_handler.side_effect = ValueError
+    with pytest.raises(ValueError):
+        run(aio.open('a.CR2', executor=executor))
+    # The raw which was opened isn't leaked.
+    libraw.libraw_close.assert_called_once_with(
+        libraw.libraw_init.return_value)
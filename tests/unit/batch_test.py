@@ -0,0 +1,306 @@
+import ctypes
+import multiprocessing
+import os
+import threading
+import time
+
+import mock
+import pytest
+
+from libraw import structs_19
+from libraw.errors import FileUnsupported, InsufficientMemory
+from rawkit import batch
+from rawkit import shm
+from rawkit.options import Options
+
+
+def libraw_data(width=4000, height=3000, filters=0x94949494):
+    data = structs_19.libraw_data_t()
+    data.sizes.raw_width = data.sizes.width = width
+    data.sizes.raw_height = data.sizes.height = height
+    data.idata.filters = filters
+    return ctypes.pointer(data)
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.batch.LibRaw') as libraw:
+        libraw.return_value = libraw
+        libraw.libraw_init.side_effect = lambda flags: libraw_data()
+
+        def open_file(data, path):
+            if b'bad' in path:
+                raise FileUnsupported()
+        libraw.libraw_open_file.side_effect = open_file
+        yield libraw
+
+
+@pytest.fixture
+def photos(tmpdir):
+    paths = []
+    for name in ('a.CR2', 'bad.CR2', 'c.NEF'):
+        tmpdir.join(name).write_binary(b'II*\x00')
+        paths.append(str(tmpdir.join(name)))
+    return paths
+
+
+def test_output_name():
+    assert batch.output_name(
+        '{dir}/out/{stem}-{index}.{ext}.tiff', b'/photos/a.CR2', 3
+    ) == '/photos/out/a-3.CR2.tiff'
+    assert batch.output_name('{dir}/{name}.ppm', 'a.CR2') == './a.CR2.ppm'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_develop(libraw, photos, tmpdir, workers):
+    progress = mock.Mock()
+    options = Options({'half_size': True})
+    results = list(batch.develop(
+        photos, options, str(tmpdir.join('out', '{stem}.tiff')),
+        workers=workers, progress=progress))
+
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.path for r in results] == photos
+    good = [r for r in results if r.error is None]
+    assert [os.path.basename(r.output) for r in good] == ['a.tiff', 'c.tiff']
+    assert all(os.path.exists(r.output) for r in good)
+    assert isinstance(results[1].error, FileUnsupported)
+    # Nothing is left behind for the file which failed.
+    assert sorted(tmpdir.join('out').listdir()) == [
+        tmpdir.join('out', 'a.tiff'), tmpdir.join('out', 'c.tiff')]
+    assert progress.call_args_list == [
+        mock.call(1, 3), mock.call(2, 3), mock.call(3, 3)]
+
+
+def test_develop_unordered(libraw, photos, tmpdir):
+    results = batch.develop(
+        photos, None, str(tmpdir.join('{stem}.ppm')), workers=2,
+        ordered=False, chunksize=1, max_tasks_per_worker=1)
+    assert sorted(r.index for r in results) == [0, 1, 2]
+
+
+def test_develop_in_process(libraw, photos, tmpdir):
+    options = Options({'half_size': True})
+    list(batch.develop(photos, options, str(tmpdir.join('{stem}.ppm')),
+                       workers=1))
+    # The library is loaded once for the whole batch, and the options are
+    # rebuilt from their frozen form.
+    libraw.assert_called_once_with()
+    assert batch._worker_libraw is None
+    assert batch._worker_options is None
+
+
+def test_develop_default_workers(libraw, photos, tmpdir):
+    with mock.patch.object(os, 'cpu_count', return_value=None):
+        results = list(batch.develop(photos, None,
+                                     str(tmpdir.join('{stem}.ppm'))))
+    assert [r.error is None for r in results] == [True, False, True]
+    # A single worker develops in this process.
+    libraw.assert_called_once_with()
+
+
+def test_develop_stop_early(libraw, photos, tmpdir):
+    pools = []
+    make_pool = multiprocessing.Pool
+
+    def pool(*args, **kwargs):
+        pools.append(mock.Mock(wraps=make_pool(*args, **kwargs)))
+        return pools[-1]
+
+    with mock.patch.object(multiprocessing, 'Pool', side_effect=pool):
+        results = batch.develop(
+            photos * 10, None, str(tmpdir.join('{stem}-{index}.ppm')),
+            workers=2, chunksize=1)
+        next(results)
+        results.close()
+    # Whatever was still running was killed.
+    pools[0].terminate.assert_called_once_with()
+    assert not pools[0].close.called
+
+
+def test_make_parent(tmpdir):
+    directory = tmpdir.join('out')
+
+    def makedirs(path):
+        # Another worker got there first.
+        directory.ensure(dir=True)
+        raise FileExistsError()
+    with mock.patch.object(os, 'makedirs', side_effect=makedirs):
+        batch._make_parent(str(directory.join('a.tiff')))
+    assert directory.check(dir=True)
+
+    with mock.patch.object(os, 'makedirs', side_effect=PermissionError):
+        with pytest.raises(PermissionError):
+            batch._make_parent(str(tmpdir.join('other', 'a.tiff')))
+
+
+def test_portable():
+    class Unpicklable(Exception):
+        def __init__(self, a, b):
+            super(Unpicklable, self).__init__(a)
+
+    error = batch._portable(Unpicklable('oops', 2))
+    assert isinstance(error, RuntimeError)
+    assert str(error) == 'Unpicklable: oops'
+
+    error = FileUnsupported('nope')
+    assert batch._portable(error) is error
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_develop_threaded(libraw, photos, tmpdir, ordered):
+    progress = mock.Mock()
+    results = list(batch.develop_threaded(
+        photos * 4, Options({'half_size': True}),
+        str(tmpdir.join('out', '{stem}-{index}.tiff')), workers=3,
+        ordered=ordered, progress=progress))
+
+    indexes = [r.index for r in results]
+    assert sorted(indexes) == list(range(12))
+    if ordered:
+        assert indexes == list(range(12))
+    assert [isinstance(r.error, FileUnsupported) for r in sorted(
+        results, key=lambda r: r.index)] == [False, True, False] * 4
+    assert len(tmpdir.join('out').listdir()) == 8
+    assert progress.call_count == 12
+    # The thread safe build is checked for, then each thread loads it once.
+    assert 2 <= libraw.call_count <= 4
+    assert libraw.call_args_list[0] == mock.call(reentrant=True)
+
+
+def test_develop_threaded_not_reentrant(libraw, photos, tmpdir):
+    def load(reentrant=False):
+        if reentrant:
+            raise ImportError('Cannot find LibRaw on your system!')
+        return libraw
+    libraw.side_effect = load
+
+    with pytest.warns(UserWarning):
+        results = list(batch.develop_threaded(
+            photos * 4, None, str(tmpdir.join('{stem}-{index}.ppm')),
+            workers=3))
+
+    assert len(results) == 12
+    # Only one thread used (the regular build of) LibRaw.
+    assert libraw.call_args_list == [
+        mock.call(reentrant=True), mock.call(reentrant=False)]
+
+
+def test_develop_threaded_stop_early(libraw, photos, tmpdir):
+    results = batch.develop_threaded(
+        photos * 10, None, str(tmpdir.join('{stem}-{index}.ppm')), workers=1)
+    next(results)
+    results.close()
+    # Files which hadn't started yet were cancelled.
+    assert len(tmpdir.listdir(lambda p: p.ext == '.ppm')) < 20
+
+
+def test_estimate_memory():
+    raw = mock.Mock(data=libraw_data(4000, 3000), options=Options())
+    base = batch._BASE_MEMORY
+    # Raw data, the working image and interpolation, and the 8-bit output.
+    assert batch.estimate_memory(raw) == (
+        4000 * 3000 * 2 + 4000 * 3000 * 16 + 4000 * 3000 * 3 + base)
+    assert batch.estimate_memory(raw, Options({'half_size': True})) == (
+        4000 * 3000 * 2 + 2000 * 1500 * 16 + 2000 * 1500 * 3 + base)
+    assert batch.estimate_memory(raw, Options({'bps': 16})) == (
+        4000 * 3000 * 2 + 4000 * 3000 * 16 + 4000 * 3000 * 6 + base)
+
+    # Without a color filter array, there are four samples per photosite.
+    raw = mock.Mock(data=libraw_data(4000, 3000, filters=0),
+                    options=Options())
+    assert batch.estimate_memory(raw) == (
+        4000 * 3000 * 8 + 4000 * 3000 * 16 + 4000 * 3000 * 3 + base)
+
+
+def acquire_later(budget, size, exclusive=False):
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(size, exclusive)
+        acquired.set()
+    threading.Thread(target=acquire, daemon=True).start()
+    return acquired
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_budget(shared):
+    budget = batch._Budget(100, shared=shared)
+    assert budget.acquire(60) == 60
+    second = acquire_later(budget, 60)
+    assert not second.wait(0.05)
+    assert budget.acquire(40) == 40
+
+    budget.release(60)
+    budget.release(40)
+    assert second.wait(1)
+    budget.release(60)
+
+    # Files bigger than the whole budget run alone.
+    assert budget.acquire(500) == 500
+    assert not acquire_later(budget, 1).wait(0.05)
+    budget.release(500)
+
+
+def test_budget_exclusive():
+    budget = batch._Budget(None)
+    budget.acquire(10)
+    exclusive = acquire_later(budget, 10, exclusive=True)
+    time.sleep(0.02)
+    # Nothing else is admitted while an exclusive job waits or runs.
+    newcomer = acquire_later(budget, 10)
+    assert not exclusive.wait(0.05)
+    budget.release(10)
+    assert exclusive.wait(1)
+    assert not newcomer.wait(0.05)
+    budget.release(batch._EXCLUSIVE)
+    assert newcomer.wait(1)
+
+
+def test_develop_retries_out_of_memory(libraw, photos, tmpdir):
+    failed = set()
+
+    def write(data, path):
+        if os.path.basename(path).startswith(b'.a.CR2') and not failed:
+            failed.add(path)
+            raise InsufficientMemory()
+    libraw.libraw_dcraw_ppm_tiff_writer.side_effect = write
+
+    results = list(batch.develop_threaded(
+        photos, None, str(tmpdir.join('{name}.ppm')), workers=2,
+        memory_budget=1024 ** 3))
+    assert [(r.error is None, r.retried) for r in results] == [
+        (True, True), (False, False), (True, False)]
+    assert results[0].memory == results[2].memory > 1024 ** 2
+    assert results[1].memory is None
+
+
+@pytest.mark.parametrize('workers', [1, 2, 'threads'])
+def test_develop_into_segments(libraw, photos, workers):
+    def image_format(data, *values):
+        for value, size in zip(values, (4, 2, 3, 16)):
+            value.contents.value = size
+    libraw.libraw_get_mem_image_format.side_effect = image_format
+    libraw.libraw_copy_mem_image.side_effect = (
+        lambda data, address, stride, bgr: ctypes.memset(
+            address, 1, stride * 2))
+
+    with shm.SegmentPool() as segments:
+        if workers == 'threads':
+            results = batch.develop_threaded(
+                photos, None, None, workers=2, segments=segments)
+        else:
+            results = batch.develop(
+                photos, None, None, workers=workers, segments=segments)
+        results = sorted(results, key=lambda r: r.index)
+
+        assert isinstance(results[1].error, FileUnsupported)
+        assert results[1].output is None
+        for result in (results[0], results[2]):
+            assert result.error is None
+            assert result.output.shape == (2, 4, 3)
+            assert result.output.dtype == 'uint16'
+            assert bytes(segments.buffer(result.output)) == b'\x01' * 48
+        # Every segment the workers created is owned by the pool.
+        assert segments._names == {
+            results[0].output.name, results[2].output.name}
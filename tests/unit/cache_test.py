@@ -0,0 +1,179 @@
+import os
+import threading
+
+import mock
+import pytest
+
+from rawkit.cache import ThumbnailCache
+
+
+@pytest.fixture
+def source(tmpdir):
+    src = tmpdir.join('image.CR2')
+    src.write('raw data')
+    return str(src)
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ThumbnailCache(str(tmpdir.join('cache')), max_bytes=100)
+
+
+@pytest.yield_fixture
+def raw():
+    with mock.patch('rawkit.cache.Raw') as raw_cls:
+        raw = raw_cls.return_value.__enter__.return_value
+        raw.thumbnail.return_value.to_jpeg.return_value = b'jpeg'
+        yield raw_cls
+
+
+def test_get_miss_then_hit(cache, raw, source):
+    assert cache.get(source, 320) == b'jpeg'
+    raw.assert_called_once_with(filename=source)
+    to_jpeg = raw.return_value.__enter__.return_value.thumbnail().to_jpeg
+    to_jpeg.assert_called_once_with(320, quality=85)
+
+    raw.reset_mock()
+    assert cache.get(source, 320) == b'jpeg'
+    assert not raw.called
+    assert cache.stats == (1, 1, 0, 4)
+
+
+def test_key_depends_on_size_and_identity(cache, source):
+    key = cache.key(source, 320)
+    assert key != cache.key(source, 160)
+    assert key != cache.key(source)
+
+    with open(source, 'a') as f:
+        f.write('more')
+    assert key != cache.key(source, 320)
+
+
+def test_sharded_path(cache):
+    path = cache.path('abcdef')
+    assert path == os.path.join(cache.directory, 'ab', 'cd', 'abcdef.jpg')
+
+
+def test_put_is_atomic(cache):
+    cache.put('abcdef', b'data')
+    directory = os.path.dirname(cache.path('abcdef'))
+    assert os.listdir(directory) == ['abcdef.jpg']
+
+
+def test_concurrent_counters(cache):
+    cache.put('abcdef', b'data')
+
+    def lookup():
+        for _ in range(200):
+            cache.lookup('abcdef')
+            cache.lookup('missing')
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.stats.hits == 1600
+
+
+def test_lookup_missing(cache):
+    assert cache.lookup('abcdef') is None
+    assert cache.hits == 0
+
+
+def test_evicts_least_recently_used(cache):
+    for i, key in enumerate(['aa01', 'aa02', 'aa03']):
+        cache.put(key, b'x' * 40)
+        os.utime(cache.path(key), (i, i))
+
+    # aa03 pushed the cache over its budget; aa01 was the oldest.
+    assert cache.lookup('aa01') is None
+    assert cache.lookup('aa02') == b'x' * 40
+    assert cache.evictions == 1
+    assert cache.stats.bytes == 80
+
+
+def test_lookup_refreshes_lru(cache):
+    cache.put('aa01', b'x' * 40)
+    cache.put('aa02', b'x' * 40)
+    os.utime(cache.path('aa01'), (0, 0))
+    os.utime(cache.path('aa02'), (1, 1))
+
+    cache.lookup('aa01')
+    cache.put('aa03', b'x' * 40)
+
+    assert cache.lookup('aa02') is None
+    assert cache.lookup('aa01') is not None
+
+
+def test_replacing_an_entry_counts_the_difference(cache):
+    cache.put('aa01', b'x' * 40)
+    cache.put('aa01', b'x' * 30)
+    assert cache.stats.bytes == 30
+    assert ThumbnailCache(cache.directory).stats.bytes == 30
+
+
+def test_size_is_recorded(cache):
+    cache.put('aa01', b'x' * 40)
+    with mock.patch.object(ThumbnailCache, '_entries') as entries:
+        assert ThumbnailCache(cache.directory).stats.bytes == 40
+        assert ThumbnailCache(cache.directory).stats.bytes == 40
+    assert not entries.called
+
+
+def test_size_is_measured_if_unknown(cache):
+    cache.put('aa01', b'x' * 40)
+    size = os.path.join(cache.directory, '.size')
+    os.unlink(size)
+    assert ThumbnailCache(cache.directory).stats.bytes == 40
+
+    with open(size, 'w') as f:
+        f.write('garbage')
+    assert ThumbnailCache(cache.directory).stats.bytes == 40
+
+
+def test_lock_without_fcntl(cache):
+    with mock.patch('rawkit.cache.fcntl', None):
+        cache.put('aa01', b'x' * 40)
+    assert cache.lookup('aa01') == b'x' * 40
+
+
+def test_put_failure(cache):
+    def replace(src, dst):
+        os.unlink(src)
+        raise OSError()
+    with mock.patch.object(os, 'replace', side_effect=replace):
+        with pytest.raises(OSError):
+            cache.put('aa01', b'x' * 40)
+    assert os.listdir(os.path.dirname(cache.path('aa01'))) == []
+    assert cache.stats.bytes == 0
+
+
+def test_evicts_everything_if_needed(cache):
+    cache.put('aa01', b'x' * 40)
+    cache.put('aa02', b'x' * 150)
+    assert cache.lookup('aa01') is None
+    assert cache.lookup('aa02') is None
+    assert cache.stats.bytes == 0
+
+
+def test_evict_skips_entries_which_are_gone(cache):
+    cache.put('aa01', b'x' * 40)
+    cache.put('aa02', b'x' * 40)
+    os.utime(cache.path('aa01'), (0, 0))
+    os.utime(cache.path('aa02'), (1, 1))
+    # An entry which can't be read (eg. removed while the tree is walked)...
+    os.symlink('missing', os.path.join(cache.directory, 'bb.jpg'))
+
+    unlink = os.unlink
+
+    def fail_once(path):
+        # ...or can't be deleted is skipped.
+        if path == cache.path('aa01'):
+            raise OSError()
+        unlink(path)
+    with mock.patch.object(os, 'unlink', side_effect=fail_once):
+        cache.put('aa03', b'x' * 40)
+    assert cache.lookup('aa01') is not None
+    assert cache.lookup('aa02') is None
+    assert cache.stats.bytes == 80
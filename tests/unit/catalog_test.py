@@ -0,0 +1,216 @@
+import errno
+import os
+
+import mock
+import pytest
+
+from libraw.errors import DataError, FileUnsupported
+from rawkit.catalog import Catalog, RefreshStats
+from rawkit.metadata import Lens, Metadata
+
+
+CAMERAS = {
+    b'a.CR2': (b'Canon', b'EOS 5D', 100, 1000),
+    b'b.NEF': (b'Nikon', b'D800', 6400, 2000),
+    b'c.CR2': (b'Canon', b'EOS 5D', 3200, 3000),
+}
+
+
+@pytest.yield_fixture
+def libraw():
+    opened = []
+
+    def open_file(data, path):
+        name = os.path.basename(path)
+        if name == b'broken.CR2':
+            raise DataError()
+        if name == b'truncated.CR2':
+            raise IOError('Reading was interrupted')
+        if name not in CAMERAS:
+            raise FileUnsupported()
+        opened.append(name)
+
+    def snapshot(data):
+        make, model, iso, timestamp = CAMERAS[opened[-1]]
+        return Metadata(
+            aperture=2.8, timestamp=timestamp, shutter=0.01, flash=False,
+            focal_length=50.0, height=4000, iso=iso, make=make, model=model,
+            orientation=1, width=6000,
+            lens=Lens(b'', b'50mm f/1.4', b'', 50, 50, 1.4, 1.4, 50),
+        )
+
+    with mock.patch('rawkit.catalog.LibRaw') as libraw:
+        libraw.return_value = libraw
+        libraw.libraw_open_file.side_effect = open_file
+        libraw.opened = opened
+        with mock.patch('rawkit.catalog.snapshot', side_effect=snapshot):
+            yield libraw
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for name in ('a.CR2', 'b.NEF', 'notes.txt'):
+        tmpdir.join('photos', name).write(name, ensure=True)
+    tmpdir.join('photos', 'sub', 'c.CR2').write('c', ensure=True)
+    return tmpdir.join('photos')
+
+
+@pytest.yield_fixture
+def catalog(tmpdir):
+    with Catalog(str(tmpdir.join('catalog.db')), batch_size=2) as catalog:
+        yield catalog
+
+
+def test_refresh(libraw, catalog, tree):
+    assert catalog.refresh(str(tree)) == RefreshStats(4, 0, 0, 0)
+    assert sorted(libraw.opened) == [b'a.CR2', b'b.NEF', b'c.CR2']
+    libraw.libraw_init.assert_called_once_with(0)
+    assert libraw.libraw_recycle.call_count == 4
+
+    entries = catalog.query()
+    assert [os.path.basename(e.path) for e in entries] == [
+        b'a.CR2', b'b.NEF', b'c.CR2']
+    assert entries[0].make == 'Canon'
+    assert entries[0].lens == '50mm f/1.4'
+    assert entries[0].path == os.fsencode(str(tree.join('a.CR2')))
+
+
+def test_refresh_incremental(libraw, catalog, tree):
+    catalog.refresh(str(tree))
+    del libraw.opened[:]
+
+    assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 0, 4)
+    assert libraw.opened == []
+
+    tree.join('a.CR2').write('changed')
+    tree.join('b.NEF').remove()
+    tree.join('d.txt').write('d')
+    assert catalog.refresh(str(tree)) == RefreshStats(1, 1, 1, 2)
+    assert libraw.opened == [b'a.CR2']
+    assert len(catalog.query()) == 2
+
+
+def test_refresh_records_errors(libraw, catalog, tree):
+    tree.join('broken.CR2').write('x')
+    catalog.refresh(str(tree))
+    error, = catalog.connection.execute(
+        'SELECT error FROM files WHERE is_raw = 0 AND error IS NOT NULL'
+    ).fetchone()
+    assert error.startswith('DataError')
+    assert len(catalog.query()) == 3
+
+
+def test_refresh_records_truncated_files(libraw, catalog, tree):
+    tree.join('truncated.CR2').write('x')
+    assert catalog.refresh(str(tree)) == RefreshStats(5, 0, 0, 0)
+    error, = catalog.connection.execute(
+        'SELECT error FROM files WHERE is_raw = 0 AND error IS NOT NULL'
+    ).fetchone()
+    assert error == 'OSError: Reading was interrupted'
+    assert libraw.libraw_recycle.call_count == 5
+    assert len(catalog.query()) == 3
+
+
+def test_refresh_retries_errors(libraw, catalog, tree):
+    tree.join('truncated.CR2').write('x')
+    catalog.refresh(str(tree))
+
+    # Unchanged files which couldn't be read are read again.
+    libraw.libraw_open_file.reset_mock()
+    assert catalog.refresh(str(tree)) == RefreshStats(0, 1, 0, 4)
+    (_, path), _ = libraw.libraw_open_file.call_args
+    assert path == os.fsencode(str(tree.join('truncated.CR2')))
+
+
+def test_refresh_keeps_files_which_cant_be_stated(libraw, catalog, tree):
+    catalog.refresh(str(tree))
+    path = os.fsencode(str(tree.join('a.CR2')))
+    stat = os.stat
+
+    def failing_stat(name, *args, **kwargs):
+        if name == path:
+            raise PermissionError(errno.EACCES, 'Permission denied', name)
+        return stat(name, *args, **kwargs)
+
+    with mock.patch('os.stat', side_effect=failing_stat):
+        assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 0, 4)
+    assert len(catalog.query()) == 3
+
+
+def test_refresh_keeps_unlisted_directories(libraw, catalog, tree):
+    catalog.refresh(str(tree))
+    sub = os.fsencode(str(tree.join('sub')))
+    scandir = os.scandir
+
+    def failing_scandir(name):
+        if name == sub:
+            raise PermissionError(errno.EACCES, 'Permission denied', name)
+        return scandir(name)
+
+    tree.join('b.NEF').remove()
+    with mock.patch('os.scandir', side_effect=failing_scandir):
+        assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 1, 3)
+    assert [os.path.basename(e.path) for e in catalog.query()] == [
+        b'a.CR2', b'c.CR2']
+
+
+def test_refresh_keeps_files_which_come_back(libraw, catalog, tree):
+    catalog.refresh(str(tree))
+    path = os.fsencode(str(tree.join('a.CR2')))
+    stat = os.stat
+    failed = []
+
+    def failing_stat(name, *args, **kwargs):
+        if name == path and not failed:
+            failed.append(name)
+            raise FileNotFoundError(errno.ENOENT, 'Not found', name)
+        return stat(name, *args, **kwargs)
+
+    # Missing while walking, but there again when checked.
+    with mock.patch('os.stat', side_effect=failing_stat):
+        assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 0, 4)
+    assert len(catalog.query()) == 3
+
+
+def test_refresh_removes_vanished_directories(libraw, catalog, tree):
+    catalog.refresh(str(tree))
+    sub = os.fsencode(str(tree.join('sub')))
+    scandir = os.scandir
+
+    def vanishing_scandir(name):
+        if name == sub:
+            tree.join('sub').remove()
+        return scandir(name)
+
+    with mock.patch('os.scandir', side_effect=vanishing_scandir):
+        assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 1, 3)
+    assert [os.path.basename(e.path) for e in catalog.query()] == [
+        b'a.CR2', b'b.NEF']
+
+
+def test_refresh_keeps_other_trees(libraw, catalog, tree, tmpdir):
+    tmpdir.join('photos2', 'a.CR2').write('a', ensure=True)
+    catalog.refresh(str(tree))
+    catalog.refresh(str(tmpdir.join('photos2')))
+    assert catalog.refresh(str(tree)) == RefreshStats(0, 0, 0, 4)
+    assert len(catalog.query()) == 4
+
+
+@pytest.mark.parametrize('criteria,expected', [
+    ({'make': 'Canon'}, [b'a.CR2', b'c.CR2']),
+    ({'make': 'Canon', 'model': 'EOS 5D', 'min_iso': 800}, [b'c.CR2']),
+    ({'since': 1500, 'until': 2500}, [b'b.NEF']),
+    ({'max_iso': 3200}, [b'a.CR2', b'c.CR2']),
+    ({'lens': '50mm f/1.4', 'make': 'Pentax'}, []),
+])
+def test_query(libraw, catalog, tree, criteria, expected):
+    catalog.refresh(str(tree))
+    assert [
+        os.path.basename(e.path) for e in catalog.query(**criteria)
+    ] == expected
+
+
+def test_indexes(catalog):
+    plan = ' '.join(row[-1] for row in catalog.connection.execute(
+        'EXPLAIN QUERY PLAN SELECT path FROM files WHERE make = ?', ('x',)))
+    assert 'files_camera' in plan
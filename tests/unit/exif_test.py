@@ -0,0 +1,107 @@
+import ctypes
+import struct
+
+import pytest
+
+from rawkit import exif
+from rawkit.exif import ExifCollector, ExifEntry, decode, exif_types
+
+
+class FakeStream(object):
+
+    """A stand-in for a LibRaw_abstract_datastream with a C++ vtable."""
+
+    def __init__(self, data):
+        self.data = data
+        self.read = exif._read_method(self._read)
+        self.vtable = (ctypes.c_void_p * 8)()
+        self.vtable[exif._READ_SLOT] = ctypes.cast(
+            self.read, ctypes.c_void_p).value
+        self.obj = ctypes.pointer(self.vtable)
+
+    def _read(self, this, buf, size, count):
+        assert this == self.address
+        n = min(size * count, len(self.data))
+        ctypes.memmove(buf, self.data, n)
+        return n // size
+
+    @property
+    def address(self):
+        return ctypes.addressof(self.obj)
+
+
+@pytest.mark.parametrize('type,length,order,data,expected', [
+    (exif_types.ascii, 6, 'little', b'Canon\x00', b'Canon'),
+    (exif_types.undefined, 2, 'big', b'\x00\x01', b'\x00\x01'),
+    (exif_types.short, 2, 'little', b'\x01\x00\x02\x00', (1, 2)),
+    (exif_types.short, 2, 'big', b'\x00\x01\x00\x02', (1, 2)),
+    (exif_types.srational, 1, 'big', struct.pack('>ii', -1, 3), ((-1, 3),)),
+    (exif_types.double, 1, 'little', struct.pack('<d', 0.5), (0.5,)),
+    (exif_types.long, 2, 'little', b'\x01\x00', None),
+    (99, 1, 'little', b'\x00', None),
+])
+def test_decode(type, length, order, data, expected):
+    assert decode(type, length, order, data) == expected
+
+
+def test_collect_all():
+    collector = ExifCollector()
+    stream = FakeStream(struct.pack('<II', 300, 1))
+    collector.callback(None, 0x829a, exif_types.rational, 1, 0x4949,
+                       stream.address)
+    assert collector.entries == [
+        ExifEntry(0x829a, exif_types.rational, 1, 'little', ((300, 1),)),
+    ]
+
+
+def test_collect_requested_tags_only():
+    collector = ExifCollector(tags=[0x0110])
+    stream = FakeStream(b'EOS 5D\x00')
+    collector.callback(None, 0x010f, exif_types.ascii, 6, 0x4d4d,
+                       stream.address)
+    # LibRaw sets bits above the tag number to identify the directory.
+    collector.callback(None, 0x20110, exif_types.ascii, 7, 0x4d4d,
+                       stream.address)
+    assert collector.entries == [
+        ExifEntry(0x010f, exif_types.ascii, 6, 'big', None),
+        ExifEntry(0x20110, exif_types.ascii, 7, 'big', b'EOS 5D'),
+    ]
+
+
+@pytest.mark.parametrize('version,platform,expected', [
+    ((0, 19, 2), 'linux', True),
+    ((0, 16, 0), 'darwin', True),
+    ((0, 20, 0), 'linux', False),
+    ((0, 15, 3), 'linux', False),
+    ((0, 19, 2), 'win32', False),
+    (None, 'linux', False),
+])
+def test_can_read_values(version, platform, expected):
+    assert exif.can_read_values(version, platform) == expected
+
+
+def test_collect_without_values():
+    collector = ExifCollector(read_values=False)
+    stream = FakeStream(b'')
+    # The stream must not be touched at all.
+    collector.callback(None, 0x829a, exif_types.rational, 1, 0x4949,
+                       stream.address)
+    assert collector.entries == [
+        ExifEntry(0x829a, exif_types.rational, 1, 'little', None),
+    ]
+
+
+def test_collect_skips_huge_values(monkeypatch):
+    monkeypatch.setattr(exif, '_MAX_VALUE_SIZE', 4)
+    collector = ExifCollector()
+    stream = FakeStream(b'\x00' * 8)
+    collector.callback(None, 1, exif_types.double, 1, 0x4949, stream.address)
+    assert collector.entries[0].value is None
+
+
+def test_collect_unknown_type():
+    collector = ExifCollector()
+    stream = FakeStream(b'')
+    # Values of unknown types aren't read, as their size isn't known.
+    collector.callback(None, 1, 99, 1, 0x4949, stream.address)
+    assert collector.entries == [ExifEntry(1, 99, 1, 'little', None)]
@@ -0,0 +1,138 @@
+import json
+import os
+
+import mock
+import pytest
+
+from rawkit import export
+from rawkit.options import Options
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.export.LibRaw') as libraw:
+        libraw.return_value.version = '0.19.0-Release'
+        yield libraw
+
+
+@pytest.yield_fixture
+def raw():
+    def save(filename, filetype=None):
+        with open(filename, 'w') as f:
+            f.write('developed')
+
+    with mock.patch('rawkit.export.Raw') as raw_cls:
+        raw = raw_cls.return_value.__enter__.return_value
+        raw.save.side_effect = save
+        yield raw_cls
+
+
+@pytest.fixture
+def source(tmpdir):
+    src = tmpdir.join('image.CR2')
+    src.write('raw data')
+    return str(src)
+
+
+@pytest.fixture
+def manifest(tmpdir):
+    return str(tmpdir.join('manifest.json'))
+
+
+def test_source_identity_mtime(source):
+    identity = export.source_identity(source)
+    assert identity['size'] == 8
+    assert identity['mtime'] == os.stat(source).st_mtime_ns
+    assert os.path.isabs(identity['path'])
+
+
+def test_source_identity_hash(source):
+    identity = export.source_identity(source, 'hash')
+    assert 'mtime' not in identity
+    assert len(identity['sha256']) == 64
+
+
+def test_source_identity_invalid(source):
+    with pytest.raises(ValueError):
+        export.source_identity(source, 'inode')
+    with pytest.raises(ValueError):
+        export.IncrementalExporter('manifest.json', identity='inode')
+
+
+def test_export_then_skip(libraw, raw, source, manifest, tmpdir):
+    output = str(tmpdir.join('out.tiff'))
+    options = Options({'bps': 16})
+
+    with export.IncrementalExporter(manifest) as exporter:
+        assert exporter.export(source, output, options)
+        assert raw.return_value.__enter__.return_value.options is options
+
+    assert tmpdir.join('out.tiff').read() == 'developed'
+    with open(manifest) as f:
+        records = json.load(f)
+    record = records[os.path.abspath(output)]
+    assert record['libraw'] == '0.19.0-Release'
+    assert record['options'] == [['bps', 16]]
+
+    raw.reset_mock()
+    with export.IncrementalExporter(manifest) as exporter:
+        assert exporter.is_current(source, output, Options({'bps': 16}))
+        assert not exporter.export(source, output, Options({'bps': 16}))
+    assert not raw.called
+
+
+@pytest.mark.parametrize('change', ['source', 'options', 'output', 'libraw'])
+def test_export_redevelops_on_change(libraw, raw, source, manifest, tmpdir,
+                                     change):
+    output = str(tmpdir.join('out.ppm'))
+    options = Options({'bps': 16})
+    with export.IncrementalExporter(manifest) as exporter:
+        exporter.export(source, output, options)
+
+    if change == 'source':
+        with open(source, 'a') as f:
+            f.write('more')
+    elif change == 'options':
+        options.half_size = True
+    elif change == 'output':
+        os.unlink(output)
+    else:
+        libraw.return_value.version = '0.20.0-Release'
+
+    with export.IncrementalExporter(manifest) as exporter:
+        assert not exporter.is_current(source, output, options)
+        assert exporter.export(source, output, options)
+
+
+def test_is_current_missing_source(libraw, raw, source, manifest, tmpdir):
+    output = str(tmpdir.join('out.ppm'))
+    with export.IncrementalExporter(manifest) as exporter:
+        exporter.export(source, output)
+        os.unlink(source)
+        assert not exporter.is_current(source, output)
+
+
+def test_export_failure_leaves_no_output(libraw, raw, source, manifest,
+                                         tmpdir):
+    raw.return_value.__enter__.return_value.save.side_effect = IOError
+    with pytest.raises(IOError):
+        with export.IncrementalExporter(manifest) as exporter:
+            exporter.export(source, str(tmpdir.join('out.ppm')))
+
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['image.CR2']
+
+
+def test_manifest_flushes_periodically(libraw, raw, source, manifest,
+                                       tmpdir):
+    exporter = export.IncrementalExporter(manifest, flush_every=2)
+    exporter.export(source, str(tmpdir.join('a.ppm')))
+    assert not os.path.exists(manifest)
+    exporter.export(source, str(tmpdir.join('b.ppm')))
+    assert os.path.exists(manifest)
+    exporter.close()
+
+
+def test_corrupt_manifest_is_ignored(libraw, manifest):
+    with open(manifest, 'w') as f:
+        f.write('{not json')
+    assert export.IncrementalExporter(manifest).records == {}
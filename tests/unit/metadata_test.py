@@ -0,0 +1,105 @@
+import ctypes
+
+import pytest
+
+from libraw import structs_16, structs_19
+from rawkit.metadata import GPS, Lens, Metadata, Temperatures, snapshot
+
+
+@pytest.fixture
+def data():
+    data = structs_19.libraw_data_t()
+    data.sizes.width = 6000
+    data.sizes.height = 4000
+    data.sizes.flip = 6
+    data.idata.make = b'Canon'
+    data.idata.model = b'EOS 5D'
+    data.other.iso_speed = 400
+    data.other.shot_order = 1234
+    data.other.desc = b'A potato salad'
+    data.other.artist = b'Someone'
+    for name in ('CameraTemperature', 'SensorTemperature', 'LensTemperature',
+                 'AmbientTemperature', 'BatteryTemperature'):
+        setattr(data.other, name, -1000.0)
+    return data
+
+
+def test_snapshot(data):
+    metadata = snapshot(ctypes.pointer(data))
+    assert type(metadata) is Metadata
+    assert metadata.width == 6000
+    assert metadata.height == 4000
+    assert metadata.orientation == 6
+    assert metadata.make == b'Canon'
+    assert metadata.iso == 400
+    assert metadata.shot_order == 1234
+    assert metadata.description == b'A potato salad'
+    assert metadata.artist == b'Someone'
+    assert metadata.gps is None
+    assert metadata.temperatures is None
+
+
+def test_snapshot_gps(data):
+    gps = data.other.parsed_gps
+    gps.latitude[:] = [33, 51, 54]
+    gps.longitude[:] = [151, 12, 36]
+    gps.latref = b'S'
+    gps.longref = b'E'
+    gps.altitude = 12.5
+    gps.altref = b'\x01'
+    gps.gpstimestamp[:] = [23, 59, 30]
+    gps.gpsparsed = b'\x01'
+
+    metadata = snapshot(ctypes.pointer(data))
+    assert metadata.gps.latitude == pytest.approx(-33.865)
+    assert metadata.gps.longitude == pytest.approx(151.21)
+    assert metadata.gps.altitude == -12.5
+    assert metadata.gps.time == (23, 59, 30)
+    assert isinstance(metadata.gps, GPS)
+
+
+def test_snapshot_lens(data):
+    data.lens.LensMake = b'Canon'
+    data.lens.Lens = b'EF24-70mm f/2.8L'
+    data.lens.LensSerial = b'0000123'
+    data.lens.MinFocal = 24
+    data.lens.MaxFocal = 70
+    data.lens.FocalLengthIn35mmFormat = 50
+
+    lens = snapshot(ctypes.pointer(data)).lens
+    assert isinstance(lens, Lens)
+    assert lens.model == b'EF24-70mm f/2.8L'
+    assert lens.serial == b'0000123'
+    assert (lens.min_focal, lens.max_focal) == (24, 70)
+    assert lens.focal_length_35mm == 50
+
+
+def test_snapshot_temperatures(data):
+    data.other.SensorTemperature = 41.5
+    data.other.BatteryTemperature = 20
+
+    temperatures = snapshot(ctypes.pointer(data)).temperatures
+    assert temperatures == Temperatures(
+        camera=None, sensor=41.5, lens=None, ambient=None, battery=20)
+
+
+def test_snapshot_old_libraw():
+    # LibRaw 0.16 has no parsed GPS, lens information or temperatures.
+    data = structs_16.libraw_data_t()
+    data.other.artist = b'Someone'
+    metadata = snapshot(ctypes.pointer(data))
+    assert metadata.artist == b'Someone'
+    assert metadata.gps is None
+    assert metadata.lens is None
+    assert metadata.temperatures is None
+
+
+def test_metadata_defaults():
+    metadata = Metadata(
+        aperture=2.8, timestamp=0, shutter=0.01, flash=False,
+        focal_length=50, height=4000, iso=100, make=b'', model=b'',
+        orientation=1, width=6000,
+    )
+    assert metadata.gps is None
+    assert metadata.shot_order is None
+    assert not hasattr(metadata, '__dict__')
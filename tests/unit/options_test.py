@@ -1,7 +1,7 @@
 import pytest
 
 from mock import Mock
-from rawkit.options import option, Options, WhiteBalance
+from rawkit.options import gamma_curves, option, Options, WhiteBalance
 
 
 @pytest.fixture
@@ -148,3 +148,29 @@ def test_use_camera_profile_writer(options):
     options.use_camera_profile = False
     params = options._map_to_libraw_params(Mock())
     assert params.camera_profile is None
+
+
+def test_unset_gamma_and_brightness_write_defaults(options):
+    params = options._map_to_libraw_params(Mock())
+    assert list(params.gamm)[:2] == [0.45, 4.5]
+    assert params.bright.value == 1.0
+
+
+def test_freeze(options):
+    options.bps = 16
+    options.gamma = gamma_curves.srgb
+    options.white_balance = WhiteBalance(rgbg=[1, 0.5, 1, 0.5])
+    options.dark_frame = Mock(name='DarkFrame')
+    options.dark_frame.name = '/tmp/dark'
+
+    frozen = options.freeze()
+
+    assert frozen == (
+        ('bps', 16),
+        ('dark_frame', '/tmp/dark'),
+        ('gamma', tuple(gamma_curves.srgb)),
+        ('white_balance', WhiteBalance(rgbg=(1, 0.5, 1, 0.5))),
+    )
+    assert hash(frozen)
+    assert type(frozen[3][1]) is WhiteBalance
+    assert Options(dict(frozen)).bps == 16
@@ -0,0 +1,153 @@
+import ctypes
+import threading
+import time
+
+import mock
+import pytest
+
+from libraw import structs_19
+from libraw.errors import FileUnsupported
+from rawkit import pipeline
+from rawkit.raw import ProcessedImage
+from rawkit.raw import Raw
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.batch.LibRaw') as libraw:
+        libraw.return_value = libraw
+        libraw.libraw_init.side_effect = lambda flags: ctypes.pointer(
+            structs_19.libraw_data_t())
+
+        def open_buffer(data, address, size):
+            if size < 4:
+                raise FileUnsupported()
+        libraw.libraw_open_buffer.side_effect = open_buffer
+        image = ProcessedImage(2, 1, 3, 8, bytearray(b'rgbrgb'))
+        with mock.patch.object(Raw, '_mem_image', return_value=image):
+            yield libraw
+
+
+@pytest.fixture
+def photos(tmpdir):
+    paths = []
+    for name, data in (('a.CR2', b'II*\x00'), ('bad.CR2', b''),
+                       ('c.NEF', b'MM\x00*')):
+        tmpdir.join(name).write_binary(data)
+        paths.append(str(tmpdir.join(name)))
+    return paths
+
+
+def small(**kwargs):
+    return dict({name: 1 for name in pipeline.STAGES}, **kwargs)
+
+
+def test_pipeline(libraw, photos, tmpdir):
+    progress = mock.Mock()
+    runner = pipeline.Pipeline(
+        None, str(tmpdir.join('out', '{stem}.ppm')), workers=small(write=2))
+    results = list(runner.run(photos, progress=progress))
+
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.error is None for r in results] == [True, False, True]
+    assert isinstance(results[1].error, FileUnsupported)
+    assert tmpdir.join('out', 'a.ppm').read_binary().endswith(b'rgbrgb')
+    assert tmpdir.join('out', 'c.ppm').check()
+    assert not tmpdir.join('out', 'bad.ppm').check()
+    assert progress.call_args_list == [
+        mock.call(1, 3), mock.call(2, 3), mock.call(3, 3)]
+    # Every handle was closed, including the one which failed to open.
+    assert libraw.libraw_close.call_count == 3
+    assert [r.seconds >= 0 for r in results] == [True] * 3
+
+    stats = {stage.name: stage for stage in runner.stats}
+    assert list(stats) == list(pipeline.STAGES)
+    assert [stats[name].processed for name in pipeline.STAGES] == [
+        3, 3, 2, 2, 2]
+    assert stats['open'].failed == 1
+    assert stats['write'].workers == 2
+    assert stats['write'].capacity == 4
+    for stage in stats.values():
+        assert stage.queued == 0
+        assert 0 <= stage.utilisation <= 1
+
+
+def test_unordered(libraw, photos, tmpdir):
+    runner = pipeline.Pipeline(
+        None, str(tmpdir.join('{stem}.ppm')), workers=small())
+    # Nothing has run yet.
+    assert [stage.utilisation for stage in runner.stats] == []
+
+    results = list(runner.run(photos, ordered=False))
+    assert sorted(r.index for r in results) == [0, 1, 2]
+    assert [r.error is None for r in sorted(results)] == [True, False, True]
+
+
+def test_encode_errors(libraw, photos, tmpdir):
+    runner = pipeline.Pipeline(
+        None, str(tmpdir.join('{stem}.xyz')), workers=small())
+    results = list(runner.run(photos))
+
+    assert [r.error is None for r in results] == [False] * 3
+    stats = {stage.name: stage for stage in runner.stats}
+    # Files are encoded before the write stage, which only sees the bytes.
+    assert stats['encode'].failed == 2
+    assert stats['write'].processed == 0
+    assert libraw.libraw_close.call_count == 3
+
+
+def test_back_pressure(libraw, photos, tmpdir):
+    release = threading.Event()
+    processing = threading.Event()
+
+    def process(data):
+        processing.set()
+        release.wait()
+    libraw.libraw_dcraw_process.side_effect = process
+
+    runner = pipeline.Pipeline(
+        None, str(tmpdir.join('{stem}-{index}.ppm')), workers=small(),
+        queue_sizes=small())
+    results = runner.run(photos * 10)
+    thread = threading.Thread(target=lambda: list(results))
+    thread.start()
+    try:
+        assert processing.wait(1)
+        time.sleep(0.2)
+        stats = {stage.name: stage for stage in runner.stats}
+        # While processing is stuck, the earlier stages fill their queues
+        # and stop, instead of reading every file.
+        assert stats['read'].processed <= 8
+        assert stats['process'].queued <= 1
+    finally:
+        release.set()
+        thread.join()
+    assert len(tmpdir.listdir(lambda p: p.ext == '.ppm')) == 20
+    stats = {stage.name: stage for stage in runner.stats}
+    assert stats['process'].max_queued == 1
+    assert stats['open'].blocked > 0
+
+
+def test_stop_early(libraw, photos, tmpdir):
+    runner = pipeline.Pipeline(
+        None, str(tmpdir.join('{stem}-{index}.ppm')), workers=small())
+    results = runner.run(photos * 10)
+    next(results)
+    results.close()
+    # Files which were on their way through were freed.
+    assert libraw.libraw_close.call_count == libraw.libraw_init.call_count
+    assert runner.stats[0].processed < 30
+
+
+def test_unknown_stage():
+    with pytest.raises(ValueError):
+        pipeline.Pipeline(None, '{stem}.ppm', workers={'decode': 2})
+    with pytest.raises(ValueError):
+        pipeline.Pipeline(None, '{stem}.ppm', queue_sizes={'read': 0})
+
+
+def test_not_reentrant(libraw):
+    libraw.side_effect = ImportError
+    with pytest.raises(ImportError):
+        pipeline.Pipeline(None, '{stem}.ppm')
+    libraw.assert_called_once_with(reentrant=True)
@@ -1,13 +1,22 @@
+import ctypes
+import gc
+import io
+import mmap
 import mock
 import numpy
 import os
 import pytest
 import warnings
 
-from rawkit.errors import InvalidFileType, NoFileSpecified
+from libraw import structs_19
+from libraw.errors import FileUnsupported
+from rawkit.errors import InvalidFileType, MetadataOnly, NoFileSpecified
+from rawkit.options import gamma_curves, highlight_modes, Options
 from rawkit.metadata import Metadata
-from rawkit.raw import Raw, DarkFrame
+from rawkit.raw import Raw, DarkFrame, ExportTarget
 from rawkit.raw import output_file_types
+from rawkit.raw import ProcessedImage
+from rawkit.tiff import compression_types
 
 
 @pytest.fixture
@@ -29,8 +38,11 @@ def raw(input_file):
 
 
 @pytest.yield_fixture
-def dark_frame(input_file):
-    with mock.patch('rawkit.raw.LibRaw'):
+def dark_frame(input_file, tmpdir):
+    # Dark frames of the same source share a temp file, so keep each test's
+    # to itself.
+    with mock.patch('tempfile.tempdir', str(tmpdir)), \
+            mock.patch('rawkit.raw.LibRaw'):
         with DarkFrame(filename=input_file) as raw_obj:
             yield raw_obj
         raw_obj.libraw.libraw_close.assert_called_once_with(raw_obj.data)
@@ -62,11 +74,257 @@ def test_create(raw, input_file):
     )
 
 
+def test_create_shared_libraw(input_file):
+    libraw = mock.Mock()
+    with mock.patch('rawkit.raw.LibRaw') as LibRaw:
+        with Raw(filename=input_file, libraw=libraw) as raw_obj:
+            assert raw_obj.libraw is libraw
+    assert not LibRaw.called
+    libraw.libraw_close.assert_called_once_with(raw_obj.data)
+
+
+def test_create_unsupported(input_file):
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        libraw = libraw.return_value
+        libraw.libraw_open_file.side_effect = FileUnsupported
+        with pytest.raises(FileUnsupported):
+            Raw(filename=input_file)
+        # The handle isn't leaked when the file can't be opened.
+        libraw.libraw_close.assert_called_once_with(
+            libraw.libraw_init.return_value)
+
+
 def test_create_no_filename():
     with pytest.raises(NoFileSpecified):
         Raw()
 
 
+@pytest.yield_fixture
+def metadata_raw(input_file):
+    with mock.patch('rawkit.raw.LibRaw'):
+        with Raw.open_metadata(input_file) as raw_obj:
+            yield raw_obj
+
+
+def test_create_metadata_only(metadata_raw):
+    assert metadata_raw.metadata_only
+    metadata_raw.libraw.libraw_open_file.assert_called_once_with(
+        metadata_raw.data,
+        b'potato_salad.CR2',
+    )
+    metadata_raw.libraw.libraw_recycle_datastream.assert_called_once_with(
+        metadata_raw.data)
+
+
+def test_create_does_not_recycle(raw):
+    assert not raw.metadata_only
+    assert not raw.libraw.libraw_recycle_datastream.called
+
+
+def test_metadata_only_metadata(metadata_raw):
+    metadata_raw.data = ctypes.pointer(structs_19.libraw_data_t())
+    assert type(metadata_raw.metadata) is Metadata
+
+
+@pytest.mark.parametrize('method', [
+    'unpack', 'unpack_thumb', 'process', 'to_image', 'thumbnail',
+    'as_array', 'bayer_data',
+])
+def test_metadata_only_refuses_pixels(metadata_raw, method):
+    with pytest.raises(MetadataOnly):
+        getattr(metadata_raw, method)()
+    assert not metadata_raw.libraw.libraw_unpack.called
+    assert not metadata_raw.libraw.libraw_unpack_thumb.called
+    assert not metadata_raw.libraw.libraw_dcraw_process.called
+
+
+def test_metadata_only_refuses_save(metadata_raw, output_file):
+    with pytest.raises(MetadataOnly):
+        metadata_raw.save(filename=output_file, filetype='ppm')
+    with pytest.raises(MetadataOnly):
+        metadata_raw.save_thumb(filename=output_file)
+
+
+def test_dark_frame_open_metadata(input_file):
+    with mock.patch('rawkit.raw.LibRaw'):
+        with DarkFrame.open_metadata(input_file) as dark_frame:
+            assert dark_frame.metadata_only
+
+
+def test_create_collect_exif(input_file, mock_warning):
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        libraw.return_value.version_number = (0, 19, 2)
+        with mock.patch('rawkit.raw.can_read_values', return_value=True):
+            with Raw(filename=input_file, collect_exif=[0x9003]) as raw:
+                handler = raw.libraw.libraw_set_exifparser_handler
+                handler.assert_called_once_with(
+                    raw.data, raw._exif.callback, None)
+                assert raw._exif.tags == frozenset([0x9003])
+                assert raw._exif.read_values
+                assert raw.exif == []
+    assert not mock_warning.called
+
+
+def test_create_collect_exif_without_values(input_file, mock_warning):
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        libraw.return_value.version_number = (0, 20, 0)
+        with Raw(filename=input_file, collect_exif=True) as raw:
+            assert not raw._exif.read_values
+    assert mock_warning.called
+
+
+def test_create_no_exif(raw):
+    assert not raw.libraw.libraw_set_exifparser_handler.called
+    assert raw.exif is None
+
+
+def _open_buffer_contents(raw):
+    _, address, size = raw.libraw.libraw_open_buffer.call_args[0]
+    return ctypes.string_at(address, size)
+
+
+def test_from_mmap(tmpdir):
+    path = tmpdir.join('image.CR2')
+    path.write_binary(b'II*\x00raw data')
+    with mock.patch('rawkit.raw.LibRaw'):
+        raw = Raw.from_mmap(str(path))
+        assert not raw.libraw.libraw_open_file.called
+        assert _open_buffer_contents(raw) == b'II*\x00raw data'
+        mapping = raw._mmap
+        raw.close()
+        assert mapping.closed
+        assert raw._buffer is None
+
+
+def test_from_mmap_metadata_only(tmpdir):
+    path = tmpdir.join('image.CR2')
+    path.write_binary(b'II*\x00')
+    with mock.patch('rawkit.raw.LibRaw'):
+        with Raw.from_mmap(str(path), metadata_only=True) as raw:
+            raw.libraw.libraw_recycle_datastream.assert_called_once_with(
+                raw.data)
+            assert raw._mmap is None
+            assert raw._buffer is None
+
+
+def test_from_mmap_empty(tmpdir):
+    path = tmpdir.join('empty.CR2')
+    path.write_binary(b'')
+    with mock.patch('rawkit.raw.LibRaw'):
+        with Raw.from_mmap(str(path)) as raw:
+            assert raw.libraw.libraw_open_buffer.call_args[0][2] == 0
+
+
+def test_from_mmap_unsupported(tmpdir):
+    path = tmpdir.join('image.jpg')
+    path.write_binary(b'\xff\xd8')
+    mappings = []
+    real_mmap = mmap.mmap
+
+    def mmap_(*args, **kwargs):
+        mappings.append(real_mmap(*args, **kwargs))
+        return mappings[-1]
+
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        libraw.return_value.libraw_open_buffer.side_effect = FileUnsupported
+        with mock.patch('rawkit.raw.mmap.mmap', side_effect=mmap_):
+            with pytest.raises(FileUnsupported):
+                Raw.from_mmap(str(path))
+        libraw.return_value.libraw_close.assert_called_once_with(
+            libraw.return_value.libraw_init.return_value)
+    assert mappings[0].closed
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.raw.LibRaw') as libraw:
+        yield libraw.return_value
+
+
+def test_from_bytes(libraw):
+    data = b'II*\x00raw data'
+    with Raw.from_bytes(data) as raw:
+        assert not libraw.libraw_open_file.called
+        assert _open_buffer_contents(raw) == data
+        # Pointed at, not copied.
+        assert raw._buffer._objects is data
+    assert raw._buffer is None
+
+
+def test_from_bytes_bytearray_not_copied(libraw):
+    data = bytearray(b'II*\x00')
+    with Raw.from_bytes(data) as raw:
+        data[0:2] = b'MM'
+        assert _open_buffer_contents(raw) == b'MM*\x00'
+
+
+def test_from_bytes_memoryview_of_bytes(libraw):
+    data = b'II*\x00'
+    with Raw.from_bytes(memoryview(data)) as raw:
+        assert raw._buffer._objects is data
+
+
+def test_from_bytes_readonly_slice(libraw):
+    with Raw.from_bytes(memoryview(b'xxII*\x00')[2:]) as raw:
+        assert _open_buffer_contents(raw) == b'II*\x00'
+
+
+def test_from_bytes_none():
+    with pytest.raises(NoFileSpecified):
+        Raw.from_bytes(None)
+
+
+def test_from_bytes_unsupported(libraw):
+    libraw.libraw_open_buffer.side_effect = FileUnsupported
+    with pytest.raises(FileUnsupported):
+        Raw.from_bytes(b'not a raw file')
+    libraw.libraw_close.assert_called_once_with(
+        libraw.libraw_init.return_value)
+
+
+def test_from_fileobj_bytesio(libraw):
+    f = io.BytesIO(b'headerII*\x00')
+    f.seek(6)
+    with Raw.from_fileobj(f) as raw:
+        assert _open_buffer_contents(raw) == b'II*\x00'
+        with pytest.raises(BufferError):
+            f.write(b'more data')
+    f.write(b'more data')
+
+
+def test_from_fileobj_file(libraw, tmpdir):
+    path = tmpdir.join('image.CR2')
+    path.write_binary(b'headerII*\x00')
+    with open(str(path), 'rb') as f:
+        f.seek(6)
+        with Raw.from_fileobj(f) as raw:
+            assert raw._mmap is not None
+            assert _open_buffer_contents(raw) == b'II*\x00'
+
+
+def test_from_fileobj_stream(libraw):
+    stream = mock.Mock(spec=['read'])
+    stream.read.return_value = b'II*\x00'
+    with Raw.from_fileobj(stream) as raw:
+        assert _open_buffer_contents(raw) == b'II*\x00'
+
+
+def test_from_fileobj_pipe(libraw):
+    read, write = os.pipe()
+    os.write(write, b'II*\x00')
+    os.close(write)
+    # Pipes can't be mapped, so they are read.
+    with open(read, 'rb') as f:
+        with Raw.from_fileobj(f) as raw:
+            assert raw._mmap is None
+            assert _open_buffer_contents(raw) == b'II*\x00'
+
+
+def test_from_fileobj_none():
+    with pytest.raises(NoFileSpecified):
+        Raw.from_fileobj(None)
+
+
 def test_dark_frame_is_raw(dark_frame):
     assert isinstance(dark_frame, Raw)
 
@@ -93,18 +351,85 @@ def test_unpack_thumb_twice(raw):
     raw.libraw.libraw_unpack_thumb.assert_called_once_with(raw.data)
 
 
-def test_save_dark_frame_cached(dark_frame, tmpdir):
+def test_save_dark_frame_cached(dark_frame):
+    dark_frame.save()
     dark_frame.save()
 
-    # Touch the file (as if LibRaw were installed and saved a file)
-    with open(dark_frame.name, 'a'):
-        pass
+    # The file is written once, atomically.
+    writer = dark_frame.libraw.libraw_dcraw_ppm_tiff_writer
+    writer.assert_called_once_with(dark_frame.data, mock.ANY)
+    assert writer.call_args[0][1] != dark_frame.name.encode('ascii')
+    assert os.path.isfile(dark_frame.name)
+
+
+def test_dark_frame_shared(input_file, tmpdir):
+    with mock.patch('tempfile.tempdir', str(tmpdir)), \
+            mock.patch('rawkit.raw.LibRaw') as libraw:
+        writer = libraw.return_value.libraw_dcraw_ppm_tiff_writer
+        first = DarkFrame(filename=input_file)
+        first.save()
+        with DarkFrame(filename=input_file) as second:
+            second.save()
+            assert second.name == first.name
+            assert writer.call_count == 1
+
+            # A dark frame which is closed leaves the file to the others...
+            first.close()
+            assert os.path.isfile(second.name)
+            # ...and one which is still open puts it back if it's removed.
+            os.unlink(second.name)
+            second.save()
+            assert os.path.isfile(second.name)
+            assert writer.call_count == 1
+    assert tmpdir.listdir() == []
+
+
+def test_dark_frame_restored_by_another(dark_frame):
+    dark_frame.save()
+    os.unlink(dark_frame.name)
+    link = os.link
+
+    def restored_first(src, dst):
+        # Another dark frame puts the file back first.
+        link(src, dst)
+        raise FileExistsError()
+    with mock.patch('os.link', side_effect=restored_first):
+        dark_frame.save()
+    assert os.path.isfile(dark_frame.name)
 
+
+def test_dark_frame_link_removed(dark_frame):
+    # Say, by a temp cleaner.
     dark_frame.save()
-    dark_frame.libraw.libraw_dcraw_ppm_tiff_writer.assert_called_once_with(
-        dark_frame.data,
-        dark_frame.name.encode('ascii'),
-    )
+    os.unlink(dark_frame._link)
+    dark_frame.cleanup()
+    assert not os.path.exists(dark_frame.name)
+
+
+def test_dark_frame_without_hard_links(dark_frame):
+    with mock.patch('os.link', side_effect=OSError()):
+        dark_frame.save()
+    dark_frame.cleanup()
+    assert not os.path.exists(dark_frame.name)
+
+
+def test_dark_frame_name_follows_source(input_file, tmpdir):
+    with mock.patch('rawkit.raw.LibRaw'):
+        with DarkFrame(filename=input_file) as first:
+            options = Options({'dark_frame': first})
+            frozen = options.freeze()
+        with DarkFrame(filename=input_file) as second:
+            options = Options({'dark_frame': second})
+            assert options.freeze() == frozen
+        with DarkFrame(buffer=b'II*\x00') as third:
+            assert third.name != first.name
+        with DarkFrame(buffer=b'II*\x00') as fourth:
+            assert fourth.name == third.name
+
+        other = tmpdir.join('other.CR2')
+        other.write('')
+        with DarkFrame(filename=str(other)) as fifth:
+            assert fifth.name != first.name
 
 
 def test_save_dark_frame_with_filename_cached(dark_frame, tmpdir):
@@ -115,6 +440,13 @@ def test_save_dark_frame_with_filename_cached(dark_frame, tmpdir):
     assert not dark_frame.libraw.libraw_dcraw_ppm_tiff_writer.called
 
 
+def test_save_dark_frame_with_filename(dark_frame, tmpdir):
+    fn = os.path.join(str(tmpdir), 'somefile')
+    dark_frame.save(filename=fn)
+    dark_frame.libraw.libraw_dcraw_ppm_tiff_writer.assert_called_once_with(
+        dark_frame.data, fn.encode('ascii'))
+
+
 def _test_save(raw, output_file, filetype):
     raw.save(filename=output_file, filetype=filetype)
 
@@ -210,8 +542,10 @@ def test_thumbnail_to_buffer(raw, mock_ctypes):
 
 
 def test_metadata(raw):
+    raw.data = ctypes.pointer(structs_19.libraw_data_t())
     metadata = raw.metadata
     assert type(metadata) is Metadata
+    assert raw.metadata is metadata
 
 
 def test_as_array(raw, mock_ctypes, mock_numpy):
@@ -292,3 +626,299 @@ def test_bayer_data_with_margin(raw, mock_ctypes):
     result, _ = raw.bayer_data(include_margin=True)
 
     assert result
+
+
+def test_to_image(raw, mock_ctypes):
+    with mock.patch('rawkit.raw.raise_if_error'):
+        image = raw.to_image()
+
+    contents = raw.libraw.libraw_dcraw_make_mem_image(raw.data).contents
+    assert image.width == contents.width
+    assert image.height == contents.height
+    assert image.bits == contents.bits
+
+
+def test_develop_into(raw):
+    def image_format(data, *values):
+        for value, size in zip(values, (2, 1, 3, 16)):
+            value.contents.value = size
+    raw.libraw.libraw_get_mem_image_format.side_effect = image_format
+    copy = raw.libraw.libraw_copy_mem_image
+    copy.side_effect = lambda data, address, stride, bgr: ctypes.memset(
+        address, 7, stride)
+
+    buffer = bytearray(16)
+    allocate = mock.Mock(return_value=buffer)
+    image = raw.develop_into(allocate)
+
+    allocate.assert_called_once_with(2, 1, 3, 16)
+    copy.assert_called_once_with(raw.data, mock.ANY, 12, 0)
+    assert image == ProcessedImage(2, 1, 3, 16, buffer)
+    assert buffer == b'\x07' * 12 + b'\x00' * 4
+
+
+def test_develop_into_copies(raw):
+    # Older versions of LibRaw can't copy into our buffer themselves.
+    del raw.libraw.libraw_copy_mem_image
+    developed = ProcessedImage(2, 1, 3, 8, bytearray(b'abcdef'))
+    buffer = bytearray(8)
+    with mock.patch.object(raw, 'to_image', return_value=developed):
+        image = raw.develop_into(lambda *size: buffer)
+
+    assert image == developed._replace(data=buffer)
+    assert buffer == b'abcdef\x00\x00'
+
+
+def test_save_tiff_native(raw):
+    image = ProcessedImage(2, 1, 3, 8, bytearray(6))
+    with mock.patch.object(raw, 'to_image', return_value=image):
+        with mock.patch('rawkit.raw.write_tiff') as write_tiff:
+            raw.save_tiff('out.tiff', compression=compression_types.lzw)
+
+    write_tiff.assert_called_once_with(
+        'out.tiff', image.data, 2, 1, colors=3, bits=8,
+        compression=compression_types.lzw,
+    )
+
+
+def test_save_tiff_no_filename(raw):
+    with pytest.raises(NoFileSpecified):
+        raw.save_tiff(None)
+
+
+@pytest.fixture
+def processed_image():
+    pixels = numpy.array([0, 65535, 32768, 1, 2, 3], dtype=numpy.uint16)
+    return ProcessedImage(2, 1, 3, 16, bytearray(pixels.tobytes()))
+
+
+def test_linear_options(raw):
+    raw.options.bps = 8
+    raw.options.half_size = True
+    options = raw.linear_options()
+
+    assert options.bps == 16
+    assert options.gamma == gamma_curves.linear
+    assert options.auto_brightness is False
+    assert options.half_size is True
+    assert options.highlight_mode == highlight_modes.ignore
+    # The raw's own options are left untouched.
+    assert raw.options.bps == 8
+
+
+def test_to_array(raw, processed_image):
+    with mock.patch.object(raw, 'to_image',
+                           return_value=processed_image) as to_image:
+        array = raw.to_array()
+
+    assert array.shape == (1, 2, 3)
+    assert array.dtype == numpy.float32
+    assert array[0, 0, 1] == 1.0
+    assert to_image.call_args[1]['options'].bps == 16
+
+
+def test_to_array_then_to_buffer(raw, processed_image):
+    raw.data = ctypes.pointer(structs_19.libraw_data_t())
+    params = raw.data.contents.params
+    developed = []
+
+    def mem_image():
+        developed.append(
+            (tuple(params.gamm[:2]), params.bright, params.no_auto_bright))
+        return processed_image
+
+    with mock.patch.object(raw, '_mem_image', side_effect=mem_image):
+        raw.to_array()
+        raw.to_buffer()
+
+    assert developed == [
+        ((1.0, 1.0), 1.0, 1),
+        # The linear development doesn't leak into the next one.
+        ((0.45, 4.5), 1.0, 0),
+    ]
+
+
+def test_to_array_not_linear(raw, processed_image):
+    with mock.patch.object(raw, 'to_image',
+                           return_value=processed_image) as to_image:
+        raw.to_array(dtype='float64', linear=False)
+
+    to_image.assert_called_once_with(options=None)
+
+
+def test_to_array_memmap(raw, processed_image, tmpdir):
+    fn = str(tmpdir.join('out.npy'))
+    with mock.patch.object(raw, 'to_image', return_value=processed_image):
+        array = raw.to_array(memmap=fn)
+
+    assert isinstance(array, numpy.memmap)
+    assert numpy.array_equal(numpy.load(fn), array)
+
+
+@pytest.mark.parametrize('filetype', ['npy', 'pfm'])
+def test_save_float(raw, processed_image, filetype):
+    with mock.patch.object(raw, 'to_image', return_value=processed_image):
+        with mock.patch('rawkit.raw.write_' + filetype) as writer:
+            raw.save('out.' + filetype)
+
+    writer.assert_called_once_with('out.' + filetype, processed_image)
+    assert not raw.libraw.libraw_dcraw_ppm_tiff_writer.called
+
+
+@pytest.yield_fixture
+def export_raw(raw, processed_image):
+    raw.data.contents.sizes.width = 6000
+    raw.data.contents.sizes.height = 4000
+    with mock.patch.object(raw, 'to_image',
+                           return_value=processed_image) as to_image:
+        with mock.patch.object(raw, 'save_thumb'):
+            with mock.patch('rawkit.raw.write_image') as write_image:
+                yield raw, to_image, write_image
+
+
+def test_export_shares_development(export_raw):
+    raw, to_image, write_image = export_raw
+
+    result = raw.export([
+        ExportTarget('master.tiff', bps=16),
+        ExportTarget('full.jpg', kwargs={'quality': 90}),
+        ExportTarget('thumb.jpg', filetype='thumbnail'),
+    ])
+
+    assert result == ['master.tiff', 'full.jpg', 'thumb.jpg']
+    raw.save_thumb.assert_called_once_with(filename='thumb.jpg')
+    to_image.assert_called_once_with(options=mock.ANY)
+    options = to_image.call_args[1]['options']
+    assert options.bps == 16
+    assert options.half_size is False
+
+    calls = {c[0][0]: c for c in write_image.call_args_list}
+    assert calls['master.tiff'][0][1].bits == 16
+    assert calls['full.jpg'][0][2] == 'jpeg'
+    assert calls['full.jpg'][1] == {'quality': 90}
+    # 8-bit targets are derived from the 16-bit development.
+    assert calls['full.jpg'][0][1].bits == 8
+
+
+def test_export_linear_and_half_size(export_raw):
+    raw, to_image, write_image = export_raw
+
+    with mock.patch('rawkit.raw.resize', side_effect=lambda i, s: i):
+        raw.export([
+            ExportTarget('web.jpg', size=1024),
+            ExportTarget('linear.npy'),
+        ])
+
+    assert to_image.call_count == 2
+    display, linear = [c[1]['options'] for c in to_image.call_args_list]
+    assert display.bps == 8
+    assert display.half_size is True
+    assert linear.gamma == gamma_curves.linear
+    assert linear.half_size is False
+
+
+def test_export_respects_explicit_half_size(export_raw):
+    raw, to_image, _ = export_raw
+    raw.options.half_size = False
+
+    with mock.patch('rawkit.raw.resize', side_effect=lambda i, s: i):
+        raw.export([ExportTarget('web.jpg', size=1024)])
+
+    assert to_image.call_args[1]['options'].half_size is False
+
+
+def test_export_raises_write_errors(export_raw):
+    raw, _, write_image = export_raw
+    write_image.side_effect = IOError
+
+    with pytest.raises(IOError):
+        raw.export([ExportTarget('out.ppm')])
+
+
+def test_export_invalid_filetype(export_raw):
+    raw, _, _ = export_raw
+    with pytest.raises(InvalidFileType):
+        raw.export([ExportTarget('out.gif')])
+
+
+def test_thumbnail(input_file):
+    jpeg = ctypes.create_string_buffer(b'\xff\xd8\xff\xd9', 4)
+    with mock.patch('rawkit.raw.LibRaw'):
+        raw = Raw(filename=input_file)
+        thumbnail = raw.data.contents.thumbnail
+        thumbnail.tformat = 1
+        thumbnail.twidth = 160
+        thumbnail.theight = 120
+        thumbnail.tcolors = 3
+        thumbnail.tlength = 4
+        thumbnail.thumb = ctypes.cast(jpeg, ctypes.POINTER(ctypes.c_char))
+
+        thumb = raw.thumbnail()
+
+        raw.libraw.libraw_unpack_thumb.assert_called_once_with(raw.data)
+        assert thumb.is_jpeg
+        assert (thumb.width, thumb.height, thumb.colors) == (160, 120, 3)
+        assert bytes(thumb.data) == b'\xff\xd8\xff\xd9'
+
+        # No copy was made.
+        jpeg[1] = b'\x00'
+        assert thumb.data[1] == 0
+
+        raw.close()
+        with pytest.raises(ValueError):
+            thumb.data[0]
+
+
+def test_thumbnail_close_while_in_use(input_file):
+    bitmap = ctypes.create_string_buffer(b'rgb', 3)
+    with mock.patch('rawkit.raw.LibRaw'):
+        raw = Raw(filename=input_file)
+        thumbnail = raw.data.contents.thumbnail
+        thumbnail.tformat = 2
+        thumbnail.twidth = thumbnail.theight = 1
+        thumbnail.tcolors = 3
+        thumbnail.tlength = 3
+        thumbnail.thumb = ctypes.cast(bitmap, ctypes.POINTER(ctypes.c_char))
+
+        thumb = raw.thumbnail()
+        pixels = thumb.as_array()
+        tail = thumb.data[1:]
+
+        # LibRaw's memory isn't freed while views of it are alive...
+        with pytest.raises(BufferError):
+            raw.close()
+        del pixels
+        with pytest.raises(BufferError):
+            raw.close()
+        assert not raw.libraw.libraw_close.called
+        assert bytes(tail) == b'gb'
+
+        # ...but it is once they're gone.
+        del tail
+        raw.close()
+        raw.libraw.libraw_close.assert_called_once_with(raw.data)
+
+
+def test_thumbnail_close_collects_cycles(input_file):
+    bitmap = ctypes.create_string_buffer(b'rgb', 3)
+    with mock.patch('rawkit.raw.LibRaw'):
+        raw = Raw(filename=input_file)
+        thumbnail = raw.data.contents.thumbnail
+        thumbnail.tformat = 2
+        thumbnail.twidth = thumbnail.theight = 1
+        thumbnail.tcolors = 3
+        thumbnail.tlength = 3
+        thumbnail.thumb = ctypes.cast(bitmap, ctypes.POINTER(ctypes.c_char))
+
+        thumb = raw.thumbnail()
+        gc.disable()
+        try:
+            # A slice that's only reachable from garbage is collected on
+            # close instead of keeping LibRaw's memory alive.
+            cycle = [thumb.data[1:]]
+            cycle.append(cycle)
+            del cycle
+            raw.close()
+        finally:
+            gc.enable()
+        raw.libraw.libraw_close.assert_called_once_with(raw.data)
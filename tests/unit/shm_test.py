@@ -0,0 +1,80 @@
+import mock
+import pytest
+
+from multiprocessing import shared_memory
+
+from rawkit import shm
+from rawkit.raw import ProcessedImage
+
+
+@pytest.yield_fixture
+def segments():
+    with shm.SegmentPool() as segments:
+        yield segments
+
+
+def fake_raw(width=2, height=1, colors=3, bits=16, error=None):
+    def develop_into(allocate, options=None):
+        buffer = allocate(width, height, colors, bits)
+        if error is not None:
+            raise error
+        size = width * height * colors * bits // 8
+        buffer[:size] = b'\x05' * size
+        return ProcessedImage(width, height, colors, bits, buffer)
+    return mock.Mock(develop_into=mock.Mock(side_effect=develop_into))
+
+
+def test_develop(segments):
+    image = segments.develop(fake_raw())
+    assert image.shape == (1, 2, 3)
+    assert image.dtype == 'uint16'
+    assert bytes(segments.buffer(image)) == b'\x05' * 12
+
+    array = segments.array(image)
+    assert array.shape == (1, 2, 3)
+    assert array.dtype == 'uint16'
+    del array
+
+
+def test_release_reuses_segments(segments):
+    first = segments.develop(fake_raw())
+    segments.release(first)
+    # Released segments are reused for images which fit...
+    smaller = segments.develop(fake_raw(bits=8))
+    assert smaller.name == first.name
+    assert smaller.dtype == 'uint8'
+    segments.release(smaller)
+    # ...but not for bigger ones.
+    bigger = segments.develop(fake_raw(width=100))
+    assert bigger.name != first.name
+
+
+def test_develop_failure_releases_segment(segments):
+    with pytest.raises(RuntimeError):
+        segments.develop(fake_raw(error=RuntimeError('oops')))
+    image = segments.develop(fake_raw())
+    assert len(segments._names) == 1
+    assert image.name in segments._names
+
+
+def test_close_unlinks(segments):
+    released = segments.develop(fake_raw())
+    segments.release(released)
+    held = segments.develop(fake_raw(width=100))
+    segments.close()
+
+    for image in (released, held):
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(image.name)
+
+
+def test_close_skips_destroyed_segments(segments):
+    # A segment created by a worker, which was destroyed before the pool
+    # attached to it.
+    segment = shared_memory.SharedMemory(create=True, size=16)
+    segments.release(shm.SharedImage(segment.name, (1, 2, 3), 'uint8'))
+    segment.close()
+    segment.unlink()
+
+    segments.close()
+    assert segments._names == set()
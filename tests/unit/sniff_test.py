@@ -0,0 +1,40 @@
+import pytest
+
+from rawkit.sniff import sniff, sniff_file
+
+
+@pytest.mark.parametrize('header,expected', [
+    (b'II*\x00\x10\x00\x00\x00CR\x02\x00', 'cr2'),
+    (b'II*\x00\x08\x00\x00\x00', 'tiff'),
+    (b'MM\x00*\x00\x00\x00\x08', 'tiff'),
+    (b'II+\x00\x08\x00\x00\x00', 'tiff'),
+    (b'IIRO\x08\x00\x00\x00', 'orf'),
+    (b'MMOR\x00\x00\x00\x08', 'orf'),
+    (b'IIU\x00\x18\x00\x00\x00', 'rw2'),
+    (b'FUJIFILMCCD-RAW 0201', 'raf'),
+    (b'\x00\x00\x00\x18ftypcrx \x00\x00\x00\x01', 'cr3'),
+    (b'II\x1a\x00\x00\x00HEAPCCDR', 'crw'),
+    (b'FOVb\x00\x00\x04\x00', 'x3f'),
+    (b'\x00MRM\x00\x00\x00\x00', 'mrw'),
+    (b'\x00\x01\x02\x03headerless', 'unknown'),
+    (b'IIII\x00\x00\x00\x00', 'unknown'),
+    (b'\xff\xd8\xff\xe1\x00\x10Exif', None),
+    (b'\x89PNG\r\n\x1a\n', None),
+    (b'<?xpacket begin="\xef\xbb\xbf"', None),
+    (b'\n  <x:xmpmeta xmlns:x="adobe:ns:meta/">', None),
+    (b'<?xml version="1.0"?>', None),
+    (b'\x00\x00\x00\x20ftypisom\x00\x00\x02\x00', None),
+    (b'\x00\x00\x00\x18ftypheic', None),
+    (b'\x00\x00\x00\x08wide', None),
+    (b'RIFF\x00\x00\x00\x00AVI ', None),
+    (b'', None),
+])
+def test_sniff(header, expected):
+    assert sniff(header) == expected
+
+
+def test_sniff_file(tmpdir):
+    path = tmpdir.join('image.RAF')
+    path.write_binary(b'FUJIFILMCCD-RAW ' + b'\x00' * 1024)
+    assert sniff_file(str(path)) == 'raf'
+    assert sniff_file(str(tmpdir.join('missing.RAF'))) is None
@@ -0,0 +1,164 @@
+import io
+
+import mock
+import numpy
+import pytest
+
+from rawkit.thumbnail import Thumbnail, thumbnail_formats, _bin
+
+
+def test_jpeg_thumbnail():
+    thumb = Thumbnail(thumbnail_formats.jpeg, 160, 120, 3,
+                      memoryview(b'\xff\xd8'))
+    assert thumb.is_jpeg
+    assert not thumb.is_bitmap
+    with pytest.raises(ValueError):
+        thumb.as_array()
+
+
+def test_bitmap_thumbnail():
+    thumb = Thumbnail(thumbnail_formats.bitmap, 2, 1, 3,
+                      memoryview(bytearray(range(6))))
+    assert thumb.is_bitmap
+    array = thumb.as_array()
+    assert array.shape == (1, 2, 3)
+    assert array[0, 1, 2] == 5
+
+
+def test_bitmap16_thumbnail():
+    data = numpy.arange(6, dtype=numpy.uint16).tobytes()
+    thumb = Thumbnail(thumbnail_formats.bitmap16, 2, 1, 3, memoryview(data))
+    assert thumb.as_array().dtype == numpy.uint16
+
+
+@pytest.fixture
+def jpeg():
+    Image = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    Image.new('RGB', (640, 480), (200, 100, 50)).save(out, format='JPEG')
+    return Thumbnail(thumbnail_formats.jpeg, 640, 480, 3,
+                     memoryview(out.getvalue()))
+
+
+def test_to_jpeg_passthrough(jpeg):
+    assert jpeg.to_jpeg() == bytes(jpeg.data)
+    assert jpeg.to_jpeg(size=1024) == bytes(jpeg.data)
+
+
+def test_to_jpeg_wrong_size(jpeg):
+    # LibRaw doesn't always know the size of an embedded JPEG.
+    thumb = jpeg._replace(width=0, height=0)
+    Image = pytest.importorskip('PIL.Image')
+    scaled = Image.open(io.BytesIO(thumb.to_jpeg(size=160)))
+    assert scaled.size == (160, 120)
+
+
+def test_to_jpeg_scaled(jpeg):
+    from PIL import Image
+    scaled = Image.open(io.BytesIO(jpeg.to_jpeg(size=160)))
+    assert scaled.format == 'JPEG'
+    assert scaled.size == (160, 120)
+
+
+def test_to_image_jpeg(jpeg):
+    image = jpeg.to_image()
+    assert image.format == 'JPEG'
+    assert image.size == (640, 480)
+
+
+def test_to_image_bitmap16():
+    pytest.importorskip('PIL')
+    data = numpy.full((4, 8, 3), 0xff00, numpy.uint16).tobytes()
+    thumb = Thumbnail(thumbnail_formats.bitmap16, 8, 4, 3, memoryview(data))
+    image = thumb.to_image(size=4)
+    assert image.size == (4, 2)
+    assert image.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_to_image_grayscale_bitmap():
+    pytest.importorskip('PIL')
+    data = bytearray(4)
+    thumb = Thumbnail(thumbnail_formats.bitmap, 2, 2, 1, memoryview(data))
+    image = thumb.to_image()
+    assert image.mode == 'L'
+
+    # The image doesn't point into the thumbnail's data.
+    data[0] = 255
+    assert image.getpixel((0, 0)) == 0
+
+
+def test_to_image_unsupported():
+    pytest.importorskip('PIL')
+    thumb = Thumbnail(thumbnail_formats.layer, 2, 2, 1, memoryview(b''))
+    with pytest.raises(ValueError):
+        thumb.to_image()
+
+
+def test_renditions_jpeg(jpeg):
+    from PIL import Image
+    renditions = jpeg.renditions([160, 320, 1024, 320])
+    assert sorted(renditions) == [160, 320, 1024]
+    assert renditions[1024] == bytes(jpeg.data)
+    for size in (160, 320):
+        image = Image.open(io.BytesIO(renditions[size]))
+        assert image.size == (size, size * 3 // 4)
+
+
+def test_renditions_jpeg_wrong_size(jpeg):
+    Image = pytest.importorskip('PIL.Image')
+    renditions = jpeg._replace(width=0, height=0).renditions([160, 1024])
+    assert renditions[1024] == bytes(jpeg.data)
+    assert Image.open(io.BytesIO(renditions[160])).size == (160, 120)
+
+
+def test_renditions_decode_once(jpeg):
+    from PIL import Image
+    with mock.patch('PIL.Image.open', wraps=Image.open) as open_:
+        jpeg.renditions([100, 200, 300], workers=1)
+    open_.assert_called_once()
+
+
+def test_renditions_bitmap():
+    from PIL import Image
+    pixels = numpy.zeros((400, 600, 3), numpy.uint8)
+    pixels[:, 300:] = 255
+    thumb = Thumbnail(thumbnail_formats.bitmap, 600, 400, 3,
+                      memoryview(pixels.tobytes()))
+    renditions = thumb.renditions([150, 600])
+
+    full = Image.open(io.BytesIO(renditions[600]))
+    small = Image.open(io.BytesIO(renditions[150]))
+    assert full.size == (600, 400)
+    assert small.size == (150, 100)
+    assert small.getpixel((10, 50))[0] < 10
+    assert small.getpixel((140, 50))[0] > 245
+
+
+def test_renditions_bitmap_binned():
+    from PIL import Image
+    pixels = numpy.zeros((400, 600, 3), numpy.uint8)
+    thumb = Thumbnail(thumbnail_formats.bitmap, 600, 400, 3,
+                      memoryview(pixels.tobytes()))
+    with mock.patch('rawkit.thumbnail._bin', wraps=_bin) as bin_:
+        renditions = thumb.renditions([150, 75])
+    bin_.assert_called_once_with(mock.ANY, 4)
+    assert Image.open(io.BytesIO(renditions[150])).size == (150, 100)
+    assert Image.open(io.BytesIO(renditions[75])).size == (75, 50)
+
+
+def test_renditions_empty(jpeg):
+    assert jpeg.renditions([]) == {}
+
+
+def test_renditions_unsupported():
+    thumb = Thumbnail(thumbnail_formats.layer, 2, 2, 1, memoryview(b''))
+    with pytest.raises(ValueError):
+        thumb.renditions([1])
+
+
+def test_bin():
+    pixels = numpy.arange(5 * 4, dtype=numpy.uint16).reshape(5, 4, 1)
+    binned = _bin(pixels, 2)
+    assert binned.shape == (2, 2, 1)
+    assert binned.dtype == numpy.uint16
+    assert binned[:, :, 0].tolist() == [[3, 5], [11, 13]]
@@ -0,0 +1,223 @@
+import struct
+import sys
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+import numpy
+import pytest
+
+from rawkit.errors import InvalidFileType
+from rawkit.tiff import compression_types
+from rawkit.tiff import predictors
+from rawkit.tiff import write_tiff
+from rawkit.tiff import _lzw_compress
+
+
+BYTEORDER = '<' if sys.byteorder == 'little' else '>'
+
+
+def read_tags(filename):
+    """A tiny TIFF reader: returns the header magic and a dict of tags."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, = struct.unpack(BYTEORDER + 'H', data[2:4])
+    if magic == 43:
+        offset, = struct.unpack(BYTEORDER + 'Q', data[8:16])
+        count_fmt, entry_fmt, inline = 'Q', 'HHQ', 8
+    else:
+        offset, = struct.unpack(BYTEORDER + 'I', data[4:8])
+        count_fmt, entry_fmt, inline = 'H', 'HHI', 4
+    count, = struct.unpack_from(BYTEORDER + count_fmt, data, offset)
+    pos = offset + struct.calcsize(BYTEORDER + count_fmt)
+    sizes = {2: 1, 3: 2, 4: 4, 16: 8}
+    fmts = {2: 's', 3: 'H', 4: 'I', 16: 'Q'}
+    tags = {}
+    for _ in range(count):
+        tag, typ, n = struct.unpack_from(BYTEORDER + entry_fmt, data, pos)
+        pos += struct.calcsize(BYTEORDER + entry_fmt)
+        if n * sizes[typ] <= inline:
+            value_pos = pos
+        else:
+            value_pos, = struct.unpack_from(
+                BYTEORDER + ('Q' if magic == 43 else 'I'), data, pos)
+        pos += inline
+        if typ == 2:
+            tags[tag] = data[value_pos:value_pos + n]
+        else:
+            tags[tag] = struct.unpack_from(
+                BYTEORDER + str(n) + fmts[typ], data, value_pos)
+    return magic, tags, data
+
+
+@pytest.fixture
+def image():
+    return (numpy.arange(20 * 30 * 3) % 251).astype(numpy.uint8)
+
+
+def test_write_deflate_strips(tmpdir, image):
+    fn = str(tmpdir.join('out.tiff'))
+    stats = write_tiff(fn, image.tobytes(), 30, 20, rows_per_strip=8)
+
+    magic, tags, data = read_tags(fn)
+    assert magic == 42
+    assert tags[256] == (30,)
+    assert tags[257] == (20,)
+    assert tags[259] == (compression_types.deflate,)
+    assert len(tags[273]) == 3
+
+    strips = b''.join(
+        zlib.decompress(data[o:o + n]) for o, n in zip(tags[273], tags[279])
+    )
+    assert strips == image.tobytes()
+    assert stats.bytes_in == image.nbytes
+    assert stats.bytes_out == len(data)
+    assert not stats.bigtiff
+    assert stats.mb_per_s > 0
+    assert stats.ratio > 1
+
+
+def test_write_uncompressed_ignores_predictor(tmpdir, image):
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, image.tobytes(), 30, 20,
+               compression=compression_types.none,
+               predictor=predictors.horizontal)
+
+    _, tags, data = read_tags(fn)
+    assert 317 not in tags
+    offset, = tags[273]
+    assert data[offset:offset + image.nbytes] == image.tobytes()
+
+
+def test_write_predictor(tmpdir):
+    image = numpy.arange(4 * 5, dtype=numpy.uint16)
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, image.tobytes(), 5, 4, colors=1, bits=16,
+               predictor=predictors.horizontal)
+
+    _, tags, data = read_tags(fn)
+    assert tags[317] == (predictors.horizontal,)
+    assert tags[258] == (16,)
+    assert tags[262] == (1,)
+    offset, = tags[273]
+    rows = numpy.frombuffer(
+        zlib.decompress(data[offset:offset + tags[279][0]]), numpy.uint16
+    ).reshape(4, 5)
+    assert (rows[:, 1:] == 1).all()
+    assert numpy.array_equal(numpy.cumsum(rows, axis=1).ravel(), image)
+
+
+def test_write_tiles(tmpdir, image):
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, image.tobytes(), 30, 20, tile_size=(16, 16))
+
+    _, tags, data = read_tags(fn)
+    assert tags[322] == (16,)
+    assert tags[323] == (16,)
+    assert len(tags[324]) == 4
+    assert 273 not in tags
+
+    first = numpy.frombuffer(
+        zlib.decompress(data[tags[324][0]:tags[324][0] + tags[325][0]]),
+        numpy.uint8,
+    ).reshape(16, 16, 3)
+    expected = image.reshape(20, 30, 3)[:16, :16]
+    assert numpy.array_equal(first, expected)
+
+
+def test_write_bigtiff(tmpdir, image):
+    fn = str(tmpdir.join('out.tiff'))
+    stats = write_tiff(fn, image.tobytes(), 30, 20, bigtiff=True)
+
+    magic, tags, data = read_tags(fn)
+    assert magic == 43
+    assert stats.bigtiff
+    assert zlib.decompress(
+        data[tags[273][0]:tags[273][0] + tags[279][0]]) == image.tobytes()
+
+
+def test_write_bigtiff_automatically(tmpdir, image, monkeypatch):
+    fn = str(tmpdir.join('out.tiff'))
+    monkeypatch.setattr('rawkit.tiff.BIGTIFF_THRESHOLD', 1024)
+    stats = write_tiff(fn, image.tobytes(), 30, 20)
+    assert stats.bigtiff
+
+
+def test_write_extra_samples(tmpdir):
+    image = numpy.zeros((2, 2, 4), numpy.uint8)
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, image.tobytes(), 2, 2, colors=4)
+    _, tags, _ = read_tags(fn)
+    assert tags[338] == (0,)
+    assert tags[262] == (2,)
+
+
+def test_lzw_matches_pillow(tmpdir):
+    Image = pytest.importorskip('PIL.Image')
+    image = (numpy.arange(64 * 80 * 3) * 7 % 256).astype(numpy.uint8)
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, image.tobytes(), 80, 64,
+               compression=compression_types.lzw,
+               predictor=predictors.horizontal)
+
+    decoded = numpy.array(Image.open(fn))
+    assert numpy.array_equal(decoded.ravel(), image)
+
+
+@pytest.mark.parametrize('compression,workers', [
+    (compression_types.deflate, 4),
+    (compression_types.lzw, 1),
+    (compression_types.none, 1),
+])
+def test_only_deflate_is_parallel(tmpdir, image, compression, workers):
+    with mock.patch('rawkit.tiff.ThreadPoolExecutor',
+                    wraps=ThreadPoolExecutor) as pool:
+        write_tiff(str(tmpdir.join('out.tiff')), image.tobytes(), 30, 20,
+                   compression=compression, workers=4)
+    pool.assert_called_once_with(workers)
+
+
+@pytest.mark.parametrize('length', [
+    6,  # Ends on a byte boundary.
+    254,  # Widens the codes after the last one.
+    3944,  # Fills the table with the last code.
+    6000,  # Fills the table part way through.
+])
+def test_lzw_table_edges(tmpdir, length):
+    Image = pytest.importorskip('PIL.Image')
+    data = numpy.random.RandomState(0).randint(0, 256, length, numpy.uint8)
+    fn = str(tmpdir.join('out.tiff'))
+    write_tiff(fn, data.tobytes(), length, 1, colors=1,
+               compression=compression_types.lzw)
+
+    decoded = numpy.array(Image.open(fn))
+    assert numpy.array_equal(decoded.ravel(), data)
+
+
+def test_lzw_empty():
+    # Clear code followed by EOI, both 9 bits wide.
+    assert _lzw_compress(b'') == b'\x80\x40\x40'
+
+
+def test_stats_throughput(tmpdir, image):
+    stats = write_tiff(str(tmpdir.join('out.tiff')), image.tobytes(), 30, 20)
+    assert stats._replace(seconds=2).mb_per_s == stats.bytes_in / 2e6
+    assert stats._replace(seconds=0).mb_per_s == float('inf')
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'compression': 7},
+    {'predictor': 3},
+    {'bits': 12},
+    {'tile_size': (10, 16)},
+])
+def test_write_invalid(tmpdir, image, kwargs):
+    with pytest.raises(InvalidFileType):
+        write_tiff(str(tmpdir.join('out.tiff')), image.tobytes(), 30, 20,
+                   **kwargs)
+
+
+def test_write_wrong_size(tmpdir, image):
+    with pytest.raises(ValueError):
+        write_tiff(str(tmpdir.join('out.tiff')), image.tobytes(), 31, 20)
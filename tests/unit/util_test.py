@@ -1,7 +1,9 @@
+import os
 import mock
 import pytest
 
 from rawkit import util
+from rawkit.metadata import Metadata
 from libraw.errors import FileUnsupported
 
 
@@ -13,17 +15,440 @@ def libraw():
         yield libraw
 
 
-def test_discover(libraw):
-    with mock.patch(
-        'rawkit.util.os.walk',
-        return_value=(('', None, ('foo.CR2', 'foo.jpg')),)
-    ):
-        libraw.libraw_open_file.side_effect = [0, FileUnsupported()]
-        files = util.discover('')
-        assert files == ['foo.CR2'.encode('ascii')]
+@pytest.fixture
+def photos(tmpdir):
+    tmpdir.join('a.CR2').write_binary(b'II*\x00\x10\x00\x00\x00CR')
+    tmpdir.join('sub', 'caf\xe9.NEF').write_binary(b'MM\x00*', ensure=True)
+    tmpdir.join('plain.tif').write_binary(b'II*\x00')
+    tmpdir.join('a.jpg').write_binary(b'\xff\xd8\xff\xe1')
+    tmpdir.join('a.xmp').write_binary(b'<x:xmpmeta xmlns:x="adobe:ns:meta/">')
+    return tmpdir
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_discover(libraw, photos, workers):
+    def open_file(data, path):
+        if path.endswith(b'.tif'):
+            raise FileUnsupported()
+    libraw.libraw_open_file.side_effect = open_file
+
+    files = util.discover(str(photos), workers=workers)
+
+    root = os.fsencode(str(photos))
+    assert sorted(files) == sorted([
+        os.path.join(root, b'a.CR2'),
+        os.path.join(root, b'sub', os.fsencode('caf\xe9.NEF')),
+    ])
+    # Files which are certainly not raw files are never opened.
+    opened = sorted(
+        os.path.basename(c[0][1])
+        for c in libraw.libraw_open_file.call_args_list)
+    assert opened == [b'a.CR2', os.fsencode('caf\xe9.NEF'), b'plain.tif']
+    assert libraw.libraw_recycle.call_count == 3
+    assert (libraw.libraw_close.call_count ==
+            libraw.libraw_init.call_count)
 
 
 def test_camera_list(libraw):
     libraw.libraw_cameraCount.return_value = 0
     assert util.camera_list() == []
     libraw.libraw_cameraList.assert_called_once_with()
+
+
+def test_atomic_output(tmpdir):
+    target = tmpdir.join('out.tiff')
+    target.write('old')
+
+    with util.atomic_output(str(target)) as tmp:
+        assert tmp.endswith('.tiff')
+        assert os.path.dirname(tmp) == str(tmpdir)
+        with open(tmp, 'w') as f:
+            f.write('new')
+        assert target.read() == 'old'
+
+    assert target.read() == 'new'
+    assert tmpdir.listdir() == [target]
+
+
+def test_atomic_output_syncs(tmpdir):
+    target = tmpdir.join('out.tiff')
+    synced = []
+
+    def fsync(fd):
+        synced.append(os.path.samestat(os.fstat(fd), os.stat(str(tmpdir))))
+    with mock.patch.object(os, 'fsync', side_effect=fsync):
+        with util.atomic_output(str(target)) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('new')
+    # The file, then the directory.
+    assert synced == [False, True]
+
+    # Directories which can't be synced don't stop the write.
+    with mock.patch.object(os, 'fsync', side_effect=[None, OSError]):
+        with util.atomic_output(str(target)) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('newer')
+    assert target.read() == 'newer'
+
+
+def test_atomic_output_mode(tmpdir):
+    # New files get the same permissions as any other new file...
+    tmpdir.join('direct').write('')
+    with util.atomic_output(str(tmpdir.join('new'))):
+        pass
+    assert (tmpdir.join('new').stat().mode ==
+            tmpdir.join('direct').stat().mode)
+
+    # ...and replaced files keep theirs.
+    target = tmpdir.join('old')
+    target.write('old')
+    target.chmod(0o640)
+    with util.atomic_output(str(target)) as tmp:
+        with open(tmp, 'w') as f:
+            f.write('new')
+    assert target.stat().mode & 0o777 == 0o640
+
+
+def test_atomic_output_failure(tmpdir):
+    target = tmpdir.join('out.tiff')
+    target.write('old')
+
+    with pytest.raises(KeyError):
+        with util.atomic_output(str(target)) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('partial')
+            raise KeyError
+
+    assert target.read() == 'old'
+    assert tmpdir.listdir() == [target]
+
+
+def test_atomic_output_retries_names(tmpdir):
+    target = tmpdir.join('out.tiff')
+    taken = tmpdir.join('.out.tiff.aaaa.tiff')
+    taken.write('taken')
+
+    with mock.patch.object(util.secrets, 'token_hex',
+                           side_effect=['aaaa', 'bbbb']):
+        with util.atomic_output(str(target)) as tmp:
+            assert tmp == str(tmpdir.join('.out.tiff.bbbb.tiff'))
+    assert taken.read() == 'taken'
+
+
+def test_atomic_output_failure_after_removal(tmpdir):
+    # The block may have removed the temporary file itself.
+    with pytest.raises(KeyError):
+        with util.atomic_output(str(tmpdir.join('out.tiff'))) as tmp:
+            os.unlink(tmp)
+            raise KeyError
+    assert tmpdir.listdir() == []
+
+
+def fake_snapshot(data):
+    return Metadata(
+        aperture=2.8, timestamp=1500000000, shutter=0.01, flash=True,
+        focal_length=50.0, height=4000, iso=200.0, make=b'Canon',
+        model=b'EOS', orientation=6, width=6000, shot_order=42,
+    )
+
+
+@pytest.yield_fixture
+def metadata_worker(libraw, monkeypatch):
+    monkeypatch.setattr(util, '_worker_libraw', None)
+    monkeypatch.setattr(util, '_worker_data', None)
+    with mock.patch('rawkit.util.snapshot', side_effect=fake_snapshot):
+        yield libraw
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_read_metadata(metadata_worker, workers):
+    def open_file(data, path):
+        if path == b'bad.CR2':
+            raise FileUnsupported()
+    metadata_worker.libraw_open_file.side_effect = open_file
+
+    table = util.read_metadata(
+        ['a.CR2', 'bad.CR2', 'b.CR2'], workers=workers, chunksize=1)
+
+    assert list(table['path']) == ['a.CR2', 'bad.CR2', 'b.CR2']
+    assert table['error'][0] is None
+    assert table['error'][1].startswith('FileUnsupported')
+    assert table['error'][2] is None
+    assert list(table['iso']) == [200, 0, 200]
+    assert list(table['make']) == [b'Canon', b'', b'Canon']
+    assert table['width'][2] == 6000
+    assert table['timestamp'].dtype == 'int64'
+    assert table['flash'][0]
+    assert table['shot_order'][0] == 42
+
+
+def test_read_metadata_reuses_handle(metadata_worker):
+    util.read_metadata(['a.CR2', 'b.CR2'], workers=1)
+    metadata_worker.libraw_init.assert_called_once_with(0)
+    assert metadata_worker.libraw_recycle.call_count == 2
+    # Reading in this process doesn't keep (or share) a handle.
+    metadata_worker.libraw_close.assert_called_once_with(
+        metadata_worker.libraw_init.return_value)
+    assert util._worker_data is None
+
+
+def test_read_metadata_worker(metadata_worker):
+    # What each worker process runs.
+    util._init_metadata_worker()
+    metadata_worker.libraw_init.assert_called_once_with(0)
+    assert util._read_one('a.CR2')[1] is None
+    metadata_worker.libraw_open_file.assert_called_once_with(
+        metadata_worker.libraw_init.return_value, b'a.CR2')
+
+
+def test_read_metadata_default_workers(metadata_worker):
+    with mock.patch.object(os, 'cpu_count', return_value=None):
+        table = util.read_metadata(['a.CR2'])
+    assert table['error'][0] is None
+    # A single worker reads in this process.
+    metadata_worker.libraw_close.assert_called_once_with(
+        metadata_worker.libraw_init.return_value)
+
+
+def test_read_metadata_empty(metadata_worker):
+    table = util.read_metadata([], workers=1)
+    assert len(table['path']) == 0
+    assert set(table) == set(
+        ['path', 'error'] + [name for name, _ in util.metadata_columns])
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for name in ('a.CR2', 'sub/b.NEF', 'sub/deeper/c.CR2', '.hidden/d.CR2',
+                 'sub/e.DNG'):
+        tmpdir.join(name).write_binary(b'II*\x00', ensure=True)
+    return tmpdir
+
+
+def names(results):
+    return sorted(os.path.basename(r).decode() for r in results)
+
+
+def test_iter_discover(libraw, tree):
+    results = util.iter_discover(str(tree), workers=2)
+    assert not isinstance(results, list)
+    assert names(results) == ['a.CR2', 'b.NEF', 'c.CR2', 'd.CR2', 'e.DNG']
+
+
+def test_iter_discover_filters(libraw, tree):
+    assert names(util.iter_discover(
+        str(tree), include=['*.CR2', '*.NEF'], exclude=['.*', 'deeper'],
+    )) == ['a.CR2', 'b.NEF']
+    # Files which are filtered out are never checked.
+    assert libraw.libraw_open_file.call_count == 2
+
+
+@pytest.mark.parametrize('max_depth,expected', [
+    (0, ['a.CR2']),
+    (1, ['a.CR2', 'b.NEF', 'd.CR2', 'e.DNG']),
+])
+def test_iter_discover_max_depth(libraw, tree, max_depth, expected):
+    assert names(util.iter_discover(str(tree), max_depth=max_depth)) == \
+        expected
+
+
+def test_iter_discover_symlinks(libraw, tree):
+    tree.join('sub', 'loop').mksymlinkto(tree)
+    tree.join('link.CR2').mksymlinkto(tree.join('a.CR2'))
+
+    assert names(util.iter_discover(str(tree))) == [
+        'a.CR2', 'b.NEF', 'c.CR2', 'd.CR2', 'e.DNG']
+    assert names(util.iter_discover(str(tree), follow_symlinks=True)) == [
+        'a.CR2', 'b.NEF', 'c.CR2', 'd.CR2', 'e.DNG', 'link.CR2']
+
+
+def test_iter_discover_records(libraw, tree):
+    record, = util.iter_discover(
+        str(tree), include=['a.CR2'], records=True)
+    st = os.stat(str(tree.join('a.CR2')))
+    assert record == util.DiscoveredFile(
+        os.fsencode(str(tree.join('a.CR2'))), 4, st.st_mtime_ns, 'tiff')
+
+
+@pytest.mark.parametrize('error', [IOError, KeyError])
+def test_iter_discover_unreadable(libraw, tree, error):
+    def open_file(data, path):
+        if path.endswith(b'b.NEF'):
+            raise error()
+    libraw.libraw_open_file.side_effect = open_file
+
+    assert names(util.iter_discover(str(tree))) == [
+        'a.CR2', 'c.CR2', 'd.CR2', 'e.DNG']
+    assert libraw.libraw_recycle.call_count == 5
+
+
+def test_iter_discover_nothing_found(libraw, tree):
+    # More candidates than can be in flight at once, none of them raw.
+    libraw.libraw_open_file.side_effect = FileUnsupported()
+    assert list(util.iter_discover(str(tree), workers=1)) == []
+    assert libraw.libraw_open_file.call_count == 5
+
+
+def test_iter_discover_errors(libraw, tree):
+    # Directories which can't be listed, and entries which can't be checked
+    # (eg. symlink loops), are skipped.
+    tree.join('sub', 'loop').mksymlinkto('loop')
+    deeper = os.fsencode(str(tree.join('sub', 'deeper')))
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if path == deeper:
+            raise PermissionError()
+        return scandir(path)
+
+    with mock.patch('os.scandir', side_effect=failing_scandir):
+        assert names(util.iter_discover(str(tree), follow_symlinks=True)) == [
+            'a.CR2', 'b.NEF', 'd.CR2', 'e.DNG']
+
+
+def test_iter_discover_records_removed_files(libraw, tree):
+    # Files removed while they are checked have no record.
+    libraw.libraw_open_file.side_effect = lambda data, path: os.unlink(path)
+    assert list(util.iter_discover(
+        str(tree), include=['a.CR2'], records=True)) == []
+
+
+def test_iter_discover_stop_early(libraw, tree):
+    results = util.iter_discover(str(tree), workers=1)
+    next(results)
+    results.close()
+    assert (libraw.libraw_close.call_count ==
+            libraw.libraw_init.call_count)
+
+
+def age(tree):
+    """Give every file and directory in a tree the same, old, mtime."""
+    for path in [tree] + list(tree.visit()):
+        os.utime(str(path), (1500000000, 1500000000), follow_symlinks=False)
+
+
+def test_rescan(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    age(tree)
+
+    diff = util.rescan(str(tree), state)
+    assert names(diff.added) == ['a.CR2', 'b.NEF', 'c.CR2', 'd.CR2', 'e.DNG']
+    assert diff.removed == diff.modified == []
+    assert libraw.libraw_open_file.call_count == 5
+
+    # Nothing changed: nothing is listed or opened again.
+    libraw.libraw_open_file.reset_mock()
+    with mock.patch('os.scandir', side_effect=os.scandir) as scandir:
+        assert util.rescan(str(tree), state) == util.ScanDiff([], [], [])
+    assert scandir.call_count == 0
+    assert libraw.libraw_open_file.call_count == 0
+
+    tree.join('sub', 'f.CR2').write_binary(b'II*\x00')
+    tree.join('sub', 'b.NEF').remove()
+    tree.join('sub', 'e.DNG').write_binary(b'II*\x00\x00')
+    with mock.patch('os.scandir', side_effect=os.scandir) as scandir:
+        diff = util.rescan(str(tree), state)
+    assert names(diff.added) == ['f.CR2']
+    assert names(diff.removed) == ['b.NEF']
+    assert names(diff.modified) == ['e.DNG']
+    # Only the changed directory was listed.
+    assert scandir.call_count == 1
+    assert libraw.libraw_open_file.call_count == 2
+
+
+def test_rescan_verify(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    age(tree)
+    util.rescan(str(tree), state)
+
+    # Editing a file doesn't change its directory's mtime.
+    tree.join('a.CR2').write_binary(b'II*\x00\x00')
+    age(tree)
+    os.utime(str(tree.join('a.CR2')))
+    assert util.rescan(str(tree), state) == util.ScanDiff([], [], [])
+    assert names(util.rescan(str(tree), state, verify=True).modified) == \
+        ['a.CR2']
+    assert util.rescan(str(tree), state, verify=True) == \
+        util.ScanDiff([], [], [])
+
+
+def test_rescan_options_changed(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    age(tree)
+    util.rescan(str(tree), state)
+
+    # State recorded with other filters can't be reused.
+    diff = util.rescan(str(tree), state, exclude=['.*'])
+    assert names(diff.added) == ['a.CR2', 'b.NEF', 'c.CR2', 'e.DNG']
+    assert diff.removed == []
+
+
+def test_rescan_recent_directories(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    util.rescan(str(tree), state)
+
+    # The tree was modified just now, so its mtimes aren't trusted, but files
+    # which haven't changed still aren't opened again.
+    libraw.libraw_open_file.reset_mock()
+    with mock.patch('os.scandir', side_effect=os.scandir) as scandir:
+        assert util.rescan(str(tree), state) == util.ScanDiff([], [], [])
+    assert scandir.call_count == 4
+    assert libraw.libraw_open_file.call_count == 0
+
+
+def test_rescan_listing_error(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    age(tree)
+    util.rescan(str(tree), state)
+
+    # Adding a file changes sub's mtime, so it is listed again...
+    tree.join('sub', 'f.CR2').write_binary(b'II*\x00')
+    sub = os.fsencode(str(tree.join('sub')))
+
+    # ...but a transient error doesn't lose what was known under it.
+    with mock.patch('os.scandir', side_effect=PermissionError) as scandir:
+        assert util.rescan(str(tree), state) == util.ScanDiff([], [], [])
+    scandir.assert_called_once_with(sub)
+    diff = util.rescan(str(tree), state)
+    assert names(diff.added) == ['f.CR2']
+    assert diff.removed == diff.modified == []
+
+
+def test_rescan_filters(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    tree.join('notes.txt').write('not a raw file')
+
+    def open_file(data, path):
+        if path.endswith(b'.txt'):
+            raise FileUnsupported()
+    libraw.libraw_open_file.side_effect = open_file
+
+    # Files which don't match, or aren't raw files, aren't recorded.
+    diff = util.rescan(str(tree), state, include=['*.CR2', '*.txt'],
+                       max_depth=1)
+    assert names(diff.added) == ['a.CR2', 'd.CR2']
+
+
+def test_rescan_symlinks(libraw, tree, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    outside = tmpdir_factory.mktemp('outside')
+    outside.join('linked', 'f.CR2').write_binary(b'II*\x00', ensure=True)
+    outside.join('g.CR2').write_binary(b'II*\x00')
+    tree.join('sub', 'linked').mksymlinkto(outside.join('linked'))
+    tree.join('sub', 'g.CR2').mksymlinkto(outside.join('g.CR2'))
+    # Links back into the tree aren't followed around in circles, and
+    # links which can't be resolved are skipped.
+    tree.join('sub', 'tree').mksymlinkto(tree)
+    tree.join('sub', 'loop').mksymlinkto('loop')
+    age(tree)
+
+    diff = util.rescan(str(tree), state, follow_symlinks=True)
+    assert names(diff.added) == [
+        'a.CR2', 'b.NEF', 'c.CR2', 'd.CR2', 'e.DNG', 'f.CR2', 'g.CR2']
+
+    # The links are still there, so their directory is unchanged, but what
+    # they point to is gone.
+    outside.join('linked').remove()
+    outside.join('g.CR2').remove()
+    diff = util.rescan(str(tree), state, follow_symlinks=True, verify=True)
+    assert names(diff.removed) == ['f.CR2', 'g.CR2']
@@ -0,0 +1,395 @@
+import os
+import sys
+import threading
+import time
+
+import mock
+import pytest
+
+from rawkit import watch
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason='inotify is Linux only')
+
+RAW = b'II*\x00\x10\x00\x00\x00CR'
+
+
+@pytest.yield_fixture
+def libraw():
+    with mock.patch('rawkit.util.LibRaw') as libraw:
+        libraw.return_value = libraw
+        yield libraw
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+class Handler(object):
+
+    def __init__(self, error=None):
+        self.paths = []
+        self.error = error
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        with self.lock:
+            self.paths.append(path)
+        if self.error is not None:
+            raise self.error
+
+    def names(self):
+        with self.lock:
+            return sorted(os.path.basename(p).decode() for p in self.paths)
+
+
+def test_parse_events():
+    buffer = (watch._EVENT.pack(1, watch._IN_CLOSE_WRITE, 0, 16) +
+              b'a.CR2'.ljust(16, b'\x00') +
+              watch._EVENT.pack(-1, watch._IN_Q_OVERFLOW, 0, 0))
+    assert list(watch._parse_events(buffer)) == [
+        (1, watch._IN_CLOSE_WRITE, 0, b'a.CR2'),
+        (-1, watch._IN_Q_OVERFLOW, 0, b''),
+    ]
+
+
+def test_inotify_unavailable():
+    with mock.patch.object(watch, '_libc', None):
+        with mock.patch('ctypes.CDLL', return_value=object()):
+            with pytest.raises(OSError):
+                watch._inotify()
+
+
+def test_watch(libraw, tmpdir, tmpdir_factory):
+    handler = Handler()
+    elsewhere = tmpdir_factory.mktemp('elsewhere').join('c.ORF')
+    elsewhere.write_binary(RAW)
+    tmpdir.join('old.CR2').write_binary(RAW)
+    with watch.Watcher(str(tmpdir), handler, debounce=0.01,
+                       workers=2) as watcher:
+        tmpdir.join('a.CR2').write_binary(RAW)
+        tmpdir.join('a.jpg').write_binary(b'\xff\xd8\xff\xe1')
+        tmpdir.join('sub', 'b.NEF').write_binary(b'MM\x00*', ensure=True)
+        elsewhere.rename(tmpdir.join('c.ORF'))
+        wait_for(lambda: handler.names() == ['a.CR2', 'b.NEF', 'c.ORF'])
+        wait_for(lambda: watcher.stats.skipped == 1)
+
+    # Files which already existed aren't developed.
+    assert handler.names() == ['a.CR2', 'b.NEF', 'c.ORF']
+    stats = watcher.stats
+    assert stats.developed == 3
+    assert stats.failed == stats.pending == stats.queued == 0
+    assert stats.max_queued >= 1
+    assert 0 < stats.latency <= stats.max_latency
+    assert libraw.libraw_close.call_count == libraw.libraw_init.call_count
+
+
+def test_watch_debounce(libraw, tmpdir):
+    handler = Handler()
+    with watch.Watcher(str(tmpdir), handler, debounce=0.2):
+        for _ in range(3):
+            tmpdir.join('a.CR2').write_binary(RAW)
+        wait_for(lambda: handler.names())
+        time.sleep(0.3)
+    assert handler.names() == ['a.CR2']
+
+
+def test_watch_filters(libraw, tmpdir):
+    handler = Handler()
+    with watch.Watcher(str(tmpdir), handler, recursive=False,
+                       include=['*.CR2'], exclude=['.*'], debounce=0):
+        tmpdir.join('a.CR2').write_binary(RAW)
+        tmpdir.join('.b.CR2').write_binary(RAW)
+        tmpdir.join('c.NEF').write_binary(RAW)
+        tmpdir.join('sub', 'd.CR2').write_binary(RAW, ensure=True)
+        wait_for(lambda: handler.names())
+    assert handler.names() == ['a.CR2']
+
+
+def test_watch_stop_dispatches_pending(libraw, tmpdir):
+    handler = Handler()
+    with watch.Watcher(str(tmpdir), handler, debounce=60) as watcher:
+        tmpdir.join('a.CR2').write_binary(RAW)
+        wait_for(lambda: watcher.stats.pending == 1)
+    assert handler.names() == ['a.CR2']
+
+
+def test_watch_errors(libraw, tmpdir):
+    error = ValueError('broken')
+    handler = Handler(error)
+    on_error = mock.Mock()
+    with watch.Watcher(str(tmpdir), handler, debounce=0,
+                       on_error=on_error) as watcher:
+        tmpdir.join('a.CR2').write_binary(RAW)
+        wait_for(lambda: watcher.stats.failed == 1)
+        tmpdir.join('b.CR2').write_binary(RAW)
+        wait_for(lambda: watcher.stats.failed == 2)
+    on_error.assert_any_call(os.fsencode(str(tmpdir.join('a.CR2'))), error)
+
+
+def test_watch_errors_without_callback(libraw, tmpdir):
+    handler = Handler(ValueError('broken'))
+    with watch.Watcher(str(tmpdir), handler, debounce=0) as watcher:
+        tmpdir.join('a.CR2').write_binary(RAW)
+        wait_for(lambda: watcher.stats.failed == 1)
+
+
+def test_watch_run(libraw, tmpdir):
+    handler = Handler()
+    watcher = watch.Watcher(str(tmpdir), handler, debounce=0)
+    # Stopping a watcher which hasn't started does nothing.
+    watcher.stop()
+
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        wait_for(lambda: watcher._wake is not None)
+        tmpdir.join('a.CR2').write_binary(RAW)
+        wait_for(lambda: handler.names() == ['a.CR2'])
+    finally:
+        watcher.stop()
+        thread.join()
+    assert watcher._fd is None
+
+
+def test_watch_directories(libraw, tmpdir):
+    for name in ('gone', 'skipped', 'removed'):
+        tmpdir.join(name).ensure(dir=True)
+    handler = Handler()
+    watcher = watch.Watcher(str(tmpdir), handler, exclude=['skip*'],
+                            debounce=0)
+    add_watch = watcher._libc.inotify_add_watch
+    gone = os.fsencode(str(tmpdir.join('gone')))
+
+    def failing_add_watch(fd, path, mask):
+        # As if the directory was removed before it could be watched.
+        return -1 if path == gone else add_watch(fd, path, mask)
+    watcher._libc = mock.Mock(wraps=watcher._libc)
+    watcher._libc.inotify_add_watch.side_effect = failing_add_watch
+
+    def watched():
+        return sorted(os.path.basename(d).decode()
+                      for d in watcher._directories.values())
+    with watcher:
+        assert watched() == ['removed', os.path.basename(str(tmpdir))]
+        # Excluded directories aren't watched when they are created either.
+        tmpdir.join('skipped2', 'a.CR2').write_binary(RAW, ensure=True)
+        tmpdir.join('new', 'b.CR2').write_binary(RAW, ensure=True)
+        # Without a debounce, a file written while its directory is being
+        # listed may be seen both ways.
+        wait_for(lambda: handler.names()[:1] == ['b.CR2'])
+        # Directories which are removed are forgotten.
+        tmpdir.join('removed').remove()
+        wait_for(lambda: 'removed' not in watched())
+    assert set(handler.names()) == {'b.CR2'}
+
+
+def test_watch_new_tree(libraw, tmpdir):
+    handler = Handler()
+    watcher = watch.Watcher(str(tmpdir), handler)
+    watcher._open()
+    try:
+        # Everything already in a new directory when it is watched is
+        # scheduled, however deep.
+        tmpdir.join('new', 'sub', 'b.CR2').write_binary(RAW, ensure=True)
+        tmpdir.join('new', 'a.CR2').write_binary(RAW)
+        watcher._watch_tree(os.fsencode(str(tmpdir.join('new'))),
+                            schedule=True)
+        assert sorted(os.path.basename(p) for p in watcher._due) == [
+            b'a.CR2', b'b.CR2']
+        assert os.fsencode(str(tmpdir.join('new', 'sub'))) in \
+            watcher._directories.values()
+    finally:
+        watcher._close()
+    assert handler.names() == ['a.CR2', 'b.CR2']
+
+
+def test_watch_directory_removed_while_listing(libraw, tmpdir):
+    tmpdir.join('removed').ensure(dir=True)
+    watcher = watch.Watcher(str(tmpdir), Handler())
+    add_watch = watcher._libc.inotify_add_watch
+    removed = os.fsencode(str(tmpdir.join('removed')))
+
+    def removing_add_watch(fd, path, mask):
+        wd = add_watch(fd, path, mask)
+        if path == removed:
+            os.rmdir(path)
+        return wd
+    watcher._libc = mock.Mock(wraps=watcher._libc)
+    watcher._libc.inotify_add_watch.side_effect = removing_add_watch
+
+    watcher._open()
+    try:
+        assert removed in watcher._directories.values()
+    finally:
+        watcher._close()
+
+
+def test_watch_stray_events(libraw, tmpdir):
+    watcher = watch.Watcher(str(tmpdir), Handler(), recursive=False)
+    watcher._open()
+    try:
+        # Nothing to read.
+        watcher._read()
+
+        wd, = watcher._directories
+        events = [
+            (wd + 1, watch._IN_CLOSE_WRITE, 0, b'a.CR2'),
+            (wd, watch._IN_CLOSE_WRITE, 0, b''),
+            (wd, watch._IN_CREATE | watch._IN_ISDIR, 0, b'sub'),
+        ]
+        with mock.patch('os.read', return_value=b''):
+            with mock.patch.object(watch, '_parse_events',
+                                   return_value=events):
+                watcher._read()
+        assert list(watcher._directories) == [wd]
+        assert watcher.stats.events == 0
+
+        # Files which are gone by the time they are seen are still
+        # dispatched (and skipped), but not remembered.
+        gone = os.fsencode(str(tmpdir.join('gone.CR2')))
+        watcher._schedule(gone, b'gone.CR2')
+        assert watcher.stats.pending == 1
+        assert watcher._seen == {}
+    finally:
+        watcher._close()
+    wait_for(lambda: watcher.stats.skipped == 1)
+
+
+def test_watch_overflow_rescans(libraw, tmpdir, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    lost = []
+    parse_events = watch._parse_events
+
+    def lossy(buffer):
+        if lost:
+            # The kernel dropped these events.
+            lost.pop()
+            return [(-1, watch._IN_Q_OVERFLOW, 0, b'')]
+        return parse_events(buffer)
+
+    handler = Handler()
+    tmpdir.join('old.CR2').write_binary(RAW)
+    with mock.patch.object(watch, '_parse_events', side_effect=lossy):
+        with watch.Watcher(str(tmpdir), handler, recursive=False,
+                           debounce=0, state_file=state) as watcher:
+            tmpdir.join('a.CR2').write_binary(RAW)
+            wait_for(lambda: handler.names() == ['a.CR2'])
+            lost.append(True)
+            tmpdir.join('b.CR2').write_binary(RAW)
+            wait_for(lambda: watcher.stats.overflows == 1)
+            wait_for(lambda: handler.names() == ['a.CR2', 'b.CR2'])
+
+    # Files which already existed, or were seen arriving, aren't developed
+    # again.
+    assert handler.names() == ['a.CR2', 'b.CR2']
+    assert os.path.exists(state)
+
+
+def test_watch_overflow_keeps_reading(libraw, tmpdir):
+    scanning = threading.Event()
+    release = threading.Event()
+    rescan = watch.rescan
+
+    def slow_rescan(*args, **kwargs):
+        if watcher.stats.overflows:
+            scanning.set()
+            release.wait()
+        return rescan(*args, **kwargs)
+
+    def overflow(name):
+        overflows = watcher.stats.overflows
+        with mock.patch.object(watch, '_parse_events', return_value=[
+                (-1, watch._IN_Q_OVERFLOW, 0, b'')]):
+            tmpdir.join(name).write_binary(RAW)
+            wait_for(lambda: watcher.stats.overflows > overflows)
+
+    handler = Handler()
+    with mock.patch.object(watch, 'rescan', side_effect=slow_rescan):
+        watcher = watch.Watcher(str(tmpdir), handler, debounce=0)
+        with watcher:
+            try:
+                overflow('a.CR2')
+                assert scanning.wait(5)
+                # Events are still read and dispatched while the tree is
+                # being rescanned (a.CR2's own events may not all have been
+                # read before the overflow, so it may be dispatched too).
+                tmpdir.join('b.CR2').write_binary(RAW)
+                wait_for(lambda: 'b.CR2' in handler.names())
+                # Events lost during the rescan may have been missed by it,
+                # so the tree is scanned again.
+                overflow('c.CR2')
+                wait_for(lambda: watcher._rescan_again)
+            finally:
+                # Don't leave the rescan (which stopping waits for) stuck.
+                release.set()
+            wait_for(lambda: handler.names() == ['a.CR2', 'b.CR2', 'c.CR2'])
+    assert handler.names() == ['a.CR2', 'b.CR2', 'c.CR2']
+
+
+def test_watch_stop_while_rescanning(libraw, tmpdir):
+    scanning = threading.Event()
+    rescan = watch.rescan
+
+    def slow_rescan(*args, **kwargs):
+        if watcher.stats.overflows:
+            scanning.set()
+            time.sleep(0.2)
+        return rescan(*args, **kwargs)
+
+    handler = Handler()
+    with mock.patch.object(watch, 'rescan', side_effect=slow_rescan):
+        watcher = watch.Watcher(str(tmpdir), handler, debounce=60)
+        with watcher:
+            with mock.patch.object(watch, '_parse_events', return_value=[
+                    (-1, watch._IN_Q_OVERFLOW, 0, b'')]):
+                tmpdir.join('a.CR2').write_binary(RAW)
+                assert scanning.wait(5)
+    # Stopping waited for the rescan, and dispatched what it found.
+    assert handler.names() == ['a.CR2']
+
+
+def test_watch_resumes(libraw, tmpdir, tmpdir_factory):
+    state = str(tmpdir_factory.mktemp('state').join('scan.json'))
+    tmpdir.join('old.CR2').write_binary(RAW)
+    handler = Handler()
+    with watch.Watcher(str(tmpdir), handler, debounce=0, state_file=state):
+        pass
+
+    # Files written while nobody was watching are dispatched when watching
+    # starts again, but the others aren't (and nor are those which are
+    # removed again before they can be).
+    tmpdir.join('new.CR2').write_binary(RAW)
+    tmpdir.join('gone.CR2').write_binary(RAW)
+    rescan = watch.rescan
+
+    def rescan_then_remove(*args, **kwargs):
+        diff = rescan(*args, **kwargs)
+        tmpdir.join('gone.CR2').remove()
+        return diff
+    with mock.patch.object(watch, 'rescan', side_effect=rescan_then_remove):
+        with watch.Watcher(str(tmpdir), handler, debounce=0,
+                           state_file=state):
+            wait_for(lambda: handler.names())
+    assert handler.names() == ['new.CR2']
+
+
+def test_watch_forgets_removed_files(libraw, tmpdir, tmpdir_factory):
+    elsewhere = tmpdir_factory.mktemp('elsewhere').join('b.CR2')
+    handler = Handler()
+    with watch.Watcher(str(tmpdir), handler, debounce=0) as watcher:
+        tmpdir.join('a.CR2').write_binary(RAW)
+        tmpdir.join('b.CR2').write_binary(RAW)
+        wait_for(lambda: len(watcher._seen) == 2)
+        tmpdir.join('a.CR2').remove()
+        tmpdir.join('b.CR2').rename(elsewhere)
+        wait_for(lambda: not watcher._seen)
+
+
+def test_watch_missing_directory(tmpdir):
+    watcher = watch.Watcher(str(tmpdir.join('missing')), Handler())
+    with pytest.raises(OSError):
+        watcher.start()
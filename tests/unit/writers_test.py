@@ -0,0 +1,265 @@
+import threading
+
+import mock
+import numpy
+import pytest
+
+from rawkit.errors import InvalidFileType, NoFileSpecified
+from rawkit.raw import ProcessedImage
+from rawkit import writers
+
+
+@pytest.fixture
+def image():
+    pixels = numpy.arange(2 * 3 * 3, dtype=numpy.uint16) * 1000
+    return ProcessedImage(3, 2, 3, 16, bytearray(pixels.tobytes()))
+
+
+@pytest.fixture
+def expected(image):
+    pixels = numpy.arange(2 * 3 * 3, dtype=numpy.float32) * 1000
+    return (pixels / 65535).reshape(2, 3, 3)
+
+
+def test_float_chunks(image, expected, monkeypatch):
+    monkeypatch.setattr(writers, '_CHUNK_ROWS', 1)
+    chunks = list(writers.float_chunks(image))
+    assert [start for start, _ in chunks] == [0, 1]
+    assert numpy.allclose(numpy.concatenate([c for _, c in chunks]), expected)
+
+
+def test_float_chunks_8_bit():
+    image = ProcessedImage(1, 1, 3, 8, bytearray([0, 51, 255]))
+    _, chunk = next(writers.float_chunks(image))
+    assert numpy.allclose(chunk, [[[0, 0.2, 1]]])
+
+
+def test_write_npy(image, expected, tmpdir):
+    fn = str(tmpdir.join('out.npy'))
+    writers.write_npy(fn, image)
+    result = numpy.load(fn)
+    assert result.dtype == numpy.float32
+    assert numpy.allclose(result, expected)
+
+
+def test_write_pfm(image, expected, tmpdir, monkeypatch):
+    monkeypatch.setattr(writers, '_CHUNK_ROWS', 1)
+    fn = str(tmpdir.join('out.pfm'))
+    writers.write_pfm(fn, image)
+
+    with open(fn, 'rb') as f:
+        assert f.readline() == b'PF\n'
+        assert f.readline() == b'3 2\n'
+        assert f.readline() == b'-1.0\n'
+        data = numpy.frombuffer(f.read(), '<f4').reshape(2, 3, 3)
+
+    # Rows are stored bottom to top.
+    assert numpy.allclose(data[::-1], expected)
+
+
+def test_write_pfm_grayscale(tmpdir):
+    image = ProcessedImage(1, 1, 1, 8, bytearray([255]))
+    fn = str(tmpdir.join('out.pfm'))
+    writers.write_pfm(fn, image)
+    with open(fn, 'rb') as f:
+        assert f.read(3) == b'Pf\n'
+
+
+def test_write_pfm_invalid_colors(tmpdir):
+    image = ProcessedImage(1, 1, 4, 8, bytearray(4))
+    with pytest.raises(ValueError):
+        writers.write_pfm(str(tmpdir.join('out.pfm')), image)
+
+
+def test_write_ppm_16_bit(image, tmpdir):
+    fn = str(tmpdir.join('out.ppm'))
+    writers.write_ppm(fn, image)
+
+    with open(fn, 'rb') as f:
+        assert f.readline() == b'P6\n'
+        assert f.readline() == b'3 2\n'
+        assert f.readline() == b'65535\n'
+        data = numpy.frombuffer(f.read(), '>u2')
+    assert numpy.array_equal(data, numpy.arange(18) * 1000)
+
+
+def test_write_ppm_8_bit_grayscale(tmpdir):
+    image = ProcessedImage(2, 1, 1, 8, bytearray([1, 2]))
+    fn = str(tmpdir.join('out.pgm'))
+    writers.write_ppm(fn, image)
+    with open(fn, 'rb') as f:
+        assert f.read() == b'P5\n2 1\n255\n\x01\x02'
+
+
+def test_write_ppm_invalid_colors(tmpdir):
+    image = ProcessedImage(1, 1, 4, 8, bytearray(4))
+    with pytest.raises(ValueError):
+        writers.write_ppm(str(tmpdir.join('out.ppm')), image)
+
+
+@pytest.mark.parametrize('filename,filetype,writer', [
+    ('out.ppm', None, 'write_ppm'),
+    ('out', None, 'write_ppm'),
+    ('out.npy', None, 'write_npy'),
+    ('out.pfm', None, 'write_pfm'),
+    ('out.img', 'pfm', 'write_pfm'),
+])
+def test_write_image_dispatch(image, filename, filetype, writer):
+    with mock.patch.object(writers, writer) as mock_writer:
+        writers.write_image(filename, image, filetype)
+    mock_writer.assert_called_once_with(filename, image)
+
+
+def test_write_image_tiff(image):
+    with mock.patch.object(writers, 'write_tiff') as write_tiff:
+        writers.write_image('out.TIFF', image, level=9)
+    write_tiff.assert_called_once_with(
+        'out.TIFF', image.data, 3, 2, colors=3, bits=16, level=9)
+
+
+@pytest.mark.parametrize('filetype', ['ppm', 'tiff', 'npy', 'pfm'])
+def test_encode_image(image, filetype, tmpdir):
+    fn = str(tmpdir.join('out'))
+    writers.write_image(fn, image, filetype)
+    with open(fn, 'rb') as f:
+        assert writers.encode_image(image, filetype) == f.read()
+
+
+def test_write_image_invalid(image):
+    with pytest.raises(InvalidFileType):
+        writers.write_image('out.gif', image)
+    with pytest.raises(NoFileSpecified):
+        writers.write_image(None, image)
+
+
+def test_async_writer_writes(image, tmpdir):
+    with writers.AsyncWriter(workers=2) as writer:
+        futures = [
+            writer.submit(image, str(tmpdir.join('{}.ppm'.format(i))))
+            for i in range(5)
+        ]
+    assert all(f.done() and f.exception() is None for f in futures)
+    assert len(tmpdir.listdir()) == 5
+    assert writer.pending == 0
+
+
+def test_async_writer_back_pressure(image):
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_write(*args, **kwargs):
+        started.set()
+        release.wait(5)
+
+    with mock.patch.object(writers, 'write_image', slow_write):
+        writer = writers.AsyncWriter(workers=1, max_pending=1)
+        writer.submit(image, 'a.ppm')
+        started.wait(5)
+
+        blocked = threading.Thread(
+            target=writer.submit, args=(image, 'b.ppm'))
+        blocked.start()
+        blocked.join(0.1)
+        assert blocked.is_alive()
+        assert writer.pending == 1
+
+        release.set()
+        blocked.join(5)
+        assert not blocked.is_alive()
+        writer.close()
+
+
+def test_async_writer_reports_errors(image):
+    with mock.patch.object(writers, 'write_image', side_effect=IOError):
+        with pytest.raises(IOError):
+            with writers.AsyncWriter() as writer:
+                future = writer.submit(image, 'out.ppm')
+        assert isinstance(future.exception(), IOError)
+        assert writer.flush() == [future]
+
+
+def test_async_writer_flush_reports_errors_before_callbacks(image):
+    with mock.patch.object(writers, 'write_image', side_effect=IOError):
+        writer = writers.AsyncWriter()
+        # Stand in for a done callback which hasn't run yet.
+        with mock.patch.object(writer, '_done'):
+            future = writer.submit(image, 'out.ppm')
+            assert writer.flush() == [future]
+        writer._executor.shutdown(wait=True)
+
+
+def test_async_writer_keeps_body_error(image):
+    with mock.patch.object(writers, 'write_image', side_effect=IOError):
+        with pytest.raises(KeyError):
+            with writers.AsyncWriter() as writer:
+                writer.submit(image, 'out.ppm')
+                raise KeyError
+
+
+def test_async_writer_submit_after_close(image):
+    writer = writers.AsyncWriter()
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.submit(image, 'out.ppm')
+    # The slot taken by the failed submit was given back.
+    assert writer._slots.acquire(blocking=False)
+
+
+def test_to_8_bit(image):
+    result = writers.to_8_bit(image)
+    assert result.bits == 8
+    assert list(result.data[:3]) == [0, 1000 >> 8, 2000 >> 8]
+    assert writers.to_8_bit(result) is result
+
+
+def test_resize_noop(image):
+    assert writers.resize(image, None) is image
+    assert writers.resize(image, 3) is image
+
+
+@pytest.mark.parametrize('bits,colors', [(8, 3), (8, 1), (16, 3)])
+def test_resize(bits, colors):
+    pytest.importorskip('PIL')
+    dtype = numpy.uint8 if bits == 8 else numpy.uint16
+    pixels = numpy.full((40, 20, colors), 200, dtype=dtype)
+    image = ProcessedImage(20, 40, colors, bits, bytearray(pixels.tobytes()))
+
+    result = writers.resize(image, 10)
+
+    assert (result.width, result.height) == (5, 10)
+    assert result.bits == bits
+    scaled = numpy.frombuffer(result.data, dtype)
+    assert scaled.size == 5 * 10 * colors
+    assert (scaled == 200).all()
+
+
+def test_write_pillow(image, tmpdir):
+    Image = pytest.importorskip('PIL.Image')
+    fn = str(tmpdir.join('out.png'))
+    writers.write_pillow(fn, image, 'png')
+    decoded = numpy.asarray(Image.open(fn))
+    assert decoded.shape == (2, 3, 3)
+    assert decoded[1, 2, 2] == 17000 >> 8
+
+
+def test_write_pillow_invalid_colors(tmpdir):
+    pytest.importorskip('PIL')
+    image = ProcessedImage(1, 1, 4, 8, bytearray(4))
+    with pytest.raises(ValueError):
+        writers.write_pillow(str(tmpdir.join('out.png')), image, 'png')
+
+
+@pytest.mark.parametrize('filename,filetype,expected', [
+    ('out.JPG', None, 'jpeg'),
+    ('out.tif', None, 'tiff'),
+    ('out', None, 'ppm'),
+    ('out.img', 'png', 'png'),
+])
+def test_image_filetype(filename, filetype, expected):
+    assert writers.image_filetype(filename, filetype) == expected
+
+
+def test_write_image_pillow(image):
+    with mock.patch.object(writers, 'write_pillow') as write_pillow:
+        writers.write_image('out.jpg', image, quality=90)
+    write_pillow.assert_called_once_with('out.jpg', image, 'jpeg', quality=90)
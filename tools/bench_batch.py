@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# Usage: tools/bench_batch.py /path/to/raw/files...
+#
+# Compares how many files per second can be developed with
+# rawkit.batch.develop (a pool of processes) and rawkit.batch.develop_threaded
+# (a pool of threads) for 4 to 32 workers (up to the number of CPUs), along
+# with the peak memory of the largest process (with processes, the total is
+# roughly that times the number of workers). Set WORKERS (eg. WORKERS=4,8)
+# to choose the worker counts. Outputs are written to a temporary directory
+# and discarded.
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from rawkit.batch import develop, develop_threaded
+from rawkit.options import Options
+
+
+def peak_mb(who):
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+files = sys.argv[1:]
+cpus = os.cpu_count() or 1
+counts = [int(n) for n in os.environ.get('WORKERS', '').split(',') if n] or [
+    n for n in (4, 8, 16, 32) if n <= cpus] or [cpus]
+options = Options({'half_size': True})
+
+for workers in counts:
+    for name, run, who in (
+            ('processes', develop, resource.RUSAGE_CHILDREN),
+            ('threads', develop_threaded, resource.RUSAGE_SELF)):
+        out = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            failed = sum(
+                result.error is not None
+                for result in run(files, options,
+                                  os.path.join(out, '{index}.tiff'),
+                                  workers=workers))
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(out)
+        print('{:>3} {:<10} {:>8.2f} files/s {:>8.0f} MB peak {:>4} failed'
+              .format(workers, name, len(files) / elapsed, peak_mb(who),
+                      failed))
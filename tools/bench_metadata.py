@@ -0,0 +1,37 @@
+#! /usr/bin/env python
+# Usage: tools/bench_metadata.py /path/to/raw/files...
+#
+# Compares how many files per second can be catalogued with a regular Raw
+# (which keeps the file open, and which catalogue code often unpacks by
+# accident) against Raw.open_metadata().
+import sys
+import time
+
+from rawkit.raw import Raw
+
+
+def regular(filename):
+    with Raw(filename=filename) as raw:
+        return raw.metadata
+
+
+def regular_unpacked(filename):
+    with Raw(filename=filename) as raw:
+        raw.unpack()
+        return raw.metadata
+
+
+def metadata_only(filename):
+    with Raw.open_metadata(filename) as raw:
+        return raw.metadata
+
+
+files = sys.argv[1:]
+for name, read in (('Raw', regular),
+                   ('Raw + unpack()', regular_unpacked),
+                   ('Raw.open_metadata', metadata_only)):
+    start = time.time()
+    for filename in files:
+        read(filename)
+    elapsed = time.time() - start
+    print('{:<20} {:>10.1f} files/s'.format(name, len(files) / elapsed))